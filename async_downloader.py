@@ -0,0 +1,803 @@
+import asyncio
+import os
+import ssl
+import threading
+import time
+import traceback
+from urllib.parse import urljoin, urlparse
+
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None  # 没有h2时 "http2" 引擎退回HTTP/1.1 / without h2 the "http2" engine falls back to HTTP/1.1
+
+from configs import *
+from utils import log, progress_bar, logger
+from cache_handler import CacheType, save_spool_state, save_spool_to_cache
+from downloader import DownloadAborted, DownloadWindow, _assign, _completed_intervals, _has_unassigned_range, _keep_partial_spool, _next_in_run, _pick_range, _pick_straggler, _retry_delay, _retry_wait, _split_for_hedge, _store_hedge, _store_piece
+from session_pool import get_origin
+from host_profile import get_concurrency, record_range_support
+from mirror_handler import MirrorSelector, source_headers
+from redirect_handler import MAX_REDIRECTS, REDIRECT_STATUS
+from range_transport import _build_request, _request_fields
+from circuit_breaker import is_open, record_failure, record_success
+
+# 基于asyncio的下载引擎: 所有下载的分片连接由同一个事件循环驱动, 不再每个连接占一个线程.
+# 调度表, 下载窗口和写盘的约定与downloader.download_file_with_schedule相同, 由DOWNLOADER_ENGINE选择.
+# Asyncio download engine: one event loop drives the chunk connections of every download.
+# It keeps the schedule / window / spool contract of downloader.download_file_with_schedule.
+#
+# DOWNLOADER_ENGINE = "http2" 时支持HTTP/2的源上所有分片请求作为流复用少数几个连接, 减少握手并避开按IP的连接数限制
+# With DOWNLOADER_ENGINE = "http2" the range requests to an HTTP/2 origin are streams multiplexed over a few connections
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+_H2_MAX_STREAMS = 100  # 源站没有限制时每个连接上的并发流数 / concurrent streams per connection when the origin sets no limit
+
+_loop = None
+_loop_lock = threading.Lock()
+_pools = {}  # 源 -> _OriginPool, 只在事件循环中访问 / only touched from the event loop
+_connections = None  # 所有下载共享的连接数限制 / connection limit shared by all downloads
+
+def _get_loop():
+    """获取下载用的事件循环, 第一次调用时在后台线程中启动"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name="AsyncDownloader").start()
+        return _loop
+
+def _create_ssl_context():
+    return ssl.create_default_context(cafile=DEFAULT_CA_BUNDLE_PATH)
+
+class _Connection:
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    def usable(self):
+        return not self.reader.at_eof() and not self.writer.is_closing()
+
+    def close(self):
+        self.writer.close()
+
+class _Response:
+    """HTTP/1.1响应, 响应体读完并且源站允许时连接可以复用"""
+    def __init__(self, connection: _Connection, status_code: int, reason: str, headers: dict, keep_alive: bool):
+        self.connection = connection
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.keep_alive = keep_alive
+        self.complete = False
+
+    async def _read(self, size: int):
+        data = await asyncio.wait_for(self.connection.reader.read(size), READ_TIMEOUT)
+        if not data:
+            raise ConnectionError("Connection closed while reading the response body")
+        return data
+
+    async def _readline(self):
+        return await asyncio.wait_for(self.connection.reader.readline(), READ_TIMEOUT)
+
+    async def _skip_trailer(self):
+        while (await self._readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+    async def iter_content(self, piece_size: int):
+        """
+        逐块读取响应体. 调用者收到区间的最后一块后通常直接break, 不会再让生成器继续,
+        所以complete在交出最后一块之前设置, 连接才能回到连接池.
+        """
+        if "chunked" in self.headers.get("transfer-encoding", "").lower():
+            chunk_size = int((await self._readline()).split(b";")[0], 16)
+            if chunk_size == 0:
+                await self._skip_trailer()
+            while chunk_size > 0:
+                data = await self._read(min(piece_size, chunk_size))
+                chunk_size -= len(data)
+                if chunk_size == 0:
+                    # 先读出下一块的长度, 最后一块时连同trailer一起读完
+                    await self._readline()
+                    chunk_size = int((await self._readline()).split(b";")[0], 16)
+                    if chunk_size == 0:
+                        await self._skip_trailer()
+                        self.complete = True
+                yield data
+        elif "content-length" in self.headers:
+            remaining = int(self.headers["content-length"])
+            while remaining > 0:
+                data = await self._read(min(piece_size, remaining))
+                remaining -= len(data)
+                if remaining == 0:
+                    self.complete = True
+                yield data
+        else:
+            # 没有长度的响应以连接关闭结束
+            self.keep_alive = False
+            while True:
+                data = await asyncio.wait_for(self.connection.reader.read(piece_size), READ_TIMEOUT)
+                if not data:
+                    break
+                yield data
+        self.complete = True
+
+class _OriginPool:
+    """一个源的keep-alive连接和连接数限制, 只在事件循环中使用"""
+    def __init__(self, url: str):
+        parsed_url = urlparse(url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        self.ssl_context = _create_ssl_context() if parsed_url.scheme == "https" else None
+        self.semaphore = asyncio.Semaphore(DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN)
+        self._idle = []
+
+    async def _connect(self, fresh: bool = False):
+        """返回(connection, 是否复用); fresh为True时总是新建连接"""
+        while self._idle and not fresh:
+            connection = self._idle.pop()
+            if connection.usable():
+                return connection, True
+            connection.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl_context), CONNECT_TIMEOUT)
+        return _Connection(reader, writer), False
+
+    async def get(self, url: str, headers: dict, start: int, end: int, fresh: bool = False):
+        """发送range请求并读取响应头"""
+        request = _build_request(url, headers, start, end)
+        while True:
+            connection, reused = await self._connect(fresh)
+            try:
+                connection.writer.write(request)
+                await connection.writer.drain()
+                return await _read_response_head(connection)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection.close()
+                if not reused:
+                    raise
+                # 空闲的keep-alive连接可能已经被源站关闭, 换一个连接重新发送
+            except BaseException:
+                connection.close()
+                raise
+
+    def release(self, response: _Response):
+        connection = response.connection
+        if response.complete and response.keep_alive and connection.usable() and len(self._idle) < DOWNLOADER_POOL_SIZE:
+            self._idle.append(connection)
+        else:
+            connection.close()
+
+class _H2Response:
+    """HTTP/2连接上的一个流, 与_Response的用法相同"""
+    def __init__(self, connection, stream_id: int):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.status_code = None
+        self.reason = ""
+        self.headers = {}
+        self.complete = False
+        self.received = asyncio.Event()  # 收到响应头 / the response head arrived
+        self._queue = asyncio.Queue()
+        self._unacknowledged = 0  # 已收到但还没读取的字节, 读取后才归还流量控制窗口 / flow-controlled bytes not read yet
+
+    def on_headers(self, headers: list):
+        for key, value in headers:
+            key = key.decode("iso-8859-1")
+            if key == ":status":
+                self.status_code = int(value)
+            else:
+                self.headers[key] = value.decode("iso-8859-1")
+        self.received.set()
+
+    def on_data(self, data: bytes, flow_controlled_length: int):
+        self._unacknowledged += flow_controlled_length
+        self._queue.put_nowait((data, flow_controlled_length))
+
+    def on_end(self, error: Exception | None = None):
+        self._queue.put_nowait((error, 0))
+        self.received.set()
+
+    async def iter_content(self, piece_size: int):
+        while True:
+            data, flow_controlled_length = await asyncio.wait_for(self._queue.get(), READ_TIMEOUT)
+            if data is None:
+                break
+            if isinstance(data, Exception):
+                raise data
+            # 数据被读走之后才扩大窗口, 停下来的流不会让源站继续发送
+            self._unacknowledged -= flow_controlled_length
+            self.connection.acknowledge(self.stream_id, flow_controlled_length)
+            yield data
+        self.complete = True
+
+    def cancel(self):
+        """响应体没有读完时重置流, 并归还它占用的连接窗口"""
+        self.connection.reset(self.stream_id, self._unacknowledged)
+        self._unacknowledged = 0
+
+class _H2Connection:
+    """一个HTTP/2连接, 后台任务读取帧并分发给各个流"""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self.streams = {}  # stream_id -> _H2Response
+        self.closed = False
+        self._read_task = None
+
+    async def start(self):
+        self.conn.initiate_connection()
+        self.conn.update_settings({
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: DOWNLOADER_HTTP2_WINDOW_SIZE,
+        })
+        # 连接窗口要容纳所有流的窗口, 否则一个停下来的流会挡住其他流
+        connection_window = min(2 ** 31 - 1, DOWNLOADER_HTTP2_WINDOW_SIZE * DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN)
+        self.conn.increment_flow_control_window(connection_window - self.conn.inbound_flow_control_window)
+        await self.flush()
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    def usable(self):
+        return not self.closed and not self.writer.is_closing()
+
+    def has_capacity(self):
+        max_streams = min(self.conn.remote_settings.max_concurrent_streams, _H2_MAX_STREAMS)
+        return self.usable() and self.conn.open_outbound_streams < max_streams
+
+    async def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    def _flush_nowait(self):
+        data = self.conn.data_to_send()
+        if data and not self.writer.is_closing():
+            self.writer.write(data)
+
+    async def request(self, headers: list):
+        stream_id = self.conn.get_next_available_stream_id()
+        response = _H2Response(self, stream_id)
+        self.streams[stream_id] = response
+        self.conn.send_headers(stream_id, headers, end_stream=True)
+        try:
+            await self.flush()
+            await asyncio.wait_for(response.received.wait(), READ_TIMEOUT)
+        except BaseException:
+            response.cancel()
+            raise
+        if response.status_code is None:
+            # 流在响应头之前就结束了
+            self.streams.pop(stream_id, None)
+            raise ConnectionError(f"HTTP/2 stream {stream_id} closed before the response")
+        return response
+
+    def acknowledge(self, stream_id: int, length: int):
+        if self.closed or length == 0:
+            return
+        # 流已经关闭时只归还连接窗口 / only the connection window is returned once the stream is closed
+        self.conn.acknowledge_received_data(length, stream_id)
+        self._flush_nowait()
+
+    def reset(self, stream_id: int, unacknowledged: int):
+        self.streams.pop(stream_id, None)
+        if self.closed:
+            return
+        try:
+            self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+        except h2.exceptions.ProtocolError:
+            pass  # 流已经结束 / the stream already ended
+        if unacknowledged:
+            self.conn.acknowledge_received_data(unacknowledged, stream_id)
+        self._flush_nowait()
+
+    async def _read_loop(self):
+        error = ConnectionError("HTTP/2 connection closed")
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                for event in self.conn.receive_data(data):
+                    stream = self.streams.get(getattr(event, "stream_id", None))
+                    if isinstance(event, h2.events.ResponseReceived) and stream is not None:
+                        stream.on_headers(event.headers)
+                    elif isinstance(event, h2.events.DataReceived):
+                        if stream is not None:
+                            stream.on_data(event.data, event.flow_controlled_length)
+                        else:
+                            # 已经重置的流上还在路上的数据 / data in flight on a stream we reset
+                            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded) and stream is not None:
+                        self.streams.pop(event.stream_id, None)
+                        stream.on_end()
+                    elif isinstance(event, h2.events.StreamReset) and stream is not None:
+                        self.streams.pop(event.stream_id, None)
+                        stream.on_end(ConnectionError(f"HTTP/2 stream reset: {event.error_code}"))
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        # 源站不再接受新的流, 已经开始的流可以继续 / no new streams, open ones may still finish
+                        self.closed = True
+                        error = ConnectionError(f"HTTP/2 connection terminated: {event.error_code}")
+                await self.flush()
+        except Exception as e:
+            error = e
+        finally:
+            self.closed = True
+            for stream in list(self.streams.values()):
+                stream.on_end(error)
+            self.streams.clear()
+            self.writer.close()
+
+    def close(self):
+        self.closed = True
+        if self._read_task is not None:
+            self._read_task.cancel()
+        self.writer.close()
+
+class _H2OriginPool:
+    """
+    一个源的少数几个HTTP/2连接, 请求作为流分配到最空闲的连接上, 只在事件循环中使用.
+    TLS协商没有选中h2的源退回HTTP/1.1连接池.
+    """
+    def __init__(self, url: str):
+        parsed_url = urlparse(url)
+        self.url = url
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        self.ssl_context = None
+        if parsed_url.scheme == "https":
+            self.ssl_context = _create_ssl_context()
+            self.ssl_context.set_alpn_protocols(["h2", "http/1.1"])
+        self.semaphore = asyncio.Semaphore(DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN)
+        self.fallback = None  # 不支持HTTP/2时使用的_OriginPool / the _OriginPool used when the origin lacks HTTP/2
+        self._connections = []
+        self._connecting = 0
+        self._changed = asyncio.Condition()
+
+    async def _connect(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port, ssl=self.ssl_context), CONNECT_TIMEOUT)
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object is not None and ssl_object.selected_alpn_protocol() != "h2":
+            writer.close()
+            if self.fallback is None:
+                log(f"{get_origin(self.url)} does not speak HTTP/2, using HTTP/1.1")
+                self.fallback = _OriginPool(self.url)
+            return None
+        connection = _H2Connection(reader, writer)
+        await connection.start()
+        return connection
+
+    async def _acquire(self, fresh: bool):
+        """选择承载新流的连接; fresh为True时总是新建连接, 用完后多出的连接会被关闭"""
+        async with self._changed:
+            while True:
+                self._connections = [connection for connection in self._connections if connection.usable()]
+                available = [connection for connection in self._connections if connection.has_capacity()]
+                if available and not fresh:
+                    return min(available, key=lambda connection: len(connection.streams)), True
+                if fresh or len(self._connections) + self._connecting < DOWNLOADER_HTTP2_CONNECTIONS:
+                    break
+                await self._changed.wait()
+            self._connecting += 1
+        try:
+            connection = await self._connect()
+        finally:
+            async with self._changed:
+                self._connecting -= 1
+                self._changed.notify_all()
+        if connection is not None:
+            async with self._changed:
+                self._connections.append(connection)
+                self._changed.notify_all()
+        return connection, False
+
+    async def get(self, url: str, headers: dict, start: int, end: int, fresh: bool = False):
+        """以流的形式发送range请求并读取响应头"""
+        parsed_url = urlparse(url)
+        request_headers = [
+            (":method", "GET"),
+            (":scheme", parsed_url.scheme),
+            (":authority", headers.get("Host") or parsed_url.netloc),
+            (":path", (parsed_url.path or "/") + ("?" + parsed_url.query if parsed_url.query else "")),
+        ] + [(k.lower(), v) for k, v in _request_fields(headers, start, end)]
+        while True:
+            if self.fallback is not None:
+                return await self.fallback.get(url, headers, start, end, fresh)
+            connection, reused = await self._acquire(fresh)
+            if connection is None:
+                continue  # 退回了HTTP/1.1
+            try:
+                return await connection.request(request_headers)
+            except (ConnectionError, h2.exceptions.ProtocolError):
+                # 复用的连接可能刚被源站关闭 (GOAWAY), 在新连接上重新发送
+                if not reused:
+                    raise
+                fresh = True
+
+    def release(self, response):
+        if isinstance(response, _Response):
+            self.fallback.release(response)
+            return
+        if not response.complete:
+            response.cancel()
+        connection = response.connection
+        if not connection.streams and len(self._connections) > DOWNLOADER_HTTP2_CONNECTIONS:
+            # 对冲时新建的连接空闲后关闭 / connections opened for hedging are closed once idle
+            self._connections.remove(connection)
+            connection.close()
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+def _get_pool(url: str):
+    global _connections
+    if _connections is None:
+        _connections = asyncio.Semaphore(DOWNLOADER_ASYNC_MAX_CONNECTIONS)
+    origin = get_origin(url)
+    pool = _pools.get(origin)
+    if pool is None:
+        http2 = DOWNLOADER_ENGINE == "http2" and (url.startswith("https://") or origin in DOWNLOADER_HTTP2_PRIOR_KNOWLEDGE)
+        if http2 and h2 is None:
+            logger.error("The http2 engine needs the h2 package, using HTTP/1.1")
+            http2 = False
+        pool = _H2OriginPool(url) if http2 else _OriginPool(url)
+        _pools[origin] = pool
+        log(f"Created async {'HTTP/2' if http2 else 'connection'} pool for {origin}")
+    return pool
+
+async def _read_response_head(connection: _Connection):
+    status_line = await asyncio.wait_for(connection.reader.readline(), READ_TIMEOUT)
+    if not status_line:
+        raise ConnectionError("Connection closed before the response")
+    version, status_code, *reason = status_line.decode("iso-8859-1").rstrip("\r\n").split(" ", 2)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(connection.reader.readline(), READ_TIMEOUT)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("iso-8859-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    return _Response(connection, int(status_code), reason[0] if reason else "", headers, keep_alive)
+
+async def _request_range(url: str, source: str, headers: dict, start: int, end: int, fresh: bool = False):
+    """向source发送range请求并跟随重定向, 返回 (最终地址的连接池, 响应)"""
+    target = source
+    for _ in range(MAX_REDIRECTS + 1):
+        pool = _get_pool(target)
+        response = await pool.get(target, source_headers(url, target, headers), start, end, fresh)
+        location = response.headers.get("location")
+        if response.status_code not in REDIRECT_STATUS or location is None:
+            return pool, response
+        pool.release(response)
+        target = urljoin(target, location)
+    raise ConnectionError(f"Exceeded {MAX_REDIRECTS} redirects for {source}")
+
+async def _download(url: str, headers: dict, schedule: list, lock: threading.Condition, window: DownloadWindow, spool_path: str | None, sources: list | None, progress_task):
+    """在事件循环中下载调度表里未完成的区间, 失败时抛出异常"""
+    loop = asyncio.get_running_loop()
+    mirrors = MirrorSelector(sources or [url])
+    exceptions = []
+    max_retries = 3  # 最大重试次数
+    finished = asyncio.Event()
+    range_checked = False
+    single_stream = False  # 某个区间重试耗尽后不再并行, 由一个worker用一个range请求顺序下载剩下的部分
+    stream_busy = False
+    hedging = False  # 同一时间只有一个空闲worker负责对冲 / only one idle worker hedges at a time
+    spool_fd = os.open(spool_path, os.O_WRONLY) if spool_path is not None else None
+
+    def fail(e: Exception):
+        """调用者需持有锁"""
+        exceptions.append(e)
+        finished.set()
+        lock.notify_all()
+
+    def persist_state():
+        """写盘模式下记录已完成的区间, 供中断后续传; 调用者需持有锁"""
+        if spool_path is None:
+            return
+        try:
+            save_spool_state(spool_path, _completed_intervals(schedule))
+        except OSError as e:
+            logger.error(f"保存下载进度失败: {str(e)}")
+
+    def complete(schedule_item: dict):
+        """调用者需持有锁"""
+        schedule_item["downloaded"] = True
+        schedule_item["finished_at"] = time.time()
+        persist_state()
+        if all(item["downloaded"] for item in schedule):
+            finished.set()
+        lock.notify_all()
+
+    async def hedge_chunk(schedule_item: dict):
+        """在新连接上重新请求落后区间接下来的一小段, 先收完的一方生效, 区间剩下的部分重新放回调度表"""
+        with lock:
+            start, end = _split_for_hedge(schedule, schedule_item)
+        # 切出来的后半段由新的worker下载 / a new worker fetches the part split off
+        workers.append(asyncio.ensure_future(worker(f"AsyncDownloader-{len(workers)}")))
+        log(f"分片 {schedule_item['chunk_id']} 落后, 在新连接上对冲请求 ({(end - start + 1)/1024:.0f}KB)")
+        pieces = []
+        received = 0
+        source = mirrors.acquire()
+        pool = _get_pool(source)
+        request_started = time.time()
+        try:
+            async with _connections, pool.semaphore:
+                response_pool, response = await _request_range(url, source, headers, start, end, fresh=True)
+                try:
+                    if response.status_code != 206:
+                        raise ConnectionError(f"HTTP {response.status_code} {response.reason}")
+                    async for data in response.iter_content(DOWNLOADER_PIECE_SIZE):
+                        pieces.append(data)
+                        received += len(data)
+                        with lock:
+                            if schedule_item["downloaded"] or exceptions:
+                                return  # 原来的请求先完成了
+                finally:
+                    response_pool.release(response)
+        except Exception as e:
+            mirrors.report_failure(source)
+            record_failure(source)
+            logger.error(f"分片 {schedule_item['chunk_id']} 对冲请求失败: {str(e)}")
+            return
+        finally:
+            mirrors.release(source, received, time.time() - request_started)
+        record_success(source)
+
+        with lock:
+            if exceptions:
+                return
+            stored = _store_hedge(schedule_item, start, pieces, window, spool_fd)
+            if stored:
+                progress_bar.update(progress_task, stored)
+                complete(schedule_item)
+
+    async def download_chunk(schedule_item: dict, follow: bool = False):
+        """
+        下载一个区间, 窗口已满时让出区间并等待客户端跟上.
+        失败的区间记下重试时间后让出, worker先去下载其他区间.
+        follow为True时 (单连接模式) 区间下载完后用同一个请求继续下载后面相邻的未分配区间.
+        """
+        nonlocal single_stream, range_checked
+        resume = asyncio.Event()
+        wake = lambda: loop.call_soon_threadsafe(resume.set)
+        streamed = 0  # 本次调用收到的字节数 / bytes received by this call
+        source = None
+        try:
+            window.check()
+            with lock:
+                if schedule_item["downloaded"]:
+                    return  # 对冲请求先完成了
+                start = schedule_item["start"] + schedule_item["received"]
+                # 单连接模式下请求到文件末尾, 遇到别人的区间时再断开
+                end = schedule[-1]["end"] if follow else schedule_item["end"]
+            parked = False
+            source = mirrors.acquire()
+            pool = _get_pool(source)
+            request_started = time.time()
+            request_streamed = streamed
+            try:
+                async with _connections, pool.semaphore:
+                    response_pool, response = await _request_range(url, source, headers, start, end)
+                    try:
+                        if response.status_code == 200 and start != 0:
+                            record_range_support(source, False)
+                        elif response.status_code == 206 and not range_checked:
+                            range_checked = True
+                            record_range_support(source, True)
+                        if response.status_code != 206 and not (response.status_code == 200 and start == 0):
+                            raise ConnectionError(f"HTTP {response.status_code} {response.reason}")
+
+                        # 区间的后半段可能随时被其他worker窃取, 所以每次都按最新的end截断
+                        async for data in response.iter_content(DOWNLOADER_PIECE_SIZE):
+                            with lock:
+                                if exceptions or schedule_item["downloaded"]:
+                                    return
+                                while data:
+                                    chunk_size = schedule_item["end"] - schedule_item["start"] + 1
+                                    piece = data[:chunk_size - schedule_item["received"]]
+                                    data = data[len(piece):]
+                                    _store_piece(schedule_item, piece, window, spool_fd)
+                                    streamed += len(piece)
+                                    progress_bar.update(progress_task, len(piece))
+                                    if schedule_item["received"] < chunk_size or not follow:
+                                        break
+
+                                    # 单连接模式下接着下载相邻的区间, 剩下的数据属于它
+                                    complete(schedule_item)
+                                    owner = schedule_item["owner"]
+                                    schedule_item = _next_in_run(schedule, schedule_item)
+                                    if schedule_item is None:
+                                        return
+                                    _assign(schedule_item, owner)
+
+                                lock.notify_all()
+                                if schedule_item["received"] >= schedule_item["end"] - schedule_item["start"] + 1:
+                                    break
+
+                                # 窗口已满时让出区间, 等客户端跟上后再继续
+                                if window.park_item(schedule_item, wake):
+                                    schedule_item["owner"] = None
+                                    parked = True
+                                    break
+                    finally:
+                        response_pool.release(response)
+            finally:
+                mirrors.release(source, streamed - request_streamed, time.time() - request_started)
+
+            if parked:
+                await resume.wait()
+                return
+
+            with lock:
+                if schedule_item["downloaded"]:
+                    return
+                chunk_size = schedule_item["end"] - schedule_item["start"] + 1
+                if schedule_item["received"] != chunk_size:
+                    raise Exception(f"分片大小不匹配: {schedule_item['received']}!= {chunk_size} for {schedule_item['chunk_id']}")
+                complete(schedule_item)
+            record_success(source)
+            return
+
+        except DownloadAborted as e:
+            with lock:
+                fail(e)
+            return
+
+        except Exception as e:
+            if source is not None:
+                mirrors.report_failure(source)
+                record_failure(source)
+            with lock:
+                if follow and streamed > 0:
+                    schedule_item["retries"] = 0  # 单连接模式下只要有进展就重新计数
+                schedule_item["retries"] += 1
+                if schedule_item["retries"] > max_retries:
+                    if not follow:
+                        # 并行下载该区间一直失败, 退回单连接模式由一个worker继续
+                        logger.error(f"分片 {schedule_item['chunk_id']} 下载失败: {str(e)}, 退回单连接下载")
+                        single_stream = True
+                        schedule_item["retries"] = 0
+                        schedule_item["owner"] = None
+                        return
+                    fail(e)
+                    logger.error(f"分片 {schedule_item['chunk_id']} 下载失败: {str(e)}")
+                    return
+                # 指数退避重试, 从已收到的位置继续
+                schedule_item["owner"] = None
+                schedule_item["retry_at"] = time.time() + _retry_delay(schedule_item["retries"])
+
+    async def worker(name: str):
+        """不断领取区间下载, 没有可领取的区间时对冲落后的区间或者结束"""
+        nonlocal stream_busy, hedging
+        while True:
+            straggler = None
+            hedge = False
+            with lock:
+                if exceptions or finished.is_set():
+                    return
+                if window.closed:
+                    # 最后一个区间可能已经收完数据, 只是还没标记完成
+                    if _has_unassigned_range(schedule):
+                        fail(DownloadAborted("Download window closed"))
+                    return
+                follow = single_stream or all(is_open(source) for source in mirrors.urls)
+                if follow and stream_busy:
+                    return  # 单连接模式下只保留一个worker
+                generation = window.generation
+                schedule_item = _pick_range(schedule, window, steal=not follow)
+                retry_wait = _retry_wait(schedule, time.time()) if schedule_item is None else None
+                if schedule_item is None and not _has_unassigned_range(schedule):
+                    if hedging:
+                        return
+                    straggler, hedge_wait = _pick_straggler(schedule, time.time())
+                    if straggler is None and hedge_wait is None:
+                        return
+                    hedging = hedge = True
+                if schedule_item is not None:
+                    _assign(schedule_item, name)
+                    stream_busy = follow
+
+            if hedge:
+                try:
+                    if straggler is not None:
+                        await hedge_chunk(straggler)
+                    else:
+                        # 等到可能出现落后区间的时候再检查
+                        try:
+                            await asyncio.wait_for(finished.wait(), hedge_wait)
+                        except asyncio.TimeoutError:
+                            pass
+                finally:
+                    with lock:
+                        hedging = False
+                continue
+
+            if retry_wait is not None:
+                # 剩下的区间在等待重试
+                await asyncio.sleep(retry_wait)
+                continue
+
+            if schedule_item is None:
+                # 剩下的区间都在窗口之外, 等客户端跟上
+                resume = asyncio.Event()
+                window.park(lambda: loop.call_soon_threadsafe(resume.set), generation)
+                await resume.wait()
+                continue
+
+            try:
+                await download_chunk(schedule_item, follow)
+            finally:
+                if follow:
+                    with lock:
+                        stream_busy = False
+
+    with lock:
+        if all(schedule_item["downloaded"] for schedule_item in schedule):
+            finished.set()
+
+    # 与线程引擎相同, 并发数参考各个源以往的表现
+    concurrency = min(DOWNLOADER_MAX_THREADS, sum(get_concurrency(source) for source in mirrors.urls), len(schedule))
+    workers = [asyncio.ensure_future(worker(f"AsyncDownloader-{i}")) for i in range(concurrency)]
+    try:
+        await finished.wait()
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        if spool_fd is not None:
+            os.close(spool_fd)
+    if exceptions:
+        raise exceptions[0]
+
+def download_file_with_schedule_async(url: str, headers: dict, file_size: int, schedule: list, lock: threading.Condition, window: DownloadWindow, spool_path: str | None = None, sources: list | None = None, cache_name: str | None = None, response_headers: dict | None = None):
+    """
+    与downloader.download_file_with_schedule的约定相同, 但分片由共享的事件循环下载.
+    给定spool_path时各分片直接写入对象的分段存储, 对象完整后 (cache_name不为None) 发送端结束后原子地移入缓存.
+    """
+    progress_task = progress_bar.create_task(f"downloading {url}", total=file_size)
+    spool_saved = False
+
+    try:
+        log(f"开始异步下载 (总大小: {file_size/1024/1024:.2f}MB)")
+
+        with lock:
+            resumed = sum(schedule_item["received"] for schedule_item in schedule)
+        progress_bar.update(progress_task, resumed)
+
+        asyncio.run_coroutine_threadsafe(_download(url, headers, schedule, lock, window, spool_path, sources, progress_task), _get_loop()).result()
+
+        if spool_path is None:
+            log("下载完成")
+            return
+
+        if cache_name is None:
+            # 对象还不完整, 下载的区间留在分段存储里 (见finally)
+            log("下载完成并已保存到分段存储")
+            return
+
+        # 发送端可能还在读这个文件, 等它关闭后再移动
+        window.wait_closed()
+        spool_saved = True
+        if save_spool_to_cache(CacheType.WEB_FILE, cache_name, spool_path, response_headers):
+            log("下载完成并已缓存")
+        return
+
+    except Exception as e:
+        logger.error(f"下载失败: {str(e)}")
+        traceback.print_exc()
+    finally:
+        progress_bar.remove_task(progress_task)
+        if spool_path is not None and not spool_saved:
+            _keep_partial_spool(spool_path, schedule, lock)
@@ -1,26 +1,65 @@
+import atexit
 import hashlib
+import json
 from pathlib import Path
 import threading
 import time
 import traceback
 import shutil
+import uuid
 
-from filelock import FileLock
+from filelock import FileLock, Timeout
 
 from configs import *
 import configs
 from utils import log
+from revalidation_handler import freshness_lifetime, same_validators
 from enum import Enum
 
 # cache structure:
 #
 # .cache/{cache_key}/.meta
-# {id in hex} {file type id} {file name} {last hit timestamp} {size in bytes}
+# {id in hex} {file type id} {file name} {last hit timestamp} {size in bytes} {sha256}
 #
-# .cache/{cache_key}/{file id in hex}
+# .cache/{cache_key}/{file id in hex}  指向blob的硬链接 / hard link to the blob
+# .cache/{cache_key}/{file id in hex}.headers  源站的响应头 (JSON), 命中时原样返回; 修改时间是最近一次向源站验证的时间
+#                                               the origin's response headers (JSON), replayed on a hit; its mtime is when the origin last confirmed them
+#
+# .cache/.blobs/{sha256}  按内容寻址的文件, 内容相同的缓存项共用一份 / content-addressed files shared by identical entries
+# .cache/.blobs/{sha1}.sha1
+# {sha256}  Maven只给出sha1时用它找到blob / finds the blob when Maven only gives the sha1
+#
+# .cache/.spool/{cache_key}.part  对象的分段存储, 与对象一样大, 下载的区间写在原来的偏移处 / segment store of an object,
+#                                  as large as the object, downloaded ranges sit at their own offsets
+# .cache/.spool/{cache_key}.part.state
+# {start} {end}  已经下载的区间, 对任意区间的请求只下载其中没有的部分 / present ranges, requests for any range only fetch the gaps
+# .cache/.spool/{cache_key}.part.headers  源站的响应头 (JSON) / the origin's response headers (JSON)
+#
+# .cache/.vary/{url key}  资源最近保存的响应头里的Vary, 请求到达时据此选择参与缓存键的请求头 (见cache_key_handler)
+#                         the Vary of the resource's latest stored response, picks the keyed request headers when a request arrives
+#
+# .cache/.journal  只追加的命中日志, 清理时并入.meta / append-only hit journal, folded into the .meta files when cleaning
+# {cache_key} {file id in hex} {last hit timestamp}
+#
+# 查找只访问内存中的索引, 命中时间批量写入日志, 不再每次加锁重写.meta; 其他代理进程加入的文件在未命中时从.meta读取
+# Lookups only touch the in-memory index and hit times are journaled in batches instead of rewriting .meta under a lock;
+# files added by other proxy processes are read from their .meta on a miss
 
 # cache init
 Path(CACHE_DIR).mkdir(exist_ok=True)
+SPOOL_DIR = CACHE_DIR + "/.spool"
+BLOB_DIR = CACHE_DIR + "/.blobs"
+VARY_DIR = CACHE_DIR + "/.vary"
+JOURNAL_FILE = CACHE_DIR + "/.journal"
+
+_index = None  # (类型, 名称) -> 元数据, 第一次查找时加载 / (type, name) -> meta entry, loaded on the first lookup
+_index_lock = threading.Lock()
+_pending_hits = {}  # (cache_key, id) -> 还没写入日志的命中时间 / hit times not journaled yet
+
+_spool_segments = {}  # 临时文件 -> 本次下载开始前已有的区间 / spool file -> ranges present before this download
+_usage = 0  # 缓存目录实际占用的字节数, 硬链接只算一次 / bytes the cache directory uses, hard links counted once
+_usage_lock = threading.Lock()
+_evict_wakeup = threading.Event()
 
 class CacheType(Enum):
     WEB_FILE = 1
@@ -29,14 +68,16 @@ class CacheType(Enum):
 def _parse_cache_meta_line(line: str):
     """解析元数据行"""
     line_parts = line.strip().split('\t')
-    if len(line_parts) != 5:
+    if len(line_parts) not in (5, 6):
         raise ValueError("Invalid meta data line")
     return {
         'id': line_parts[0],
         'type': CacheType(int(line_parts[1])),
         'name': line_parts[2],
         'last_hit': float(line_parts[3]),
-        'size': int(line_parts[4])
+        'size': int(line_parts[4]),
+        # 旧版本的元数据没有哈希 / entries written by older versions have no hash
+        'sha256': line_parts[5] if len(line_parts) == 6 and line_parts[5] else None
     }
 
 def _parse_cache_meta(meta_str: str):
@@ -50,7 +91,7 @@ def _parse_cache_meta(meta_str: str):
 
 def _save_cache_meta(meta: list):
     """保存元数据"""
-    return '\n'.join(f"{m['id']}\t{m['type'].value}\t{m['name']}\t{m['last_hit']}\t{m['size']}" for m in meta)
+    return '\n'.join(f"{m['id']}\t{m['type'].value}\t{m['name']}\t{m['last_hit']}\t{m['size']}\t{m.get('sha256') or ''}" for m in meta)
 
 def _get_available_cache_id(meta: list):
     """获取可用缓存ID"""
@@ -64,32 +105,217 @@ def _get_cache_key(type: CacheType, name: str):
     """生成缓存键"""
     return hashlib.sha256((type.name + "#" + name).encode('utf-8')).hexdigest()
 
-def _check_disk_space():
-    """检查磁盘空间是否充足"""
-    if not Path(CACHE_DIR).exists():
-        return True
-    used = sum(f.stat().st_size for f in Path(CACHE_DIR).glob('*') if f.is_file())
-    return used < DISK_CACHE_MAX_SIZE
-    
+def _log_name(name: str):
+    """日志中的缓存名只保留url, 参与缓存键的请求头可能带有凭据"""
+    return name.split("#{", 1)[0]
 
-def save_to_cache(type: CacheType, name: str, data: bytes):
-    """保存数据到缓存系统"""
-    if (not configs.with_cache) and type == CacheType.WEB_FILE:
-        return False
+def _hash_file(path: str):
+    """顺序读一遍文件, 返回 (sha256, sha1)"""
+    sha256 = hashlib.sha256()
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(1024 * 1024)
+            if not block:
+                break
+            sha256.update(block)
+            sha1.update(block)
+    return sha256.hexdigest(), sha1.hexdigest()
 
-    data_size = len(data)
-    if data_size > DISK_CACHE_MAX_FILE_SIZE:
-        log(f"Jummping cache for file {name}: too large ({data_size / 1024 / 1024:.2f} MB)")
-        return False
-    
-    if data_size < DISK_CACHE_MIN_FILE_SIZE and type == CacheType.WEB_FILE:
-        log(f"Jummping cache for file {name}: too small ({data_size / 1024 / 1024:.2f} MB)")
-        return False
-    
-    if not _check_disk_space():
-        log(f"Jummping cache for file {name}: no space left")
+def _store_blob(path: str, sha256: str, sha1: str, cache_file: str):
+    """
+    把path的内容放进blob仓库并链接为cache_file, path随后不再存在.
+    内容相同的blob已经存在时直接链接, 不再占用磁盘; 文件系统不支持硬链接时退回复制.
+    """
+    Path(BLOB_DIR).mkdir(exist_ok=True)
+    blob = BLOB_DIR + "/" + sha256
+    try:
+        os.link(blob, cache_file)
+        _remove_accounted(path)
+        log(f"Deduplicated cache file {cache_file} against blob {sha256}")
+        return
+    except FileNotFoundError:
+        pass  # 新内容 / new content
+    except OSError:
+        pass  # 不支持硬链接, 下面会复制 / no hard links, copied below
+
+    os.replace(path, blob)
+    with open(BLOB_DIR + "/" + sha1 + ".sha1", 'w') as f:
+        f.write(sha256)
+    try:
+        os.link(blob, cache_file)
+    except OSError:
+        shutil.copyfile(blob, cache_file)
+        _account(os.path.getsize(cache_file))
+
+def get_blob_path(sha256: str | None = None, sha1: str | None = None):
+    """按哈希查找缓存中的文件, 不存在时返回None"""
+    if not configs.with_cache:
+        return None
+
+    try:
+        if sha256 is None and sha1 is not None:
+            with open(BLOB_DIR + "/" + sha1.lower() + ".sha1") as f:
+                sha256 = f.read().strip()
+        if sha256 is None:
+            return None
+        blob = BLOB_DIR + "/" + sha256.lower()
+        os.utime(blob)  # 按哈希命中也算使用, 见_clean_blob_dir / a hit by hash keeps the blob alive, see _clean_blob_dir
+        return blob
+    except (FileNotFoundError, ValueError):
+        return None
+    except OSError as e:
+        log(f"Failed to get blob {sha256 or sha1}: {e}")
+        return None
+
+def _read_meta_file(cache_key: str):
+    """在文件锁内读取一个缓存目录的元数据, 没有时返回空列表"""
+    meta_file = CACHE_DIR + "/" + cache_key + "/.meta"
+    if not Path(meta_file).exists():
+        return []
+    with FileLock(meta_file + ".lock").acquire(timeout=10):
+        with open(meta_file) as f:
+            return _parse_cache_meta(f.read())
+
+def _read_journal(truncate: bool = False):
+    """日志中每个缓存项最近的命中时间, (cache_key, id) -> last_hit; truncate为True时读完清空日志"""
+    hits = {}
+    if not Path(JOURNAL_FILE).exists():
+        return hits
+    with FileLock(JOURNAL_FILE + ".lock").acquire(timeout=10):
+        with open(JOURNAL_FILE) as f:
+            lines = f.read().split('\n')
+        if truncate:
+            open(JOURNAL_FILE, 'w').close()
+    for line in lines:
+        line_parts = line.strip().split('\t')
+        if len(line_parts) != 3:
+            continue  # 空行或者写了一半的行 / blank or torn lines
+        try:
+            key = (line_parts[0], line_parts[1])
+            hits[key] = max(hits.get(key, 0), float(line_parts[2]))
+        except ValueError:
+            continue
+    return hits
+
+def _index_entries(cache_key: str, meta: list):
+    """把一个缓存目录的元数据放进索引; 调用者需持有_index_lock"""
+    for m in meta:
+        _index[(m['type'], m['name'])] = dict(m, cache_key=cache_key)
+
+def _get_index():
+    """获取内存中的索引, 第一次调用时从各目录的.meta和日志加载"""
+    global _index
+    with _index_lock:
+        if _index is not None:
+            return _index
+        _index = {}
+        for cache_key in os.listdir(CACHE_DIR):
+            if not Path(CACHE_DIR + "/" + cache_key + "/.meta").exists():
+                continue  # .spool, .blobs, 主机能力记录等 / .spool, .blobs, host profiles, ...
+            try:
+                _index_entries(cache_key, _read_meta_file(cache_key))
+            except Exception as e:
+                log(f"Failed to load cache meta {cache_key}: {e}")
+        try:
+            hits = _read_journal()
+        except Exception as e:
+            log(f"Failed to load cache journal: {e}")
+            hits = {}
+        for m in _index.values():
+            m['last_hit'] = max(m['last_hit'], hits.get((m['cache_key'], m['id']), 0))
+        log(f"Loaded cache index: {len(_index)} entries")
+        return _index
+
+def _flush_hits():
+    """把攒下的命中时间追加到日志, 失败时留到下一次"""
+    with _index_lock:
+        if not _pending_hits:
+            return
+        hits = dict(_pending_hits)
+        _pending_hits.clear()
+    try:
+        with FileLock(JOURNAL_FILE + ".lock").acquire(timeout=10):
+            with open(JOURNAL_FILE, 'a') as f:
+                f.write(''.join(f"{cache_key}\t{cache_id}\t{last_hit}\n" for (cache_key, cache_id), last_hit in hits.items()))
+    except Exception as e:
+        log(f"Failed to write cache journal: {e}")
+        with _index_lock:
+            for key, last_hit in hits.items():
+                _pending_hits[key] = max(_pending_hits.get(key, 0), last_hit)
+
+def _flush_hits_periodically():
+    while True:
+        time.sleep(CACHE_JOURNAL_FLUSH_SECONDS)
+        _flush_hits()
+
+def _measure_cache():
+    """遍历缓存目录统计实际占用, 指向同一个blob的硬链接只算一次"""
+    seen = set()
+    used = 0
+    for root, _, file_names in os.walk(CACHE_DIR):
+        for file_name in file_names:
+            try:
+                stat = os.stat(root + "/" + file_name)
+            except OSError:
+                continue  # 刚被删除 / just removed
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                used += stat.st_size
+    return used
+
+def _account(size: int):
+    """缓存占用增加size字节 (可以为负), 超出上限时唤醒淘汰线程"""
+    global _usage
+    with _usage_lock:
+        _usage += size
+        over = _usage > DISK_CACHE_MAX_SIZE
+    if over:
+        _evict_wakeup.set()
+
+def _remove_accounted(path: str):
+    """删除文件, 它是数据的最后一个链接时从占用中减去"""
+    stat = os.stat(path)
+    os.remove(path)
+    if stat.st_nlink <= 1:
+        _account(-stat.st_size)
+
+def _remove_cache_file(cache_file: str):
+    """删除缓存文件和保存的响应头"""
+    if Path(cache_file).exists():
+        _remove_accounted(cache_file)
+    if Path(cache_file + ".headers").exists():
+        _remove_accounted(cache_file + ".headers")
+
+def _save_response_headers(path: str, response_headers: dict):
+    """原子地保存path旁边的响应头, 同时把验证时间更新为现在"""
+    headers_file = path + ".headers"
+    old_size = os.path.getsize(headers_file) if Path(headers_file).exists() else 0
+    with open(headers_file + ".tmp", 'w') as f:
+        json.dump(response_headers, f)
+    os.replace(headers_file + ".tmp", headers_file)
+    _account(os.path.getsize(headers_file) - old_size)
+
+def _load_response_headers(path: str):
+    """path旁边保存的 (响应头, 验证时间); 没有保存响应头时返回 ({}, 文件的修改时间)"""
+    try:
+        with open(path + ".headers") as f:
+            return json.load(f), os.fstat(f.fileno()).st_mtime
+    except FileNotFoundError:
+        return {}, os.path.getmtime(path)
+
+def _check_disk_space(size: int):
+    """缓存预算和磁盘上的空闲空间是否放得下size字节; 超出预算的部分由淘汰线程腾出"""
+    if size > DISK_CACHE_MAX_SIZE * DISK_CACHE_EVICT_TARGET:
         return False
-    
+    try:
+        return size < shutil.disk_usage(CACHE_DIR).free
+    except OSError:
+        return True
+
+
+def _add_cache_entry(type: CacheType, name: str, data_size: int, write_cache_file: callable, sha256: str | None = None):
+    """登记元数据并写入缓存文件"""
     cache_key = _get_cache_key(type, name)
     cache_dir = CACHE_DIR + "/" + cache_key
     Path(cache_dir).mkdir(exist_ok=True)
@@ -107,7 +333,7 @@ def save_to_cache(type: CacheType, name: str, data: bytes):
                 meta = _parse_cache_meta(f.read())
             for m in meta:
                 if m['name'] == name and m['type'] == type:
-                    log(f"Jummping cache for file {type.name}#{name}: already exist")
+                    log(f"Jummping cache for file {type.name}#{_log_name(name)}: already exist")
                     return False
             
             cache_id = _get_available_cache_id(meta)
@@ -116,79 +342,439 @@ def save_to_cache(type: CacheType, name: str, data: bytes):
                 'type': type,
                 'name': name,
                 'last_hit': time.time(),
-                'size': data_size
+                'size': data_size,
+                'sha256': sha256
             })
             with open(meta_file, 'w') as f:
                 f.write(_save_cache_meta(meta))
             
             cache_file = cache_dir + "/" + cache_id
-            with open(cache_file, 'wb') as f:
-                f.write(data)
+            write_cache_file(cache_file)
+            with _index_lock:
+                if _index is not None:
+                    _index_entries(cache_key, meta[-1:])
             return True
     except Exception as e:
         log(f"Failed to check cache: {e}")
         traceback.print_exc()
         return False
+
+def save_to_cache(type: CacheType, name: str, data: bytes):
+    """保存数据到缓存系统"""
+    if (not configs.with_cache) and type == CacheType.WEB_FILE:
+        return False
+
+    data_size = len(data)
+    if data_size > DISK_CACHE_MAX_FILE_SIZE:
+        log(f"Jummping cache for file {_log_name(name)}: too large ({data_size / 1024 / 1024:.2f} MB)")
+        return False
     
-def get_path_from_cache(type: CacheType, name: str):
-    """从缓存中获取数据路径"""
-    cache_key = _get_cache_key(type, name)
-    cache_dir = CACHE_DIR + "/" + cache_key
-    if not Path(cache_dir).exists():
-        return None
+    if data_size < DISK_CACHE_MIN_FILE_SIZE and type == CacheType.WEB_FILE:
+        log(f"Jummping cache for file {_log_name(name)}: too small ({data_size / 1024 / 1024:.2f} MB)")
+        return False
     
-    meta_file = CACHE_DIR + "/" + cache_key + "/.meta"
-    if not Path(meta_file).exists():
+    if not _check_disk_space(data_size):
+        log(f"Jummping cache for file {_log_name(name)}: no space left")
+        return False
+
+    sha256 = hashlib.sha256(data).hexdigest()
+    sha1 = hashlib.sha1(data).hexdigest()
+
+    def write_cache_file(cache_file: str):
+        Path(BLOB_DIR).mkdir(exist_ok=True)
+        tmp_path = BLOB_DIR + "/" + uuid.uuid4().hex + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        _account(data_size)
+        _store_blob(tmp_path, sha256, sha1, cache_file)
+
+    return _add_cache_entry(type, name, data_size, write_cache_file, sha256)
+
+_spool_locks = {}
+
+def _merge_intervals(intervals: list):
+    """合并重叠和相邻的闭区间"""
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def create_spool_file(size: int, name: str, response_headers: dict | None = None):
+    """
+    在缓存目录中打开对象的分段存储: 预分配为对象大小的临时文件, 供下载时按对象中的偏移写入; 不适合缓存时返回None.
+    与save_to_cache不同, 写盘的下载不受DISK_CACHE_MAX_FILE_SIZE限制.
+    文件名由缓存名决定, 之前对同一对象任意区间的下载留下的文件会被继续使用, 已有的区间见load_spool_state;
+    save_spool_state保存的区间会与这些区间合并. response_headers随文件保存, 见open_cached_segments.
+    """
+    if not configs.with_cache:
         return None
-    
-    locker = FileLock(meta_file + ".lock")
+
+    if size < DISK_CACHE_MIN_FILE_SIZE:
+        return None
+
+    Path(SPOOL_DIR).mkdir(exist_ok=True)
+    path = SPOOL_DIR + "/" + _get_cache_key(CacheType.WEB_FILE, name) + ".part"
+    locker = FileLock(path + ".lock")
     try:
-        with locker.acquire(timeout=10):
-            meta = None
-            with open(meta_file) as f:
-                meta = _parse_cache_meta(f.read())
-            for m in meta:
-                if m['name'] == name and m['type'] == type:
-                    cache_file = cache_dir + "/" + m['id']
-                    if not Path(cache_file).exists():
-                        raise ValueError("Cache file not found, but meta data exists")
-                    m['last_hit'] = time.time()
-                    with open(meta_file, 'w') as f:
-                        f.write(_save_cache_meta(meta))
-
-                    log(f"Cache hit for file {type.name}#{name}: {m['size'] / 1024 / 1024:.2f} MB")
-                    return cache_file
+        locker.acquire(timeout=0)
+    except Timeout:
+        # 同名文件正在被其他下载使用, 这次不续传
+        path = SPOOL_DIR + "/" + uuid.uuid4().hex + ".part"
+        locker = FileLock(path + ".lock")
+        locker.acquire()
+    _spool_locks[path] = locker
+
+    segments = load_spool_state(path)
+    # 源站的文件换了版本时之前的区间作废 / the segments are void once the origin has a new version of the file
+    if segments and response_headers is not None and Path(path + ".headers").exists():
+        try:
+            if same_validators(_load_response_headers(path)[0], response_headers) is False:
+                log(f"Origin has a new version of {_log_name(name)}, dropping its segments")
+                segments = []
+        except (OSError, ValueError):
+            segments = []
+    if response_headers is not None:
+        _save_response_headers(path, response_headers)
+
+    if Path(path).exists() and os.path.getsize(path) == size and segments:
+        log(f"Resuming spool file for {_log_name(name)}")
+        _spool_segments[path] = segments
+        return path
+
+    if not _check_disk_space(size):
+        log(f"Jummping cache for spool file: no space left")
+        remove_spool_file(path)
+        return None
+
+    # 先删除旧文件再新建, 正在从旧文件发送的请求 (见open_cached_segments) 不受影响
+    # the old file is unlinked rather than truncated, requests still sending from it keep their copy
+    if Path(path).exists():
+        _remove_accounted(path)
+    if Path(path + ".state").exists():
+        os.remove(path + ".state")
+    # 预分配的空间立即计入占用 / the preallocated space counts right away
+    _account(size)
+    with open(path, 'wb') as f:
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except (AttributeError, OSError):
+            # Windows或者不支持fallocate的文件系统
+            f.truncate(size)
+    return path
+
+def save_spool_to_cache(type: CacheType, name: str, path: str, response_headers: dict | None = None):
+    """
+    把下载完成的临时文件原子地移动到缓存中, 失败时删除临时文件.
+    分片是乱序到达的, 哈希在这里顺序读一遍刚写完的文件 (通常还在页缓存里) 时计算, 这时客户端已经收完数据.
+    给定response_headers时一起保存, 见get_cached_response.
+    """
+    def write_cache_file(cache_file: str):
+        # 响应头先于文件写入, 其他进程看到文件时响应头已经在了 / headers first, so other processes never see the file without them
+        if response_headers is not None:
+            _save_response_headers(cache_file, response_headers)
+        _store_blob(path, sha256, sha1, cache_file)
+
+    try:
+        sha256, sha1 = _hash_file(path)
+        return _add_cache_entry(type, name, os.path.getsize(path), write_cache_file, sha256)
+    finally:
+        remove_spool_file(path)
+
+def load_spool_state(path: str):
+    """读取临时文件中已经下载完成的区间, 相对文件开头的闭区间列表"""
+    try:
+        with open(path + ".state") as f:
+            lines = f.read().split('\n')
+        intervals = []
+        for line in lines:
+            if line.strip() == "":
+                continue
+            start, end = line.strip().split('\t')
+            intervals.append((int(start), int(end)))
+        return intervals
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError) as e:
+        log(f"Failed to load spool state {path}: {e}")
+        return []
+
+def save_spool_state(path: str, intervals: list):
+    """原子地保存已经下载完成的区间, 与下载开始前分段存储中已有的区间合并"""
+    intervals = _merge_intervals(_spool_segments.get(path, []) + intervals)
+    with open(path + ".state.tmp", 'w') as f:
+        f.write('\n'.join(f"{start}\t{end}" for start, end in intervals))
+    os.replace(path + ".state.tmp", path + ".state")
+
+def _release_spool_lock(path: str, remove: bool = False):
+    """释放临时文件的锁; remove为True时 (临时文件已删除) 连同锁文件一起删除"""
+    _spool_segments.pop(path, None)
+    locker = _spool_locks.pop(path, None)
+    if locker is not None:
+        locker.release()
+    if remove:
+        _remove_lock_file(path)
+
+def _remove_lock_file(path: str):
+    # 临时文件的锁只用timeout=0获取, 没有进程会在旧的锁文件上等待, 释放后可以直接删除
+    try:
+        os.remove(path + ".lock")
+    except OSError:
+        pass
+
+def close_spool_file(path: str, intervals: list):
+    """保留临时文件和已完成的区间, 供之后的请求使用"""
+    try:
+        save_spool_state(path, intervals)
+    except OSError as e:
+        log(f"Failed to save spool state {path}: {e}")
+    finally:
+        _release_spool_lock(path)
+
+def remove_spool_file(path: str):
+    """删除临时文件"""
+    try:
+        for file_path in [path, path + ".state", path + ".headers"]:
+            if Path(file_path).exists():
+                _remove_accounted(file_path)
+    except OSError as e:
+        log(f"Failed to remove spool file {path}: {e}")
+    finally:
+        _release_spool_lock(path, remove=True)
+
+def get_path_from_cache(type: CacheType, name: str):
+    """从缓存中获取数据路径; 只查内存中的索引, 命中时间攒起来批量写入日志"""
+    try:
+        index = _get_index()
+        with _index_lock:
+            m = index.get((type, name))
+        if m is None:
+            # 其他代理进程可能刚刚加入了这个文件 / another proxy process may have just added it
+            cache_key = _get_cache_key(type, name)
+            meta = _read_meta_file(cache_key)
+            with _index_lock:
+                _index_entries(cache_key, meta)
+                m = index.get((type, name))
+            if m is None:
+                return None
+
+        cache_file = CACHE_DIR + "/" + m['cache_key'] + "/" + m['id']
+        if not os.path.exists(cache_file):
+            # 被其他进程清理了 / cleaned by another process
+            with _index_lock:
+                index.pop((type, name), None)
             return None
+        now = time.time()
+        with _index_lock:
+            m['last_hit'] = now
+            _pending_hits[(m['cache_key'], m['id'])] = now
+
+        log(f"Cache hit for file {type.name}#{_log_name(name)}: {m['size'] / 1024 / 1024:.2f} MB")
+        return cache_file
     except Exception as e:
         log(f"Failed to get cache path: {e}")
         traceback.print_exc()
         return None
 
-def get_from_cache(type: CacheType, name: str):
-    """从缓存中获取数据"""
+def get_cached_response(type: CacheType, name: str):
+    """
+    从缓存中获取 (数据路径, 保存的响应头, 验证时间), 没有时返回None; 保存时没有给出响应头的返回空字典.
+    与get_path_from_cache一样只查内存中的索引, 不读取数据, 由调用者直接从文件发送.
+    """
     if not configs.with_cache:
         return None
 
     path = get_path_from_cache(type, name)
     if path is None:
         return None
-    
-    locker = FileLock(path + ".lock")
     try:
-        with locker.acquire(timeout=10):
-            with open(path, 'rb') as f:
-                return f.read()
+        return (path,) + _load_response_headers(path)
+    except (OSError, ValueError) as e:
+        log(f"Failed to load cached headers of {path}: {e}")
+        return path, {}, 0
+
+def get_cached_vary(url: str):
+    """url的响应最近一次保存时的Vary, 没有时返回None"""
+    if not configs.with_cache:
+        return None
+    try:
+        with open(VARY_DIR + "/" + _get_cache_key(CacheType.WEB_FILE, url)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        log(f"Failed to load vary record of {url}: {e}")
+        return None
+
+def save_cached_vary(url: str, vary: str | None):
+    """记录url的响应的Vary, 没有Vary时删除记录; 内容不变时只刷新修改时间, 清理时按它判断是否还在使用"""
+    if not configs.with_cache:
+        return
+    path = VARY_DIR + "/" + _get_cache_key(CacheType.WEB_FILE, url)
+    try:
+        if not vary:
+            if Path(path).exists():
+                os.remove(path)
+            return
+        if get_cached_vary(url) == vary:
+            os.utime(path)
+            return
+        Path(VARY_DIR).mkdir(exist_ok=True)
+        with open(path + ".tmp", 'w') as f:
+            f.write(vary)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        log(f"Failed to save vary record of {url}: {e}")
+
+def refresh_cached_response(path: str, response_headers: dict):
+    """源站确认缓存的文件 (或者分段存储) 仍然有效后, 保存更新的响应头并刷新验证时间"""
+    try:
+        _save_response_headers(path, response_headers)
+    except OSError as e:
+        log(f"Failed to refresh cached headers of {path}: {e}")
+
+def remove_from_cache(type: CacheType, name: str):
+    """删除已经过时的缓存项"""
+    index = _get_index()
+    with _index_lock:
+        m = index.get((type, name))
+    if m is None:
+        return
+    try:
+        _evict_entry(m)
+        log(f"Removed outdated cache file {type.name}#{_log_name(name)}")
     except Exception as e:
-        log(f"Failed to get cache: {e}")
-        traceback.print_exc()
+        log(f"Failed to remove cache file {type.name}#{_log_name(name)}: {e}")
+
+def discard_segments(name: str):
+    """删除已经过时的分段存储, 正在下载的除外"""
+    path = SPOOL_DIR + "/" + _get_cache_key(CacheType.WEB_FILE, name) + ".part"
+    try:
+        if Path(path).exists() and _remove_idle_spool(path):
+            log(f"Removed outdated segments of {_log_name(name)}")
+    except OSError as e:
+        log(f"Failed to remove segments of {_log_name(name)}: {e}")
+
+def open_cached_segments(name: str):
+    """
+    打开对象的分段存储用于发送, 返回 (文件, 保存的响应头, 验证时间, 已有的区间); 没有时返回None, 调用者用完后需要关闭文件.
+    不加锁, 正在下载其他区间的请求可以同时写入: 已有的区间不会再被写, 分段存储重建时旧文件先被删除,
+    所以读完区间后文件仍是打开的那一个, 读到的区间就属于它.
+    """
+    if not configs.with_cache:
         return None
 
+    path = SPOOL_DIR + "/" + _get_cache_key(CacheType.WEB_FILE, name) + ".part"
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+    try:
+        with open(path + ".headers") as headers_file:
+            response_headers = json.load(headers_file)
+            validated_at = os.fstat(headers_file.fileno()).st_mtime
+        intervals = load_spool_state(path)
+        if intervals and os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+            os.utime(path)  # 最近使用时间, 见_evict / the last use, see _evict
+            return f, response_headers, validated_at, intervals
+    except (OSError, ValueError):
+        pass
+    f.close()
+    return None
+
+def _remove_idle_spool(path: str):
+    """删除没有下载在使用的分段存储, 返回是否删除了"""
+    locker = FileLock(path + ".lock")
+    try:
+        locker.acquire(timeout=0)
+    except Timeout:
+        return False  # 正在下载
+    try:
+        for file_path in [path, path + ".state", path + ".headers"]:
+            if Path(file_path).exists():
+                _remove_accounted(file_path)
+    finally:
+        locker.release()
+    _remove_lock_file(path)
+    return True
+
+def _clean_spool_dir(now: float):
+    """清理长时间没有继续的临时文件"""
+    for file_name in os.listdir(SPOOL_DIR):
+        path = SPOOL_DIR + "/" + file_name
+        try:
+            if not file_name.endswith(".part"):
+                # 状态文件和锁文件跟随临时文件清理
+                if not Path(SPOOL_DIR + "/" + file_name.split(".")[0] + ".part").exists() and os.path.getmtime(path) + CACHE_EXPIRE_SECONDS < now:
+                    os.remove(path)
+                continue
+
+            if os.path.getmtime(path) + CACHE_EXPIRE_SECONDS >= now:
+                continue
+            if _remove_idle_spool(path):
+                log(f"Cleaned spool file {path}")
+        except OSError as e:
+            log(f"Failed to clean spool file {path}: {e}")
+
+def _clean_blob_dir(now: float):
+    """清理已经没有缓存项链接的blob, 以及指向不存在的blob的sha1索引"""
+    for file_name in os.listdir(BLOB_DIR):
+        path = BLOB_DIR + "/" + file_name
+        try:
+            if file_name.endswith(".sha1"):
+                with open(path) as f:
+                    if not Path(BLOB_DIR + "/" + f.read().strip()).exists():
+                        os.remove(path)
+                continue
+
+            # 缓存项都过期后只剩blob自己这一个链接, 最近按哈希命中过的保留
+            stat = os.stat(path)
+            if stat.st_nlink <= 1 and stat.st_mtime + CACHE_EXPIRE_SECONDS < now:
+                _remove_accounted(path)
+                log(f"Cleaned blob {path}")
+        except OSError as e:
+            log(f"Failed to clean blob {path}: {e}")
+
+def _clean_vary_dir(now: float):
+    """清理长时间没有再保存过的Vary"""
+    for file_name in os.listdir(VARY_DIR):
+        path = VARY_DIR + "/" + file_name
+        try:
+            if os.path.getmtime(path) + CACHE_EXPIRE_SECONDS < now:
+                os.remove(path)
+        except OSError as e:
+            log(f"Failed to clean vary record {path}: {e}")
+
+def _kept_until_evicted(m: dict):
+    # 缓存名以url开头, 见cache_key_handler / cache names start with the url, see cache_key_handler
+    return m['type'] == CacheType.WEB_FILE and freshness_lifetime(m['name'].split("#", 1)[0]) is None
+
 def _clean_cache():
     """定期清理过期缓存"""
     while True:
         now = time.time()
         log("Cleaning cache...")
+        # 所有进程的命中时间先并入.meta再判断过期 / the hits of every process are folded into .meta before expiring
+        _flush_hits()
+        try:
+            hits = _read_journal(truncate=True)
+        except Exception as e:
+            log(f"Failed to read cache journal: {e}")
+            hits = {}
         for cache_key in os.listdir(CACHE_DIR):
+            if CACHE_DIR + "/" + cache_key == SPOOL_DIR:
+                _clean_spool_dir(now)
+                continue
+            if CACHE_DIR + "/" + cache_key == BLOB_DIR:
+                continue  # 在缓存项之后清理 / cleaned after the entries
+            if CACHE_DIR + "/" + cache_key == VARY_DIR:
+                _clean_vary_dir(now)
+                continue
+            if not Path(CACHE_DIR + "/" + cache_key).is_dir():
+                continue  # 例如主机能力记录 / e.g. the host profiles
+
             meta_file = CACHE_DIR + "/" + cache_key + "/.meta"
             if not Path(meta_file).exists():
                 shutil.rmtree(CACHE_DIR + "/" + cache_key, ignore_errors=True) # ignore errors
@@ -200,14 +786,21 @@ def _clean_cache():
                     meta = None
                     with open(meta_file) as f:
                         meta = _parse_cache_meta(f.read())
+                    for m in meta:
+                        m['last_hit'] = max(m['last_hit'], hits.get((cache_key, m['id']), 0))
 
-                    expired_ids = [m['id'] for m in meta if m['last_hit'] + CACHE_EXPIRE_SECONDS < now]
-                    for expired_id in expired_ids:
-                        cache_file = CACHE_DIR + "/" + cache_key + "/" + expired_id
+                    # 永不过时的文件 (例如发布版本的制品) 不按空闲时间清理, 磁盘不够时由_evict按最近使用淘汰
+                    # files that never go stale (e.g. release artifacts) are not expired for idling, _evict drops them when space runs out
+                    expired = [m for m in meta if m['last_hit'] + CACHE_EXPIRE_SECONDS < now and not _kept_until_evicted(m)]
+                    for expired_m in expired:
+                        cache_file = CACHE_DIR + "/" + cache_key + "/" + expired_m['id']
                         if Path(cache_file).exists():
-                            os.remove(cache_file) # ignore errors
                             log(f"Cleaned cache file {cache_file}")
-                        meta = [m for m in meta if m['id'] != expired_id]
+                        _remove_cache_file(cache_file) # ignore errors
+                        meta = [m for m in meta if m['id'] != expired_m['id']]
+                        with _index_lock:
+                            if _index is not None:
+                                _index.pop((expired_m['type'], expired_m['name']), None)
 
                     if len(meta) == 0:
                         os.remove(meta_file) # ignore errors
@@ -219,8 +812,112 @@ def _clean_cache():
             except Exception as e:
                 log(f"Failed to clean cache: {e}")
                 traceback.print_exc()
+        if Path(BLOB_DIR).exists():
+            _clean_blob_dir(now)
+        # 其他进程写入和删除的文件不在增量统计里, 借这次遍历重新校准 / other processes' writes are not tracked incrementally
+        _set_usage(_measure_cache())
         log("Cleaning cache done")
         time.sleep(CACHE_EXPIRE_SECONDS)  # 每24小时清理一次
 
+def _set_usage(used: int):
+    global _usage
+    with _usage_lock:
+        _usage = used
+    if used > DISK_CACHE_MAX_SIZE:
+        _evict_wakeup.set()
+
+def _evict_entry(m: dict):
+    """删除一个缓存项: 从.meta和索引中去掉, 删除缓存文件, 没有其他缓存项链接的blob随之删除"""
+    cache_dir = CACHE_DIR + "/" + m['cache_key']
+    meta_file = cache_dir + "/.meta"
+    if Path(meta_file).exists():
+        with FileLock(meta_file + ".lock").acquire(timeout=10):
+            with open(meta_file) as f:
+                meta = [x for x in _parse_cache_meta(f.read()) if x['id'] != m['id']]
+            _remove_cache_file(cache_dir + "/" + m['id'])
+            if meta:
+                with open(meta_file, 'w') as f:
+                    f.write(_save_cache_meta(meta))
+            else:
+                os.remove(meta_file)
+                shutil.rmtree(cache_dir, ignore_errors=True)
+    with _index_lock:
+        if _index is not None:
+            _index.pop((m['type'], m['name']), None)
+    if m['sha256'] is not None:
+        blob = BLOB_DIR + "/" + m['sha256']
+        if Path(blob).exists() and os.stat(blob).st_nlink <= 1:
+            _remove_accounted(blob)
+
+def _evict():
+    """
+    缓存超出DISK_CACHE_MAX_SIZE时按最近使用时间淘汰缓存项, 只靠哈希查找保留的blob和分段存储, 直到降到DISK_CACHE_EVICT_TARGET.
+    正在下载的分段存储计入占用但不会被淘汰.
+    """
+    if _usage <= DISK_CACHE_MAX_SIZE:
+        return
+    # 其他进程的命中也算使用 / hits in other processes count too
+    _flush_hits()
+    hits = _read_journal()
+    index = _get_index()
+    with _index_lock:
+        entries = list(index.values())
+    candidates = [(max(m['last_hit'], hits.get((m['cache_key'], m['id']), 0)), m) for m in entries]
+    if Path(BLOB_DIR).exists():
+        for file_name in os.listdir(BLOB_DIR):
+            if file_name.endswith(".sha1") or file_name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(BLOB_DIR + "/" + file_name)
+            except OSError:
+                continue
+            if stat.st_nlink <= 1:
+                candidates.append((stat.st_mtime, BLOB_DIR + "/" + file_name))
+    if Path(SPOOL_DIR).exists():
+        for file_name in os.listdir(SPOOL_DIR):
+            if not file_name.endswith(".part"):
+                continue
+            try:
+                candidates.append((os.path.getmtime(SPOOL_DIR + "/" + file_name), SPOOL_DIR + "/" + file_name))
+            except OSError:
+                continue
+    candidates.sort(key=lambda candidate: candidate[0])
+
+    target = DISK_CACHE_MAX_SIZE * DISK_CACHE_EVICT_TARGET
+    evicted = 0
+    for _, candidate in candidates:
+        if _usage <= target:
+            break
+        try:
+            if isinstance(candidate, str) and candidate.endswith(".part"):
+                if not _remove_idle_spool(candidate):
+                    continue
+            elif isinstance(candidate, str):
+                _remove_accounted(candidate)
+            else:
+                _evict_entry(candidate)
+            evicted += 1
+        except Exception as e:
+            log(f"Failed to evict {candidate if isinstance(candidate, str) else candidate['name']}: {e}")
+    log(f"Evicted {evicted} least recently used cache files, {_usage / 1024 / 1024:.2f} MB in use")
+
+def _evict_periodically():
+    """持续把缓存保持在上限以内, 不必等到每天的过期清理"""
+    _set_usage(_measure_cache())
+    log(f"Disk cache uses {_usage / 1024 / 1024:.2f} MB of {DISK_CACHE_MAX_SIZE / 1024 / 1024:.2f} MB")
+    while True:
+        try:
+            _evict()
+        except Exception as e:
+            log(f"Failed to evict cache: {e}")
+            traceback.print_exc()
+        _evict_wakeup.wait(DISK_CACHE_EVICT_INTERVAL)
+        _evict_wakeup.clear()
+
 # 启动清理线程
-threading.Thread(target=_clean_cache, daemon=True).start()
\ No newline at end of file
+threading.Thread(target=_clean_cache, daemon=True).start()
+# 定期以及退出时写入命中日志
+threading.Thread(target=_flush_hits_periodically, daemon=True).start()
+# 启动淘汰线程
+threading.Thread(target=_evict_periodically, daemon=True).start()
+atexit.register(_flush_hits)
\ No newline at end of file
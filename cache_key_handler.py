@@ -0,0 +1,66 @@
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from configs import *
+from utils import match_prefix
+from cache_handler import get_cached_vary, save_cached_vary
+
+# 缓存键: 同一个制品的请求不论User-Agent如何变化都落到同一个缓存项上, 但凭据 (CACHE_KEY_CREDENTIAL_HEADERS) 总是参与缓存键,
+# 带认证下载的文件不会返回给其他客户端. 此外只有这个资源的响应Vary中列出的请求头参与缓存键 (去掉 CACHE_KEY_IGNORED_HEADERS),
+# CACHE_KEY_RULES 可以按url前缀指定请求头并去掉签名参数.
+# Vary随资源的响应头一起保存 (见record_vary), 请求到达时不访问源站就能算出缓存名. 缓存项, 分段存储和进行中的下载都用这个名字查找.
+# Cache keys: requests for one artifact land on the same entry whatever their User-Agent, but the credentials (CACHE_KEY_CREDENTIAL_HEADERS)
+# are always keyed so a file fetched with auth is never served to other clients. Apart from those only the request headers the resource's
+# response lists in Vary are keyed (minus CACHE_KEY_IGNORED_HEADERS), CACHE_KEY_RULES
+# picks the headers and strips signature parameters per url prefix. The Vary is stored along with the resource's response headers
+# (see record_vary), so the name is known without asking the origin. Cache entries, segment stores and in-flight downloads all use this name
+
+def _get_rule(url: str):
+    prefix = match_prefix(url, CACHE_KEY_RULES)
+    return CACHE_KEY_RULES[prefix] if prefix is not None else {}
+
+def _strip_query(url: str, params: list):
+    """去掉url中的指定查询参数, 其余参数保持原来的顺序"""
+    parts = urlsplit(url)
+    if not parts.query:
+        return url
+    names = {param.lower() for param in params}
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k.lower() not in names]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+def _resource_url(url: str, rule: dict):
+    if rule.get("strip_query"):
+        return _strip_query(url, rule["strip_query"])
+    return url
+
+def _response_vary(response_headers: dict):
+    for k, v in response_headers.items():
+        if k.lower() == "vary":
+            return v
+    return None
+
+def _key_headers(rule: dict, vary: str | None):
+    """参与缓存键的请求头 (小写), None表示全部 (Vary: *)"""
+    credentials = {name.lower() for name in CACHE_KEY_CREDENTIAL_HEADERS}
+    if rule.get("headers") is not None:
+        return {name.lower() for name in rule["headers"]} | credentials
+    names = {name.strip().lower() for name in (vary or "").split(",") if name.strip()}
+    if "*" in names:
+        return None
+    return names - {name.lower() for name in CACHE_KEY_IGNORED_HEADERS} | credentials
+
+def response_cache_name(url: str, headers: dict, response_headers: dict | None = None):
+    """
+    整个文件的缓存名, 由请求决定而与Range和文件大小无关.
+    给出源站的响应头时按其中的Vary选择请求头, 否则按这个资源保存的Vary, 请求到达时不访问源站就能查找.
+    Maven / Gradle的制品发布后不会改变, 同一个请求对应同一份内容.
+    """
+    rule = _get_rule(url)
+    url = _resource_url(url, rule)
+    vary = _response_vary(response_headers) if response_headers is not None else get_cached_vary(url)
+    names = _key_headers(rule, vary)
+    selected = {k.lower(): v for k, v in headers.items() if k.lower() != "range" and (names is None or k.lower() in names)}
+    return url + "#" + str(dict(sorted(selected.items())))
+
+def record_vary(url: str, response_headers: dict):
+    """保存资源的响应里的Vary, 之后的请求按它计算缓存名"""
+    save_cached_vary(_resource_url(url, _get_rule(url)), _response_vary(response_headers))
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from urllib.parse import urlparse
+
+from configs import *
+import configs
+from utils import log, logger
+from session_pool import get_session
+from cache_handler import get_blob_path
+
+# 制品校验和: Maven仓库的.sha256/.sha1文件和Gradle的verification-metadata.xml在下载前就给出了文件的哈希,
+# 用它在按内容寻址的缓存中找到从其他仓库或其他构建下载过的同一个文件
+# Artifact checksums: Maven .sha256/.sha1 sidecars and Gradle's verification-metadata.xml give the hash before the download,
+# which finds the same file fetched from another repository or by another build in the content-addressed cache
+
+_SIDECAR_TIMEOUT = 5
+_SIDECAR_MAX_SIZE = 1024
+_SIDECAR_MEMO_SIZE = 4096  # 记住的校验和文件查询结果数, 超过时丢掉最久没用的 / remembered sidecar lookups, the least recently used go first
+
+_HASH_LENGTHS = {"sha256": 64, "sha1": 40}
+
+_metadata_lock = threading.Lock()
+_metadata_mtimes = {}  # 文件 -> 读取时的修改时间 / file -> modification time when it was read
+_metadata_index = {}  # 制品文件名 -> [(仓库中的相对路径, 哈希)] / artifact file name -> [(path in the repository, hashes)]
+
+_sidecar_memo = OrderedDict()  # url -> (查询时间, 哈希), 按最近使用排序 / url -> (lookup time, hashes), least recently used first
+_sidecar_memo_lock = threading.Lock()
+
+def _is_artifact(url: str):
+    path = urlparse(url).path
+    return any(path.endswith(extension) for extension in CHECKSUM_ARTIFACT_EXTENSIONS)
+
+def _parse_hash(value: str | None, algorithm: str):
+    """校验和文件可能在哈希后面带上文件名, 只取第一个字段"""
+    if not value or not value.split():
+        return None
+    value = value.split()[0].lower()
+    if len(value) != _HASH_LENGTHS[algorithm] or any(c not in "0123456789abcdef" for c in value):
+        return None
+    return value
+
+def _load_verification_metadata(path: str):
+    """
+    解析verification-metadata.xml:
+    <component group="g" name="n" version="v"><artifact name="n-v.jar"><sha256 value="..."/></artifact></component>
+    """
+    index = {}
+    for component in ElementTree.parse(path).getroot().iter():
+        if not component.tag.endswith("component"):
+            continue
+        group = component.get("group", "").replace(".", "/")
+        prefix = f"{group}/{component.get('name')}/{component.get('version')}/"
+        for artifact in component:
+            if not artifact.tag.endswith("artifact"):
+                continue
+            hashes = {}
+            for checksum in artifact:
+                algorithm = checksum.tag.split("}")[-1]
+                if algorithm in _HASH_LENGTHS:
+                    hashes[algorithm] = _parse_hash(checksum.get("value"), algorithm)
+            if any(hashes.values()):
+                index.setdefault(artifact.get("name"), []).append((prefix + artifact.get("name"), hashes))
+    return index
+
+def _get_metadata_index():
+    """配置的verification-metadata.xml被修改后重新读取"""
+    with _metadata_lock:
+        mtimes = {}
+        for path in GRADLE_VERIFICATION_METADATA_FILES:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                pass
+        if mtimes != _metadata_mtimes:
+            index = {}
+            for path in mtimes:
+                try:
+                    for name, artifacts in _load_verification_metadata(path).items():
+                        index.setdefault(name, []).extend(artifacts)
+                except Exception as e:
+                    logger.error(f"Failed to load verification metadata {path}: {e}")
+            _metadata_index.clear()
+            _metadata_index.update(index)
+            _metadata_mtimes.clear()
+            _metadata_mtimes.update(mtimes)
+        return _metadata_index
+
+def _hashes_from_metadata(url: str):
+    path = urlparse(url).path
+    for artifact_path, hashes in _get_metadata_index().get(path.split("/")[-1], []):
+        if path.endswith("/" + artifact_path):
+            return hashes
+    return None
+
+def _fetch_sidecar(url: str, headers: dict, algorithm: str):
+    """下载url旁边的校验和文件, 没有时返回None"""
+    request_headers = {k: v for k, v in headers.items() if k.lower() not in ("range", "if-range")}
+    try:
+        with get_session(url).get(url + "." + algorithm, allow_redirects=True, timeout=_SIDECAR_TIMEOUT, headers=request_headers, proxies=DOWNLOADER_PROXIES, stream=True) as r:
+            if r.status_code != 200:
+                return None
+            return _parse_hash(r.raw.read(_SIDECAR_MAX_SIZE, decode_content=True).decode("utf-8", "replace"), algorithm)
+    except Exception as e:
+        logger.error(f"Failed to fetch checksum of {url}: {e}")
+        return None
+
+def _hashes_from_sidecars(url: str, headers: dict):
+    with _sidecar_memo_lock:
+        memo = _sidecar_memo.get(url)
+        if memo is not None and time.time() - memo[0] < CACHE_EXPIRE_SECONDS:
+            _sidecar_memo.move_to_end(url)
+            return memo[1]
+    hashes = {"sha256": _fetch_sidecar(url, headers, "sha256")}
+    if hashes["sha256"] is None:
+        hashes["sha1"] = _fetch_sidecar(url, headers, "sha1")
+    if "-SNAPSHOT" not in url:  # 快照会被重新发布 / snapshots get republished
+        with _sidecar_memo_lock:
+            _sidecar_memo[url] = (time.time(), hashes)
+            _sidecar_memo.move_to_end(url)
+            while len(_sidecar_memo) > _SIDECAR_MEMO_SIZE:
+                _sidecar_memo.popitem(last=False)
+    return hashes
+
+def find_cached_artifact(url: str, headers: dict, fetch_sidecars: bool = False):
+    """
+    按制品的哈希在缓存中查找相同内容的文件, 找不到时返回None.
+    verification-metadata.xml里有的哈希不用访问网络; 没有时fetch_sidecars为True才下载体积很小的.sha256/.sha1文件,
+    调用者在确认源站可用并且文件足够大之后才这样做.
+    """
+    if not configs.with_cache or not _is_artifact(url):
+        return None
+
+    hashes = _hashes_from_metadata(url)
+    source = "verification metadata"
+    if hashes is None:
+        if not fetch_sidecars:
+            return None
+        hashes = _hashes_from_sidecars(url, headers)
+        source = "checksum file"
+
+    path = get_blob_path(hashes.get("sha256"), hashes.get("sha1"))
+    if path is not None:
+        log(f"Found {url} in the cache by its {source}")
+    return path
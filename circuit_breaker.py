@@ -0,0 +1,41 @@
+import threading
+import time
+
+from configs import *
+from utils import log
+from session_pool import get_origin
+
+# 每个源的熔断器: 连续失败的请求达到 DOWNLOADER_BREAKER_THRESHOLD 次时打开,
+# 打开期间新的请求直接透传, 进行中的下载退回单连接; DOWNLOADER_BREAKER_COOLDOWN 秒后重新尝试, 成功一次即关闭
+# Per-origin circuit breaker: it opens after DOWNLOADER_BREAKER_THRESHOLD consecutive failed requests.
+# While open, new requests pass through and running downloads drop to one connection; after DOWNLOADER_BREAKER_COOLDOWN
+# seconds requests are tried again and one success closes it
+
+_breakers = {}  # 源 -> {"failures", "opened_at"} / origin -> {"failures", "opened_at"}
+_breakers_lock = threading.Lock()
+
+def record_failure(url: str):
+    """一次请求失败, 返回熔断器是否打开"""
+    origin = get_origin(url)
+    with _breakers_lock:
+        breaker = _breakers.setdefault(origin, {"failures": 0, "opened_at": None})
+        breaker["failures"] += 1
+        if breaker["failures"] >= DOWNLOADER_BREAKER_THRESHOLD:
+            if breaker["opened_at"] is None or time.time() - breaker["opened_at"] >= DOWNLOADER_BREAKER_COOLDOWN:
+                log(f"Circuit breaker for {origin} opened after {breaker['failures']} consecutive failures")
+            breaker["opened_at"] = time.time()
+            return True
+        return False
+
+def record_success(url: str):
+    origin = get_origin(url)
+    with _breakers_lock:
+        breaker = _breakers.pop(origin, None)
+    if breaker is not None and breaker["opened_at"] is not None:
+        log(f"Circuit breaker for {origin} closed")
+
+def is_open(url: str):
+    """源的熔断器是否打开; 冷却时间过后返回False, 让请求重新尝试"""
+    with _breakers_lock:
+        breaker = _breakers.get(get_origin(url))
+        return breaker is not None and breaker["opened_at"] is not None and time.time() - breaker["opened_at"] < DOWNLOADER_BREAKER_COOLDOWN
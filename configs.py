@@ -13,11 +13,43 @@ CRL_SERVER_PORT = 27580  # CRL分发服务器端口 没事别瞎改 要不然你
 ALWAYS_APPEND_DOMAIN_NAMES = ["*.honkaiimpact3.com", "hoyoverse.com", "*.hoyoverse.com"] # 证书强制附加域名 / Force append domain names to certificate
 
 # 下载器阈值 / Downloader thresholds
-DOWNLOADER_MAX_THREADS = 32
+DOWNLOADER_MAX_THREADS = 32  # 单个下载的最大并发数 / Maximum concurrency of a single download
 DOWNLOADER_MULTIPART_THRESHOLD = 1 * 1024 * 1024  # 1MB
 DOWNLOADER_PROXIES = {"http": None, "https": None} # deprecated
 DOWNLOADER_TRUST_ENV = False # deprecated
-DOWNLOADER_MAX_CHUNK_SIZE = 512 * 1024  # 0.5MB
+DOWNLOADER_MAX_CHUNK_SIZE = 512 * 1024  # 0.5MB, deprecated
+DOWNLOADER_MIN_SPLIT_SIZE = 256 * 1024  # 工作窃取时区间切分的最小粒度 / Minimum range size produced by work-stealing splits
+DOWNLOADER_PIECE_SIZE = 64 * 1024  # 分片流式读取的块大小 / Read size when streaming a range
+DOWNLOADER_STREAM_TO_CLIENT = True  # 边下载边把当前分片转发给客户端 / Forward the chunk at the send cursor while it downloads
+DOWNLOADER_WINDOW_SIZE = 64 * 1024 * 1024  # 单个下载已下载未发送的字节上限, 0为不限制 / Per-download budget of downloaded-but-unsent bytes, 0 for unlimited
+DOWNLOADER_GLOBAL_WINDOW_SIZE = 512 * 1024 * 1024  # 所有下载合计的上限, 0为不限制 / Budget across all downloads, 0 for unlimited
+DOWNLOADER_GLOBAL_MAX_THREADS = 64  # 所有下载共享的线程数 / Worker threads shared by all downloads
+DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN = 32  # 每个源同时使用的连接数上限 / Maximum simultaneous connections per origin
+DOWNLOADER_SCHEDULER_TIMESLICE = 2  # 有其他下载排队时, 一个任务最多连续运行的秒数 / Seconds a task may run while other downloads are queued
+DOWNLOADER_POOL_SIZE = DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN  # 每个源的keep-alive连接池大小 / Keep-alive connection pool size per origin
+DOWNLOADER_ENGINE = "thread"  # 下载引擎, "thread" 为线程池, "asyncio" 为单个事件循环, "http2" 在事件循环中复用HTTP/2连接 (需要h2) / Download engine: "thread" pool, a single "asyncio" event loop, or "http2" streams multiplexed on that loop (needs h2)
+DOWNLOADER_ASYNC_MAX_CONNECTIONS = 256  # asyncio引擎所有下载共享的连接数 / Connections shared by all downloads on the asyncio engine
+DOWNLOADER_HTTP2_CONNECTIONS = 2  # 每个源的HTTP/2连接数, 所有分片请求作为其上的流 / HTTP/2 connections per origin, every range request is a stream on them
+DOWNLOADER_HTTP2_WINDOW_SIZE = 16 * 1024 * 1024  # 每个流的流量控制窗口, 高带宽高延迟的链路需要更大的窗口 / Per-stream flow-control window, high bandwidth-delay links need larger windows
+DOWNLOADER_HTTP2_PRIOR_KNOWLEDGE = []  # 直接使用明文HTTP/2 (h2c) 的源, 例如 "http://127.0.0.1:8080" / Origins spoken to in cleartext HTTP/2 (h2c) with prior knowledge
+DOWNLOADER_PROBE = "range"  # 下载前探测文件大小的方式: "range" 发送小的range GET, 收到的数据作为第一个分片; "head" 发送HEAD / How files are probed: "range" sends a small ranged GET whose bytes become the first chunk, "head" sends HEAD
+DOWNLOADER_PROBE_SIZE = 64 * 1024  # range探测请求的字节数 / Bytes requested by the ranged probe
+DOWNLOADER_REDIRECT_CACHE_SECONDS = 5 * 60  # 解析出的重定向的缓存时间, 签名的CDN地址通常很快过期 / How long a resolved redirect is reused, signed CDN urls usually expire soon
+DOWNLOADER_HEDGE_FACTOR = 3  # 区间耗时超过已完成区间中位数的这个倍数时, 空闲的worker在新连接上对冲请求, 0为关闭 / Idle workers re-request a range on a fresh connection once it takes this many times the median range time, 0 to disable
+DOWNLOADER_HEDGE_MIN_DELAY = 2  # 区间至少运行这么多秒才会被对冲 / Never hedge a range that has run for less than this many seconds
+DOWNLOADER_RETRY_BASE_DELAY = 2  # 分片失败后的重试延迟为 base * 2^(n-1), 带随机抖动, 等待期间不占用线程 / A failed range is retried after base * 2^(n-1) seconds with jitter, without holding a thread
+DOWNLOADER_BREAKER_THRESHOLD = 5  # 一个源连续失败这么多次后熔断: 新请求透传, 进行中的下载退回单连接 / Consecutive failures that trip a host's breaker: new requests pass through, running downloads use one connection
+DOWNLOADER_BREAKER_COOLDOWN = 30  # 熔断后多少秒再尝试加速 / Seconds before a tripped host is accelerated again
+
+# 镜像组: 同一组里的URL前缀提供字节一致的文件, 大文件的分片可以同时从组内多个镜像下载
+# Mirror groups: URL prefixes in one group serve byte-identical files, chunks of a large file are fetched from all of them
+DOWNLOADER_MIRROR_GROUPS = [
+    # ["https://repo1.maven.org/maven2/", "https://repo.maven.apache.org/maven2/", "https://maven.aliyun.com/repository/central/"],
+]
+# 镜像改写: 匹配前缀的文件改为从对应的镜像下载, 客户端无感知 / Mirror rewrites: fetch matching files from the mirror instead, transparently to the client
+DOWNLOADER_MIRROR_REWRITES = {
+    # "https://repo1.maven.org/maven2/": "https://maven.aliyun.com/repository/central/",
+}
 
 # 代理地址 / Proxy URLs
 HTTP_PROXY = f"http://{PROXY_HOST}:{PROXY_PORT}"
@@ -31,9 +63,51 @@ GRADLE_PROPERTIES_PATH = os.path.join(GRADLE_USER_HOME, "gradle.properties")
 # 缓存配置 / Cache configuration
 CACHE_DIR = ".cache"  # Cache directory
 DISK_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024  # 10GB磁盘缓存 / 10GB disk cache max size
+DISK_CACHE_EVICT_TARGET = 0.9  # 超出上限后按最近使用时间淘汰到上限的这个比例 / Once over the limit, least recently used files are evicted down to this fraction of it
+DISK_CACHE_EVICT_INTERVAL = 10  # 后台检查缓存大小的间隔秒数, 写入使缓存超出上限时立即检查 / Seconds between background size checks, a write that crosses the limit triggers one at once
 DISK_CACHE_MIN_FILE_SIZE = 1024 * 1024  # 缓存区间起点 / Minimum file size to cache
-DISK_CACHE_MAX_FILE_SIZE = 256 * 1024 * 1024  # 缓存区间终点 / Maximum file size to cache
+DISK_CACHE_MAX_FILE_SIZE = 256 * 1024 * 1024  # 缓存区间终点, 边下载边写盘的文件不受此限制 / Maximum file size to cache in memory, downloads spooled to disk are not limited
 CACHE_EXPIRE_SECONDS = 24 * 60 * 60  # 缓存有效期 / Cache expiration time in seconds
+CACHE_JOURNAL_FLUSH_SECONDS = 30  # 缓存命中时间在内存中攒这么多秒后批量追加到日志 / Cache hit times are batched in memory this long before being appended to the journal
+CHECKSUM_ARTIFACT_EXTENSIONS = [".jar", ".aar", ".war", ".ear", ".zip", ".tgz", ".tar.gz"]  # 这些文件先按.sha256/.sha1校验和在缓存中查找相同内容 / These files are first looked up in the cache by their .sha256/.sha1 checksum
+GRADLE_VERIFICATION_METADATA_FILES = []  # Gradle的verification-metadata.xml, 其中的哈希不用访问网络 / Gradle verification-metadata.xml files, their hashes need no network access
+# 缓存键: 默认只有源站Vary中列出的请求头和凭据参与缓存键, User-Agent等变化不会导致重新下载
+# Cache keys: by default only the request headers named by the origin's Vary and the credentials are keyed, a new User-Agent is still a hit
+CACHE_KEY_CREDENTIAL_HEADERS = ["Authorization", "Cookie"]  # 总是参与缓存键, 带凭据下载的文件不会返回给没有这个凭据的客户端 / Always keyed, a file fetched with credentials is never served to clients without them
+CACHE_KEY_IGNORED_HEADERS = ["Accept-Encoding", "User-Agent"]  # 即使出现在Vary中也不参与缓存键, 缓存的内容总是未压缩的 / Never keyed even when listed in Vary, the cached bytes are never encoded
+CACHE_KEY_SIGNED_QUERY_PARAMS = [  # 常见的签名url参数, 供CACHE_KEY_RULES引用 / Common signed-url parameters, for use in CACHE_KEY_RULES
+    "X-Amz-Algorithm", "X-Amz-Credential", "X-Amz-Date", "X-Amz-Expires", "X-Amz-SignedHeaders", "X-Amz-Signature", "X-Amz-Security-Token",
+    "X-Goog-Algorithm", "X-Goog-Credential", "X-Goog-Date", "X-Goog-Expires", "X-Goog-SignedHeaders", "X-Goog-Signature",
+    "Expires", "Signature", "Key-Pair-Id", "Policy", "sv", "se", "st", "sp", "sr", "sig", "token",
+]
+# 按url前缀的缓存键规则 (最长前缀优先): "headers" 指定参与缓存键的请求头, 代替Vary; "strip_query" 是不参与缓存键的查询参数
+# CACHE_KEY_CREDENTIAL_HEADERS 不论规则如何总是参与缓存键
+# Cache key rules per url prefix (longest wins): "headers" lists the keyed request headers instead of Vary, "strip_query" the query parameters left out.
+# CACHE_KEY_CREDENTIAL_HEADERS are keyed whatever the rule says
+CACHE_KEY_RULES = {
+    # "https://objects.githubusercontent.com/": {"strip_query": CACHE_KEY_SIGNED_QUERY_PARAMS},
+    # "https://maven.example.com/releases/": {"headers": ["Accept"]},
+}
+# 新鲜度: 缓存的文件在这段时间内直接返回, 之后用ETag / Last-Modified向源站确认, 304时不重新下载
+# Freshness: a cached file is served as is for this long, then confirmed with the origin by ETag / Last-Modified and a 304 keeps it without a download
+CACHE_FRESHNESS_RULES = {  # url的通配符模式 -> 秒数, None为永不过时, 第一个匹配的生效 / url glob -> seconds, None never goes stale, the first match wins
+    "*/maven-metadata.xml*": 5 * 60,
+    "*-SNAPSHOT*": 5 * 60,
+    # Maven仓库里发布的版本不会再改变 / released versions in a Maven repository never change
+    "*.jar": None,
+    "*.aar": None,
+    "*.pom": None,
+    "*.module": None,
+}
+CACHE_FRESHNESS_DEFAULT = 24 * 60 * 60  # 没有匹配的规则时 / When no rule matches
+
+# 主机能力记录 / Host capability profiles
+HOST_PROFILE_FILE = CACHE_DIR + "/.hosts.json"  # 记录各主机是否支持Range以及多线程是否更快 / Remembers range support and whether parallel fetching pays off per host
+HOST_PROFILE_EXPIRE_SECONDS = 7 * 24 * 60 * 60  # 记录过期后重新学习 / Profiles are relearned after this long
+HOST_PROFILE_MIN_SPEEDUP = 1.2  # 多线程吞吐不到单连接的这个倍数时不再加速 / Stop accelerating when parallel throughput is below this multiple of a single connection
+HOST_PROFILE_EXPLORE_INTERVAL = 10  # 不加速的源每隔这么多次下载仍然多线程下载一次, 重新测量 / Still accelerate every Nth download of a host that is not accelerated, to measure it again
+HOST_PROFILE_SAMPLE_MAX_AGE = 24 * 60 * 60  # 多线程吞吐的样本超过这么久时重新测量 / Measure again once the parallel throughput sample is this old
+HOST_PROFILE_MIN_SAMPLE_SIZE = 8 * 1024 * 1024  # 小于这个大小的下载不计入吞吐, 连接建立的开销占比太大 / Downloads smaller than this are not sampled, connection setup dominates them
 
 with_cache = False  # 是否使用缓存 / Whether to use cache
 def set_with_cache(value: bool):
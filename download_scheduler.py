@@ -0,0 +1,113 @@
+from collections import deque
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+from configs import *
+from utils import logger
+
+class DownloadScheduler:
+    """
+    所有下载共享的分片调度器.
+    全局最多 DOWNLOADER_GLOBAL_MAX_THREADS 个线程, 每个源最多 DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN 个连接.
+    任务按先进先出轮转, 有其他下载在排队时, 运行超过时间片的任务应当让出线程.
+
+    任务是一个无参函数, 返回True表示需要重新排队, 否则视为结束 (或者已经自行挂起, 之后会重新提交).
+    需要稍后重试的任务通过submit_later提交, 等待期间不占用worker线程.
+    """
+    def __init__(self, max_threads: int, max_connections_per_origin: int):
+        self._max_threads = max_threads
+        self._max_connections_per_origin = max_connections_per_origin
+        lock = threading.RLock()
+        self._condition = threading.Condition(lock)  # worker在上面等待任务 / workers wait on it for tasks
+        self._timer_condition = threading.Condition(lock)  # 只有计时线程在上面等待, submit的notify不会被它取走 / only the timer waits on it
+        self._queue = deque()  # (job_id, origin, task)
+        self._origin_connections = {}
+        self._threads = 0
+        self._idle = 0
+        self._job_ids = itertools.count()
+        self._delayed = []  # (到期时间, 序号, (job_id, origin, task)) 的堆 / heap of (due time, sequence, entry)
+        self._delayed_ids = itertools.count()
+        self._timer = None
+
+    def new_job_id(self):
+        return next(self._job_ids)
+
+    def submit(self, job_id: int, origin: str, task: callable):
+        """提交一个任务"""
+        spawn = False
+        with self._condition:
+            self._queue.append((job_id, origin, task))
+            if self._idle < len(self._queue) and self._threads < self._max_threads:
+                self._threads += 1
+                spawn = True
+            self._condition.notify()
+        if spawn:
+            # 在锁外启动线程, 否则其他worker取任务时会被阻塞
+            threading.Thread(target=self._worker_loop, daemon=True, name="Downloader").start()
+
+    def submit_later(self, job_id: int, origin: str, task: callable, delay: float):
+        """delay秒后提交一个任务"""
+        with self._condition:
+            heapq.heappush(self._delayed, (time.time() + delay, next(self._delayed_ids), (job_id, origin, task)))
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._timer_loop, daemon=True, name="DownloadScheduler-timer")
+                self._timer.start()
+            self._timer_condition.notify()
+
+    def _timer_loop(self):
+        """到期的延迟任务转入队列; 只有这一个线程在等待它们"""
+        while True:
+            with self._timer_condition:
+                while not self._delayed or self._delayed[0][0] > time.time():
+                    self._timer_condition.wait(self._delayed[0][0] - time.time() if self._delayed else None)
+                _, _, (job_id, origin, task) = heapq.heappop(self._delayed)
+            self.submit(job_id, origin, task)
+
+    def has_waiting(self, job_id: int):
+        """是否有其他下载的任务在排队并且可以运行"""
+        with self._condition:
+            return any(entry[0] != job_id and self._runnable(entry[1]) for entry in self._queue)
+
+    def _runnable(self, origin: str):
+        return self._origin_connections.get(origin, 0) < self._max_connections_per_origin
+
+    def _take(self):
+        """取出第一个所属源还有空闲连接的任务, 调用者需持有锁"""
+        for entry in self._queue:
+            if self._runnable(entry[1]):
+                self._queue.remove(entry)
+                return entry
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self._condition:
+                entry = self._take()
+                while entry is None:
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+                    entry = self._take()
+                job_id, origin, task = entry
+                self._origin_connections[origin] = self._origin_connections.get(origin, 0) + 1
+
+            requeue = False
+            try:
+                requeue = task()
+            except Exception as e:
+                logger.error(f"Download task failed: {e}")
+                traceback.print_exc()
+            finally:
+                with self._condition:
+                    self._origin_connections[origin] -= 1
+                    if self._origin_connections[origin] == 0:
+                        del self._origin_connections[origin]
+                    if requeue is True:
+                        self._queue.append(entry)
+                    self._condition.notify_all()
+
+# 全局调度器实例
+download_scheduler = DownloadScheduler(DOWNLOADER_GLOBAL_MAX_THREADS, DOWNLOADER_MAX_CONNECTIONS_PER_ORIGIN)
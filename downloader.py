@@ -1,6 +1,10 @@
+import bisect
+import itertools
+import mmap
 import multiprocessing
+import os
+import random
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import threading
 import traceback
 import time
@@ -9,130 +13,972 @@ import urllib3
 
 from configs import *
 from utils import log, progress_bar, logger
-from cache_handler import CacheType, get_from_cache, save_to_cache
+from cache_key_handler import response_cache_name
+from cache_handler import CacheType, close_spool_file, create_spool_file, load_spool_state, remove_spool_file, save_spool_state, save_spool_to_cache
+from download_scheduler import download_scheduler
+from session_pool import get_origin
+from host_profile import get_concurrency, record_download, record_range_support
+from mirror_handler import MirrorSelector
+from circuit_breaker import is_open, record_failure, record_success
+from range_transport import request_range
+
+class DownloadAborted(Exception):
+    """客户端已经断开, 下载被放弃 / The client went away and the download was abandoned"""
+    pass
+
+class DownloadWindow:
+    """
+    限制已下载但未发送给客户端的字节数.
+    单个下载只能抓取发送游标之后 DOWNLOADER_WINDOW_SIZE 以内的数据,
+    所有下载合计不超过 DOWNLOADER_GLOBAL_WINDOW_SIZE (游标所在的区间不受全局限制, 避免互相卡死).
+    直接写盘的下载不占内存, 不受窗口限制.
+
+    被窗口挡住的任务不占用调度器的线程, 而是挂起在这里, 游标前进足够多或者进入下一个区间时重新提交.
+    """
+    _condition = threading.Condition()
+    _global_buffered = 0
+    _global_parked = []
+
+    def __init__(self, l_range: int, bounded: bool = True):
+        self.cursor = l_range  # 最慢的客户端已接收到的位置 / offset the slowest client has received up to
+        self.buffered = 0
+        self.bounded = bounded
+        self.closed = False
+        self.generation = 0  # 每次唤醒挂起任务时加一 / bumped every time parked tasks are woken
+        self._parked = []
+        self._woken_cursor = l_range
+
+    def limit(self):
+        """窗口右边界, None表示不限制"""
+        if not self.bounded or not DOWNLOADER_WINDOW_SIZE:
+            return None
+        return self.cursor + DOWNLOADER_WINDOW_SIZE
+
+    def _over_global_budget(self, schedule_item: dict):
+        at_cursor = schedule_item["start"] <= self.cursor <= schedule_item["end"]
+        return self.bounded and DOWNLOADER_GLOBAL_WINDOW_SIZE and not at_cursor and DownloadWindow._global_buffered >= DOWNLOADER_GLOBAL_WINDOW_SIZE
+
+    def _over_limit(self, schedule_item: dict):
+        limit = self.limit()
+        return limit is not None and schedule_item["start"] + schedule_item["received"] >= limit
+
+    def check(self):
+        if self.closed:
+            raise DownloadAborted("Download window closed")
+
+    def park_item(self, schedule_item: dict, callback: callable):
+        """如果该区间不能继续抓取就挂起callback并返回True"""
+        with DownloadWindow._condition:
+            self.check()
+            if self._over_limit(schedule_item):
+                self._parked.append(callback)
+                return True
+            if self._over_global_budget(schedule_item):
+                DownloadWindow._global_parked.append(callback)
+                return True
+            return False
+
+    def park(self, callback: callable, generation: int):
+        """自generation之后没有唤醒过就挂起callback, 否则立即调用"""
+        with DownloadWindow._condition:
+            if not self.closed and self.generation == generation:
+                self._parked.append(callback)
+                return
+        callback()
+
+    def _take_parked(self):
+        """调用者需持有锁"""
+        parked = self._parked
+        self._parked = []
+        self._woken_cursor = self.cursor
+        self.generation += 1
+        return parked
+
+    def wake(self):
+        """发送端进入下一个区间时调用"""
+        with DownloadWindow._condition:
+            # 新的游标区间可能挂在全局列表上, 它不受全局限制, 需要一起唤醒
+            parked = self._take_parked() + DownloadWindow._global_parked
+            DownloadWindow._global_parked = []
+        for callback in parked:
+            callback()
+
+    def wait_closed(self):
+        """等待发送端结束"""
+        with DownloadWindow._condition:
+            while not self.closed:
+                DownloadWindow._condition.wait()
+
+    def add(self, size: int):
+        if not self.bounded:
+            return
+        with DownloadWindow._condition:
+            if self.closed:
+                return  # 关闭时已经归还了全部预算
+            self.buffered += size
+            DownloadWindow._global_buffered += size
+
+    def release(self, cursor: int, size: int):
+        """游标前移到cursor并释放size字节, 按需重新提交挂起的任务"""
+        parked = []
+        with DownloadWindow._condition:
+            self.cursor = max(self.cursor, cursor)
+            if self.bounded and not self.closed:
+                self.buffered -= size
+                DownloadWindow._global_buffered -= size
+            if self.cursor - self._woken_cursor >= DOWNLOADER_MIN_SPLIT_SIZE:
+                parked += self._take_parked()
+            if DownloadWindow._global_buffered < DOWNLOADER_GLOBAL_WINDOW_SIZE:
+                parked += DownloadWindow._global_parked
+                DownloadWindow._global_parked = []
+        for callback in parked:
+            callback()
+
+    def close(self):
+        with DownloadWindow._condition:
+            DownloadWindow._global_buffered -= self.buffered
+            self.buffered = 0
+            self.closed = True
+            parked = self._take_parked() + DownloadWindow._global_parked
+            DownloadWindow._global_parked = []
+            DownloadWindow._condition.notify_all()
+        for callback in parked:
+            callback()
+
+def _new_schedule_item(start: int, end: int, chunk_id: int):
+    return {
+        "start": start,
+        "end": end,
+        "chunk_id": chunk_id,
+        "downloaded": False,
+        "received": 0,  # 已收到的字节数 / bytes received so far
+        "pieces": [],  # 还有客户端没发送的数据块, 写盘时不使用 / pieces some client has not sent yet, unused when spooling to disk
+        "pieces_start": start,  # pieces[0]的起始位置 / offset of pieces[0]
+        "owner": None,  # 正在下载该区间的worker / worker currently fetching this range
+        "started_at": None,
+        "picked_at": None,  # 最近一次被领取的时间 / when the current owner picked it up
+        "finished_at": None,
+        "hedged": False,  # 已经发出过对冲请求 / a hedged request was already sent for it
+        "retries": 0,  # 连续失败的次数 / consecutive failed attempts
+        "retry_at": None,  # 失败后在这个时间之前不再领取 / not picked again before this time after a failure
+    }
+
+def _retry_delay(retries: int):
+    """第retries次重试前等待的秒数: 指数退避加上随机抖动, 避免同时失败的请求一起重试"""
+    return DOWNLOADER_RETRY_BASE_DELAY * 2 ** (retries - 1) * random.uniform(0.5, 1.5)
 
 def generate_schedule(l_range: int, r_range: int):
+    """
+    初始时每个worker一个大区间, 之后通过工作窃取动态切分.
+    如果设置了下载窗口, 初始区间只覆盖第一个窗口, 剩下的部分作为未分配区间随游标逐步领取.
+    """
     file_size = r_range - l_range + 1
-    # decide the chunk size based on the file size
-    if file_size <= 10 * 1024 * 1024:  # 10MB
-        chunk_size = file_size // DOWNLOADER_MAX_THREADS
-    elif file_size <= 500 * 1024 * 1024:  # 500MB
-        chunk_size = file_size // DOWNLOADER_MAX_THREADS // 3
-    else:
-        chunk_size = DOWNLOADER_MAX_CHUNK_SIZE
-
-    if chunk_size > DOWNLOADER_MAX_CHUNK_SIZE:
-        chunk_size = DOWNLOADER_MAX_CHUNK_SIZE
+    initial_size = file_size
+    if DOWNLOADER_WINDOW_SIZE:
+        initial_size = min(file_size, DOWNLOADER_WINDOW_SIZE)
+    range_num = max(1, min(DOWNLOADER_MAX_THREADS, initial_size // DOWNLOADER_MIN_SPLIT_SIZE))
+    range_size = (initial_size + range_num - 1) // range_num
 
     schedule = []
 
     # generate the schedule
-    total_chunks = (file_size + chunk_size - 1) // chunk_size
-    for i in range(total_chunks):
-        start = i * chunk_size
-        end = min(start + chunk_size - 1, file_size - 1)
-        schedule.append({
-            "start": start + l_range,
-            "end": end + l_range,
-            "chunk_id": i,
-            "chunk_data": None,
-            "consumed": False,
-            "downloaded": False,
-        })
+    for i in range(range_num):
+        start = i * range_size
+        end = min(start + range_size - 1, initial_size - 1)
+        if start > end:
+            break
+        schedule.append(_new_schedule_item(start + l_range, end + l_range, i))
+
+    if initial_size < file_size:
+        schedule.append(_new_schedule_item(initial_size + l_range, r_range, len(schedule)))
 
     return schedule
 
-def download_file_with_schedule(url: str, headers: dict, file_size: int, schedule: list, lock: threading.Lock):
-    """下载文件, 如果击中缓存就返回bytes形式, 否则通过callback实时更新下载进度"""
-    try:
-        cached_data = get_from_cache(CacheType.WEB_FILE, url + "#" + str(headers) + "#" + str(file_size))
-        if cached_data is not None:
-            return cached_data
-    except Exception as e:
-        logger.error(f"获取缓存失败: {str(e)}")
-        traceback.print_exc()
-        raise
+def _steal_range(schedule: list, window: DownloadWindow):
+    """把窗口内预计最晚完成的区间切成两半, 返回后半段; 调用者需持有锁"""
+    now = time.time()
+    limit = window.limit()
+    victim = None
+    victim_key = None
+    for schedule_item in schedule:
+        if schedule_item["downloaded"] or schedule_item["owner"] is None:
+            continue
+        position = schedule_item["start"] + schedule_item["received"]
+        if limit is not None and position >= limit:
+            continue  # 被窗口挡住的区间不算慢
+        remaining = schedule_item["end"] - position + 1
+        if remaining < 2 * DOWNLOADER_MIN_SPLIT_SIZE:
+            continue
+        elapsed = now - schedule_item["started_at"]
+        speed = schedule_item["received"] / elapsed if elapsed > 0 else 0
+        eta = remaining / speed if speed > 0 else float("inf")
+        if victim is None or (eta, remaining) > victim_key:
+            victim = schedule_item
+            victim_key = (eta, remaining)
+
+    if victim is None:
+        return None
+
+    position = victim["start"] + victim["received"]
+    half = (victim["end"] - position + 1) // 2
+    if limit is not None:
+        # 切分点尽量落在窗口内, 让新区间可以马上开始
+        half = min(half, max(DOWNLOADER_MIN_SPLIT_SIZE, (limit - position) // 2))
+    split = position + half
+    stolen = _new_schedule_item(split, victim["end"], len(schedule))
+    victim["end"] = split - 1
+    schedule.insert(schedule.index(victim) + 1, stolen)
+    return stolen
+
+def _pick_range(schedule: list, window: DownloadWindow, steal: bool = True):
+    """按离游标由近到远领取窗口内未分配的区间, 没有的话就去窃取; 调用者需持有锁"""
+    now = time.time()
+    limit = window.limit()
+    for schedule_item in schedule:
+        if schedule_item["owner"] is not None or schedule_item["downloaded"]:
+            continue
+        if schedule_item["retry_at"] is not None and schedule_item["retry_at"] > now:
+            continue  # 刚失败的区间等待重试
+        # 被让出的区间可能已经下载了一部分
+        position = schedule_item["start"] + schedule_item["received"]
+        if limit is not None and position >= limit:
+            break
+        if limit is not None:
+            # 未分配的尾部区间每次只切出一小段
+            piece_size = max(DOWNLOADER_MIN_SPLIT_SIZE, DOWNLOADER_WINDOW_SIZE // DOWNLOADER_MAX_THREADS)
+            if schedule_item["end"] - position + 1 > 2 * piece_size:
+                rest = _new_schedule_item(position + piece_size, schedule_item["end"], len(schedule))
+                schedule_item["end"] = rest["start"] - 1
+                schedule.insert(schedule.index(schedule_item) + 1, rest)
+        return schedule_item
+    return _steal_range(schedule, window) if steal else None
+
+def _assign(schedule_item: dict, owner: str):
+    """把区间交给owner; 调用者需持有锁"""
+    schedule_item["owner"] = owner
+    schedule_item["picked_at"] = time.time()
+    if schedule_item["started_at"] is None:
+        schedule_item["started_at"] = schedule_item["picked_at"]
+
+def _pick_straggler(schedule: list, now: float):
+    """
+    找出耗时远超已完成区间中位数的区间, 用于对冲请求; 调用者需持有锁.
+    返回(区间, None), 暂时没有时返回(None, 最早可能出现落后区间的秒数), 无从判断时返回(None, None).
+    """
+    durations = sorted(schedule_item["finished_at"] - schedule_item["picked_at"] for schedule_item in schedule if schedule_item["finished_at"] is not None and schedule_item["picked_at"] is not None)
+    if not DOWNLOADER_HEDGE_FACTOR or len(durations) < _HEDGE_MIN_SAMPLES:
+        return None, None
+    threshold = max(DOWNLOADER_HEDGE_MIN_DELAY, durations[len(durations) // 2] * DOWNLOADER_HEDGE_FACTOR)
+    straggler = None
+    wait = None
+    for schedule_item in schedule:
+        if schedule_item["downloaded"] or schedule_item["owner"] is None or schedule_item["hedged"]:
+            continue
+        remaining = threshold - (now - schedule_item["picked_at"])
+        if remaining > 0:
+            wait = remaining if wait is None else min(wait, remaining)
+        elif straggler is None or schedule_item["picked_at"] < straggler["picked_at"]:
+            straggler = schedule_item
+    if straggler is not None:
+        return straggler, None
+    return None, wait
+
+def _split_for_hedge(schedule: list, schedule_item: dict):
+    """
+    对冲请求只重新下载落后区间接下来的 DOWNLOADER_MIN_SPLIT_SIZE 字节, 后面的部分切成新的未分配区间交给其他worker;
+    返回对冲请求的 (start, end); 调用者需持有锁.
+    """
+    start = schedule_item["start"] + schedule_item["received"]
+    end = min(schedule_item["end"], start + DOWNLOADER_MIN_SPLIT_SIZE - 1)
+    if end < schedule_item["end"]:
+        rest = _new_schedule_item(end + 1, schedule_item["end"], len(schedule))
+        schedule_item["end"] = end
+        schedule.insert(schedule.index(schedule_item) + 1, rest)
+    schedule_item["hedged"] = True
+    return start, end
+
+def _store_hedge(schedule_item: dict, start: int, pieces: list, window: DownloadWindow, spool_fd: int | None):
+    """
+    对冲请求收完时保存区间还没收到的部分, 返回保存的字节数, 原来的请求先完成时返回0; 调用者需持有锁.
+    pieces是从start开始连续的数据块.
+    """
+    if schedule_item["downloaded"] or start + sum(len(piece) for piece in pieces) <= schedule_item["end"]:
+        return 0
+    stored = 0
+    offset = start
+    for piece in pieces:
+        # 跳过区间已经收到的部分和区间之后的部分 / skip what the range already has and anything past its end
+        position = schedule_item["start"] + schedule_item["received"]
+        part = piece[max(0, position - offset):max(0, schedule_item["end"] - offset + 1)]
+        offset += len(piece)
+        if part:
+            _store_piece(schedule_item, part, window, spool_fd)
+            stored += len(part)
+    return stored
+
+def _store_piece(schedule_item: dict, piece: bytes, window: DownloadWindow, spool_fd: int | None, in_place: bool = False):
+    """
+    保存紧接着区间已收到部分的数据: 写盘模式写到临时文件的同一偏移 (临时文件覆盖整个对象), 否则留给客户端发送; 调用者需持有锁.
+    in_place为True表示数据已经收进了临时文件的映射 (见_receive_buffer), 只需推进区间.
+    """
+    position = schedule_item["start"] + schedule_item["received"]
+    if spool_fd is not None:
+        if not in_place:
+            os.pwrite(spool_fd, piece, position)
+    elif position + len(piece) > window.cursor:
+        schedule_item["pieces"].append(piece)
+        window.add(len(piece))
+    else:
+        # 所有客户端都已经越过这段数据, 不再保留
+        schedule_item["pieces_start"] += len(piece)
+    schedule_item["received"] += len(piece)
+
+def _receive_buffer(schedule_item: dict, spool_map: mmap.mmap | None):
+    """
+    区间下一段数据的接收位置, 最多DOWNLOADER_PIECE_SIZE字节, 由readinto直接写入; 调用者需持有锁.
+    写盘模式下是临时文件映射中紧接着已收到部分的位置, 否则是新分配的缓冲区, 收到后直接作为数据块保存.
+    """
+    position = schedule_item["start"] + schedule_item["received"]
+    size = min(DOWNLOADER_PIECE_SIZE, schedule_item["end"] - position + 1)
+    if spool_map is not None:
+        return memoryview(spool_map)[position:position + size]
+    return memoryview(bytearray(size))
+
+def _has_unassigned_range(schedule: list):
+    return any(schedule_item["owner"] is None and not schedule_item["downloaded"] for schedule_item in schedule)
 
-    old_headers = headers
+def _retry_wait(schedule: list, now: float):
+    """未分配的区间中等待重试的最早还要多少秒, 没有时返回None; 调用者需持有锁"""
+    waits = [schedule_item["retry_at"] - now for schedule_item in schedule if schedule_item["owner"] is None and not schedule_item["downloaded"] and schedule_item["retry_at"] is not None and schedule_item["retry_at"] > now]
+    return min(waits) if waits else None
+
+def _next_in_run(schedule: list, schedule_item: dict):
+    """紧接着schedule_item并且未分配的区间; 调用者需持有锁"""
+    index = schedule.index(schedule_item) + 1
+    if index == len(schedule):
+        return None
+    next_item = schedule[index]
+    if next_item["owner"] is not None or next_item["downloaded"] or next_item["start"] != schedule_item["end"] + 1:
+        return None
+    return next_item
+
+def _completed_intervals(schedule: list):
+    """已经收到的数据, 对象中的闭区间列表, 相邻的合并; 调用者需持有锁"""
+    intervals = []
+    for schedule_item in schedule:
+        if schedule_item["received"] == 0:
+            continue
+        start = schedule_item["start"]
+        end = start + schedule_item["received"] - 1
+        if intervals and intervals[-1][1] + 1 == start:
+            intervals[-1] = (intervals[-1][0], end)
+        else:
+            intervals.append((start, end))
+    return intervals
+
+def _mark_downloaded(schedule: list, start: int, end: int):
+    """把[start, end]标记为已经下载, 必要时切分区间"""
+    for schedule_item in list(schedule):
+        if schedule_item["end"] < start or schedule_item["start"] > end:
+            continue
+        if schedule_item["start"] < start:
+            rest = _new_schedule_item(start, schedule_item["end"], len(schedule))
+            schedule_item["end"] = start - 1
+            schedule.insert(schedule.index(schedule_item) + 1, rest)
+            schedule_item = rest
+        if schedule_item["end"] > end:
+            rest = _new_schedule_item(end + 1, schedule_item["end"], len(schedule))
+            schedule_item["end"] = end
+            schedule.insert(schedule.index(schedule_item) + 1, rest)
+        schedule_item["received"] = schedule_item["end"] - schedule_item["start"] + 1
+        schedule_item["pieces_start"] = schedule_item["end"] + 1
+        schedule_item["downloaded"] = True
+
+_HEDGE_MIN_SAMPLES = 3  # 至少完成这么多区间后才判断落后 / completed ranges needed before judging stragglers
+
+def download_file_with_schedule(url: str, headers: dict, file_size: int, schedule: list, lock: threading.Condition, window: DownloadWindow, spool_path: str | None = None, sources: list | None = None, cache_name: str | None = None, response_headers: dict | None = None):
+    """
+    下载文件, 通过callback实时更新下载进度. 缓存命中在请求到达时就由http_handler处理, 不会走到这里.
+    给定spool_path时各分片直接写入这个覆盖整个对象的文件的对应偏移 (分段存储, 见cache_handler.create_spool_file),
+    对象完整后 (cache_name不为None) 发送端结束后连同response_headers原子地移入缓存, 否则已下载的区间留在分段存储中.
+    sources是内容与url一致的镜像地址 (见mirror_handler.find_sources), 各分片请求按速度分配到这些源上, 默认只用url.
+    分片任务提交给全局的download_scheduler, 与其他下载共享线程和连接数.
+    每收到一块数据, 完成一个区间或者失败时都会通知lock上等待的发送端.
+    """
     new_headers = {}
     for k, v in headers.items():
         new_headers[k] = v
     headers = new_headers
 
     progress_task = progress_bar.create_task(f"downloading {url}", total=file_size)
+    spool_saved = False
+    spool_fd = None
+    spool_map = None
 
     try:
         log(f"开始多线程下载 (总大小: {file_size/1024/1024:.2f}MB)")
-        
+
         exceptions = []
         max_retries = 3  # 最大重试次数
+        job_id = download_scheduler.new_job_id()
+        mirrors = MirrorSelector(sources or [url])
+        origin = get_origin(mirrors.urls[0])
+        finished = threading.Event()
 
-        def download_chunk(schedule_item: dict, on_success_callback: callable):
-            retries = 0
-            while retries <= max_retries:
-                try:
-                    start = schedule_item["start"]
-                    end = schedule_item["end"]
-                    headers["Range"] = f"bytes={start}-{end}"
-
-                    session = requests.Session()
-                    session.trust_env = DOWNLOADER_TRUST_ENV
-
-                    # http = urllib3.PoolManager()
-                    
-                    # 设置连接超时和读取超时
-                    with session.get(url, headers=headers, stream=False, timeout=(5, 30), proxies=DOWNLOADER_PROXIES, allow_redirects=False) as r:
-                    # with http.request('GET', url, headers=headers, preload_content=False, timeout=urllib3.Timeout(connect=5, read=30), retries=urllib3.Retry(total=3)) as r:
-                        # r.decode_content = False
-                        if r.status_code >= 300 or r.status_code < 200:
-                            raise requests.exceptions.HTTPError(f"HTTP {r.status_code} {r.reason}")
-                        chunk_data = r.content
+        def resubmit():
+            download_scheduler.submit(job_id, origin, task)
 
-                        if len(chunk_data) != (end - start + 1):
-                            raise Exception(f"分片大小不匹配: {len(chunk_data)}!= {(end - start + 1)} for {schedule_item['chunk_id']}")
+        def source_tripped():
+            """所有源的熔断器都打开时不再并行请求"""
+            return all(is_open(source) for source in mirrors.urls)
 
-                        # log(f"response headers: {r.headers}") #!TEST
-                        
-                        with lock:
-                            schedule_item["chunk_data"] = chunk_data
-                            schedule_item["downloaded"] = True
-                            progress_bar.update(progress_task, len(chunk_data))
-                            on_success_callback()
-
-                    break  # 下载成功则退出循环
-                    
-                except Exception as e:
-                    retries += 1
-                    if retries > max_retries:
+        def fail(e: Exception):
+            """调用者需持有锁"""
+            exceptions.append(e)
+            finished.set()
+            lock.notify_all()
+
+        single_stream = False  # 某个区间重试耗尽后不再并行, 由一个任务用一个range请求顺序下载剩下的部分
+        stream_busy = False
+
+        # 记录到主机能力里的统计 / statistics for the host profile
+        active_connections = 0
+        peak_connections = 0
+        fastest_connection = 0.0  # 单个连接的最高吞吐 / best throughput of a single connection
+        throttled = False  # 被窗口或者调度器限制过的下载不能反映源站的速度
+        range_checked = False
+        cpu_time = 0.0  # 各worker花在这个下载上的CPU时间 / CPU time the workers spent on this download
+        hedging = False  # 同一时间只有一个空闲任务负责对冲 / only one idle task hedges at a time
+        hedges_won = 0
+
+        # 各worker共用一个文件描述符和它的映射, 按偏移写入 / workers share one descriptor and its mapping, writing at offsets
+        if spool_path is not None:
+            spool_fd = os.open(spool_path, os.O_RDWR)
+            spool_map = mmap.mmap(spool_fd, 0)
+
+        def persist_state():
+            """写盘模式下记录已完成的区间, 供中断后续传; 调用者需持有锁"""
+            if spool_path is None:
+                return
+            try:
+                save_spool_state(spool_path, _completed_intervals(schedule))
+            except OSError as e:
+                logger.error(f"保存下载进度失败: {str(e)}")
+
+        def complete(schedule_item: dict):
+            """调用者需持有锁"""
+            schedule_item["downloaded"] = True
+            schedule_item["finished_at"] = time.time()
+            persist_state()
+            if all(item["downloaded"] for item in schedule):
+                finished.set()
+            lock.notify_all()
+
+        def hedge_chunk(schedule_item: dict):
+            """
+            在新连接上重新请求落后区间接下来的一小段, 先收完的一方生效, 区间剩下的部分重新放回调度表.
+            原来的worker可能还卡在读超时上, 对冲先完成时它下一次拿到数据 (或者超时) 就会放弃.
+            """
+            nonlocal hedges_won
+            with lock:
+                start, end = _split_for_hedge(schedule, schedule_item)
+            resubmit()  # 切出来的后半段由其他任务下载
+            log(f"分片 {schedule_item['chunk_id']} 落后, 在新连接上对冲请求 ({(end - start + 1)/1024:.0f}KB)")
+            pieces = []  # 对冲请求收到的数据块, 原来的worker还在写同一个区间, 先收完再保存
+            received = 0
+            source = mirrors.acquire()
+            request_started = time.time()
+            try:
+                with request_range(url, source, headers, start, end, fresh=True) as r:
+                    if r.status_code != 206:
+                        raise requests.exceptions.HTTPError(f"HTTP {r.status_code} {r.reason}")
+                    while received < end - start + 1:
+                        buffer = memoryview(bytearray(min(DOWNLOADER_PIECE_SIZE, end - start + 1 - received)))
+                        count = r.readinto(buffer)
+                        if count == 0:
+                            break
+                        pieces.append(buffer[:count])
+                        received += count
                         with lock:
-                            exceptions.append(e)
-                            logger.error(f"分片 {schedule_item['chunk_id']} 下载失败: {str(e)}")
-                            traceback.print_exc()
-                        break
-                    time.sleep(2 ** retries)  # 指数退避重试
-
-        # 使用线程池动态分配任务
-        with ThreadPoolExecutor(max_workers=DOWNLOADER_MAX_THREADS) as executor:
-            def on_success_callback():
-                pass
-
-            futures = [executor.submit(download_chunk, schedule_item, on_success_callback) for schedule_item in schedule]
-            
-            # 实时监控任务状态
-            for future in as_completed(futures):
+                            if schedule_item["downloaded"] or exceptions:
+                                return  # 原来的请求先完成了
+            except Exception as e:
+                mirrors.report_failure(source)
+                record_failure(source)
+                logger.error(f"分片 {schedule_item['chunk_id']} 对冲请求失败: {str(e)}")
+                return
+            finally:
+                mirrors.release(source, received, time.time() - request_started)
+            record_success(source)
+
+            with lock:
                 if exceptions:
-                    executor.shutdown(wait=False)
-                    raise exceptions[0]
+                    return
+                stored = _store_hedge(schedule_item, start, pieces, window, spool_fd)
+                if stored == 0:
+                    return
+                progress_bar.update(progress_task, stored)
+                hedges_won += 1
+                complete(schedule_item)
+
+        def download_chunk(schedule_item: dict, follow: bool = False):
+            """
+            下载一个区间; 返回False表示时间片用完或者重试耗尽让出了区间, None表示因窗口已满或者等待重试而挂起.
+            失败的区间记下重试时间后让出, 任务延迟重新提交, 等待期间线程去做其他工作.
+            follow为True时 (单连接模式) 区间下载完后用同一个请求继续下载后面相邻的未分配区间.
+            """
+            nonlocal single_stream, active_connections, peak_connections, fastest_connection, throttled, range_checked
+            streamed = 0  # 本次调用收到的字节数 / bytes received by this call
+            source = None
+            try:
+                window.check()
+                with lock:
+                    if schedule_item["downloaded"]:
+                        return True  # 对冲请求先完成了
+                    start = schedule_item["start"] + schedule_item["received"]
+                    # 单连接模式下请求到文件末尾, 遇到别人的区间时再断开
+                    end = schedule[-1]["end"] if follow else schedule_item["end"]
+                    if download_scheduler.has_waiting(job_id):
+                        # 有其他下载在排队时只请求大约一个时间片的数据, 响应收完后连接回到连接池再让出线程
+                        end = min(end, start + max(DOWNLOADER_MIN_SPLIT_SIZE, int(fastest_connection * DOWNLOADER_SCHEDULER_TIMESLICE)) - 1)
+                source = mirrors.acquire()
+                request_started = time.time()
+                request_streamed = streamed
+                with lock:
+                    active_connections += 1
+                    peak_connections = max(peak_connections, active_connections)
+                try:
+                    # 分片请求也可能被重定向, 跟随时不会把凭据带到其他主机
+                    with request_range(url, source, headers, start, end) as r:
+                        if r.status_code == 200 and start != 0:
+                            record_range_support(source, False)
+                        elif r.status_code == 206 and not range_checked:
+                            range_checked = True
+                            record_range_support(source, True)
+                        if r.status_code != 206 and not (r.status_code == 200 and start == 0):
+                            raise requests.exceptions.HTTPError(f"HTTP {r.status_code} {r.reason}")
+
+                        # 数据由readinto直接收进临时文件的映射或者作为数据块的缓冲区, 不再复制
+                        request_done = False
+                        while True:
+                            with lock:
+                                if exceptions or schedule_item["downloaded"]:
+                                    return True
+                                view = _receive_buffer(schedule_item, spool_map)
+                            count = r.readinto(view)
+                            if count == 0:
+                                break
+                            with lock:
+                                if exceptions or schedule_item["downloaded"]:
+                                    return True
+                                # 区间的后半段可能随时被其他worker窃取, 所以每次都按最新的end截断
+                                chunk_size = schedule_item["end"] - schedule_item["start"] + 1
+                                piece = view[:min(count, chunk_size - schedule_item["received"])]
+                                _store_piece(schedule_item, piece, window, spool_fd, in_place=True)
+                                streamed += len(piece)
+                                progress_bar.update(progress_task, len(piece))
+                                if schedule_item["received"] == chunk_size and follow:
+                                    # 单连接模式下接着下载相邻的区间, 后面的数据属于它
+                                    complete(schedule_item)
+                                    schedule_item = _next_in_run(schedule, schedule_item)
+                                    if schedule_item is None:
+                                        return True
+                                    _assign(schedule_item, threading.current_thread().name)
+
+                                lock.notify_all()
+                                if schedule_item["received"] >= schedule_item["end"] - schedule_item["start"] + 1:
+                                    break
+
+                                # 窗口已满时让出区间, 等客户端跟上后再继续
+                                if window.park_item(schedule_item, resubmit):
+                                    schedule_item["owner"] = None
+                                    throttled = True
+                                    return None
+                                # 本次请求的范围已经收完, 连接可以复用
+                                if start + streamed - request_streamed > end:
+                                    request_done = True
+                                    break
+                finally:
+                    mirrors.release(source, streamed - request_streamed, time.time() - request_started)
+                    with lock:
+                        active_connections -= 1
+                        if streamed - request_streamed >= DOWNLOADER_MIN_SPLIT_SIZE:
+                            fastest_connection = max(fastest_connection, (streamed - request_streamed) / (time.time() - request_started))
+
+                with lock:
+                    if schedule_item["downloaded"]:
+                        return True
+                    chunk_size = schedule_item["end"] - schedule_item["start"] + 1
+                    yielded = request_done and schedule_item["received"] < chunk_size
+                    if yielded:
+                        # 缩短的请求已经结束, 让出区间和线程, 任务重新排到其他下载后面
+                        schedule_item["owner"] = None
+                        throttled = True
+                    elif schedule_item["received"] != chunk_size:
+                        raise Exception(f"分片大小不匹配: {schedule_item['received']}!= {chunk_size} for {schedule_item['chunk_id']}")
+                    else:
+                        complete(schedule_item)
+
+                record_success(source)
+                return not yielded
+
+            except DownloadAborted as e:
+                with lock:
+                    fail(e)
+                return True
+
+            except Exception as e:
+                if source is not None:
+                    mirrors.report_failure(source)
+                    record_failure(source)
+                with lock:
+                    if follow and streamed > 0:
+                        schedule_item["retries"] = 0  # 单连接模式下只要有进展就重新计数
+                    schedule_item["retries"] += 1
+                    if schedule_item["retries"] > max_retries:
+                        if not follow:
+                            # 并行下载该区间一直失败, 退回单连接模式由一个任务继续
+                            logger.error(f"分片 {schedule_item['chunk_id']} 下载失败: {str(e)}, 退回单连接下载")
+                            single_stream = True
+                            schedule_item["retries"] = 0
+                            schedule_item["owner"] = None
+                            return False
+                        fail(e)
+                        logger.error(f"分片 {schedule_item['chunk_id']} 下载失败: {str(e)}")
+                        traceback.print_exc()
+                        return True
+                    # 指数退避重试, 从已收到的位置继续; 等待期间区间不可领取, 线程先去做其他工作
+                    delay = _retry_delay(schedule_item["retries"])
+                    schedule_item["owner"] = None
+                    schedule_item["retry_at"] = time.time() + delay
+                download_scheduler.submit_later(job_id, origin, task, delay)
+                return None
+
+        def task():
+            """领取一个区间并下载, 返回True表示需要重新排队"""
+            nonlocal cpu_time
+            task_started = time.thread_time()
+            try:
+                return run_task()
+            finally:
+                with lock:
+                    cpu_time += time.thread_time() - task_started
+
+        def run_task():
+            nonlocal stream_busy, throttled, hedging
+            straggler = None
+            hedge_wait = None
+            hedge = False
+            with lock:
+                if exceptions or finished.is_set():
+                    return False
+                if window.closed:
+                    # 最后一个区间可能已经收完数据, 只是还没标记完成
+                    if _has_unassigned_range(schedule):
+                        fail(DownloadAborted("Download window closed"))
+                    return False
+                follow = single_stream or source_tripped()
+                if follow and stream_busy:
+                    return False  # 单连接模式下只保留一个任务
+                generation = window.generation
+                schedule_item = _pick_range(schedule, window, steal=not follow)
+                retry_wait = _retry_wait(schedule, time.time()) if schedule_item is None else None
+                if schedule_item is None and not _has_unassigned_range(schedule):
+                    # 没有可领取的区间, 空闲的任务对冲落后的区间
+                    if hedging:
+                        return False
+                    straggler, hedge_wait = _pick_straggler(schedule, time.time())
+                    if straggler is None and hedge_wait is None:
+                        return False
+                    hedging = hedge = True
+                if schedule_item is not None:
+                    _assign(schedule_item, threading.current_thread().name)
+                    stream_busy = follow
+
+            if hedge:
+                try:
+                    if straggler is not None:
+                        hedge_chunk(straggler)
+                    else:
+                        # 等到可能出现落后区间的时候再检查
+                        finished.wait(hedge_wait)
+                finally:
+                    with lock:
+                        hedging = False
+                return True
+
+            if retry_wait is not None:
+                # 剩下的区间在等待重试, 到时候再提交
+                download_scheduler.submit_later(job_id, origin, task, retry_wait)
+                return False
+
+            if schedule_item is None:
+                # 剩下的区间都在窗口之外, 等客户端跟上后再提交
+                with lock:
+                    throttled = True
+                window.park(resubmit, generation)
+                return False
+
+            # 完成或者让出区间后重新排队, 继续领取或者窃取最慢区间的后半段
+            try:
+                return download_chunk(schedule_item, follow) is not None
+            finally:
+                if follow:
+                    with lock:
+                        stream_busy = False
+
+        with lock:
+            resumed = sum(schedule_item["received"] for schedule_item in schedule)
+            if all(schedule_item["downloaded"] for schedule_item in schedule):
+                finished.set()
+        progress_bar.update(progress_task, resumed)
 
-        
+        # 每个初始区间一个任务, 并发数参考各个源以往的表现
+        download_started = time.time()
+        for _ in range(min(DOWNLOADER_MAX_THREADS, sum(get_concurrency(source) for source in mirrors.urls), len(schedule))):
+            resubmit()
 
-        result = b''.join([schedule_item["chunk_data"] for schedule_item in schedule if schedule_item["chunk_data"] is not None])
-        save_to_cache(CacheType.WEB_FILE, url + "#" + str(old_headers) + "#" + str(file_size), result)
-        log("下载完成并已缓存")
+        finished.wait()
+        if exceptions:
+            raise exceptions[0]
+
+        elapsed = time.time() - download_started
+        with lock:
+            sample = not throttled and fastest_connection > 0 and len(mirrors.urls) == 1
+        if sample:
+            record_download(mirrors.urls[0], file_size - resumed, (file_size - resumed) / elapsed, fastest_connection, peak_connections)
+
+        hedge_note = f", 对冲成功 {hedges_won} 次" if hedges_won else ""
+        if spool_path is None:
+            log(f"下载完成 (CPU时间: {cpu_time:.2f}s{hedge_note})")
+            return
+
+        if cache_name is None:
+            # 对象还不完整, 下载的区间留在分段存储里 (见finally) / the object is incomplete, the ranges stay in the segment store
+            log(f"下载完成并已保存到分段存储 (CPU时间: {cpu_time:.2f}s{hedge_note})")
+            return
+
+        # 发送端可能还在读这个文件, 等它关闭后再移动
+        window.wait_closed()
+        spool_saved = True
+        if save_spool_to_cache(CacheType.WEB_FILE, cache_name, spool_path, response_headers):
+            log(f"下载完成并已缓存 (CPU时间: {cpu_time:.2f}s{hedge_note})")
         return
 
     except Exception as e:
         logger.error(f"下载失败: {str(e)}")
         traceback.print_exc()
     finally:
-        progress_bar.remove_task(progress_task)
\ No newline at end of file
+        progress_bar.remove_task(progress_task)
+        if spool_fd is not None:
+            # 落后的worker可能还没退出, 它们在锁内确认下载未结束后才会写入
+            with lock:
+                os.close(spool_fd)
+                try:
+                    spool_map.close()
+                except BufferError:
+                    pass  # 还卡在readinto里的worker持有映射, 它退出后映射随之释放
+        if spool_path is not None and not spool_saved:
+            _keep_partial_spool(spool_path, schedule, lock)
+
+def _keep_partial_spool(spool_path: str, schedule: list, lock: threading.Condition):
+    """保留已经下载的部分, 下次请求同一个文件的任意区间时只下载缺少的部分"""
+    with lock:
+        intervals = _completed_intervals(schedule)
+    if intervals:
+        close_spool_file(spool_path, intervals)
+    else:
+        remove_spool_file(spool_path)
+
+class SharedDownload:
+    """
+    一次源站下载, 相同缓存键的并发请求通过attach_download共享它.
+    每个请求是一个消费者, 有自己的发送游标和结束位置; 下载窗口的游标是最慢的消费者.
+    内存模式下数据块在所有消费者都发送后才释放.
+    """
+    def __init__(self, key: str, url: str, headers: dict, l_range: int, r_range: int, full_length: int, sources: list | None = None, first_bytes: bytes | None = None, response_headers: dict | None = None):
+        self.key = key
+        self.url = url
+        self.headers = headers
+        self.sources = sources
+        self.l_range = l_range
+        self.r_range = r_range
+        self.response_headers = dict(response_headers) if response_headers is not None else None
+        self.schedule = generate_schedule(l_range, r_range)
+        self.lock = threading.Condition()  # 保护schedule, 发送端在上面等待数据 / guards the schedule, consumers wait on it for data
+        # 开启缓存时各分片直接写入对象的分段存储, 消费者从文件发送; 之前的请求 (任意区间) 已经下载的部分不再下载
+        # with the cache enabled chunks go into the object's segment store and consumers send from it;
+        # whatever earlier requests for any range left there is not downloaded again
+        self.spool_path = create_spool_file(full_length, response_cache_name(url, headers, response_headers), response_headers)
+        segments = []
+        if self.spool_path is not None:
+            segments = load_spool_state(self.spool_path)
+            for start, end in segments:
+                _mark_downloaded(self.schedule, start, end)
+        # 下载完这个区间后对象完整时才进入缓存, 命中时按客户端的Range从中发送 / only whole objects are cached
+        covered = 0
+        for start, end in sorted(segments + [(l_range, r_range)]):
+            if start > covered:
+                break
+            covered = max(covered, end + 1)
+        self.cache_name = response_cache_name(url, headers, response_headers) if covered >= full_length else None
+        self.window = DownloadWindow(l_range, bounded=self.spool_path is None)
+        if first_bytes:
+            self._prefill(first_bytes)
+        self.failed = False
+        self._consumers = {}  # 消费者ID -> {"cursor", "end"}
+        self._consumer_ids = itertools.count()
+        self._released = l_range  # 该位置之前的数据块已经释放 / pieces before this offset are released
+
+    def _prefill(self, data: bytes):
+        """探测请求已经收到的开头数据直接作为第一个区间的已收到部分, worker从后面继续"""
+        schedule_item = self.schedule[0]
+        if schedule_item["received"]:
+            return  # 续传的临时文件里已经有了
+        data = data[:schedule_item["end"] - schedule_item["start"] + 1]
+        spool_fd = os.open(self.spool_path, os.O_WRONLY) if self.spool_path is not None else None
+        try:
+            _store_piece(schedule_item, data, self.window, spool_fd)
+        finally:
+            if spool_fd is not None:
+                os.close(spool_fd)
+        if schedule_item["received"] == schedule_item["end"] - schedule_item["start"] + 1:
+            schedule_item["downloaded"] = True
+            schedule_item["finished_at"] = time.time()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        if DOWNLOADER_ENGINE in ("asyncio", "http2"):
+            from async_downloader import download_file_with_schedule_async as download
+        else:
+            download = download_file_with_schedule
+        download(self.url, self.headers, self.r_range - self.l_range + 1, self.schedule, self.lock, self.window, self.spool_path, self.sources, self.cache_name, self.response_headers)
+        with self.lock:
+            if not all(schedule_item["downloaded"] for schedule_item in self.schedule):
+                self.failed = True
+            self.lock.notify_all()
+
+    def _attach(self, l_range: int, r_range: int):
+        """加入一个消费者, 区间不能由本次下载提供时返回None; 调用者需持有_in_flight_lock"""
+        with self.lock:
+            if self.failed or self.window.closed or l_range < self.l_range or r_range > self.r_range:
+                return None
+            if self.spool_path is None and l_range < self._released:
+                return None  # 这段数据已经释放了
+            consumer_id = next(self._consumer_ids)
+            self._consumers[consumer_id] = {"cursor": l_range, "end": r_range}
+            return consumer_id
+
+    def _item_index(self, offset: int):
+        """包含offset的区间下标, 区间始终按start有序; 调用者需持有锁"""
+        return max(bisect.bisect_right(self.schedule, offset, key=lambda schedule_item: schedule_item["start"]) - 1, 0)
+
+    def _item_at(self, offset: int):
+        return self.schedule[self._item_index(offset)]
+
+    def read(self, consumer_id: int):
+        """
+        获取消费者游标处可以发送的数据, 返回(pieces, offset, count); 没有数据时阻塞直到worker送来新数据.
+        内存模式下pieces是待发送的数据块; 写盘模式下pieces为空, 由调用者从临时文件的offset处发送count字节.
+        发送后需要调用advance.
+        """
+        with self.lock:
+            while True:
+                if self.failed:
+                    raise DownloadAborted("Shared download failed")
+                consumer = self._consumers[consumer_id]
+                cursor = consumer["cursor"]
+                schedule_item = self._item_at(cursor)
+                count = 0
+                # 流式模式下游标所在的分片边下载边发送
+                if schedule_item["downloaded"] or DOWNLOADER_STREAM_TO_CLIENT:
+                    count = min(schedule_item["start"] + schedule_item["received"], consumer["end"] + 1) - cursor
+                if count > 0:
+                    break
+                self.lock.wait()
+
+            if self.spool_path is not None:
+                return [], cursor, count
+
+            pieces = []
+            position = schedule_item["pieces_start"]
+            for piece in schedule_item["pieces"]:
+                piece_end = position + len(piece)
+                if piece_end > cursor:
+                    pieces.append(memoryview(piece)[max(cursor - position, 0):min(len(piece), cursor + count - position)])
+                position = piece_end
+                if position >= cursor + count:
+                    break
+            return pieces, cursor, count
+
+    def advance(self, consumer_id: int, count: int):
+        """消费者发送完count字节后调用, 返回该消费者是否已经发送完毕"""
+        with self.lock:
+            consumer = self._consumers[consumer_id]
+            next_item = consumer["cursor"] + count > self._item_at(consumer["cursor"])["end"]
+            consumer["cursor"] += count
+            self._release_pieces()
+            if next_item:
+                # 下一个分片可能在等待挂起的worker
+                self.window.wake()
+            return consumer["cursor"] > consumer["end"]
+
+    def _release_pieces(self):
+        """释放所有消费者都已发送的数据块并前移窗口; 调用者需持有锁"""
+        if not self._consumers:
+            return
+        cursor = min(consumer["cursor"] for consumer in self._consumers.values())
+        if cursor <= self._released:
+            return
+        freed = 0
+        for schedule_item in itertools.islice(self.schedule, self._item_index(self._released), None):
+            if schedule_item["start"] >= cursor:
+                break
+            pieces = schedule_item["pieces"]
+            while pieces and schedule_item["pieces_start"] + len(pieces[0]) <= cursor:
+                schedule_item["pieces_start"] += len(pieces[0])
+                freed += len(pieces.pop(0))
+        self._released = cursor
+        self.window.release(cursor, freed)
+
+    def detach(self, consumer_id: int):
+        """消费者结束 (或者客户端断开) 时调用, 最后一个消费者离开时结束下载"""
+        with _in_flight_lock:
+            with self.lock:
+                del self._consumers[consumer_id]
+                if self._consumers:
+                    self._release_pieces()
+                    return
+                downloads = _in_flight[self.key]
+                downloads.remove(self)
+                if not downloads:
+                    del _in_flight[self.key]
+        # 唤醒被窗口挡住的worker, 下载未完成时它们会放弃
+        self.window.close()
+
+# 进行中的下载, 缓存键 -> [SharedDownload]
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def attach_download(url: str, headers: dict, l_range: int, r_range: int, full_length: int, sources: list | None = None, first_bytes: bytes | None = None, response_headers: dict | None = None):
+    """
+    获取可以提供[l_range, r_range]的进行中下载并加入为消费者, 没有的话新建一个, 新下载从sources (默认为url) 获取数据.
+    first_bytes是已经收到的从l_range开始的数据 (见DOWNLOADER_PROBE), 新下载不再请求这部分.
+    response_headers是源站的响应头, 下载完整个文件时随文件一起缓存.
+    返回(download, consumer_id), 发送结束后需要调用download.detach(consumer_id).
+    """
+    key = response_cache_name(url, headers, response_headers) + "#" + str(full_length)
+    with _in_flight_lock:
+        for download in _in_flight.get(key, []):
+            consumer_id = download._attach(l_range, r_range)
+            if consumer_id is not None:
+                log(f"Joined in-flight download of {url} (bytes {l_range}-{r_range})")
+                return download, consumer_id
+
+        download = SharedDownload(key, url, headers, l_range, r_range, full_length, sources, first_bytes, response_headers)
+        consumer_id = download._attach(l_range, r_range)
+        _in_flight.setdefault(key, []).append(download)
+    download.start()
+    return download, consumer_id
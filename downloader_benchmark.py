@@ -0,0 +1,187 @@
+import argparse
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import async_downloader
+import downloader
+import host_profile
+from configs import DOWNLOADER_HTTP2_PRIOR_KNOWLEDGE
+from downloader import attach_download
+
+# 用本地支持Range的源站对比线程引擎, asyncio引擎和HTTP/2引擎 (HTTP/2源站需要h2)
+# Compare the thread, asyncio and http2 download engines against a local range-capable origin (the HTTP/2 origin needs h2)
+#
+# python downloader_benchmark.py --size 64 --downloads 8 --rate 4
+
+def _parse_range(range_header: str | None, size: int):
+    """返回 (start, end, 是否是range请求)"""
+    if not range_header:
+        return 0, size - 1, False
+    first, last = range_header.split("=", 1)[1].split("-")
+    return int(first), min(int(last), size - 1) if last else size - 1, True
+
+def _make_handler(data: bytes, rate: float, stats: dict):
+    class RangeHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            stats["connections"] += 1
+
+        def handle(self):
+            try:
+                super().handle()
+            except ConnectionResetError:
+                pass  # 下载器提前关闭了连接 / the downloader dropped the connection
+
+        def do_GET(self):
+            start, end, ranged = _parse_range(self.headers.get("Range"), len(data))
+            if ranged:
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+            try:
+                view = memoryview(data)[start:end + 1]
+                for i in range(0, len(view), 64 * 1024):
+                    self.wfile.write(view[i:i + 64 * 1024])
+                    if rate:
+                        time.sleep(64 * 1024 / rate)  # 模拟单连接限速的源站 / emulate a per-connection rate limit
+            except BrokenPipeError:
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    return RangeHandler
+
+async def _serve_h2(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, data: bytes, rate: float, stats: dict):
+    """明文HTTP/2 (h2c) 的本地源站, 每个流单独限速并遵守客户端的流量控制窗口"""
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.exceptions
+
+    stats["connections"] += 1
+    conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding="utf-8"))
+    conn.initiate_connection()
+    writer.write(conn.data_to_send())
+    window_opened = asyncio.Event()
+    tasks = {}
+
+    async def send_range(stream_id: int, headers: dict):
+        start, end, ranged = _parse_range(headers.get("range"), len(data))
+        response_headers = [(":status", "206" if ranged else "200"), ("content-length", str(end - start + 1)), ("accept-ranges", "bytes")]
+        if ranged:
+            response_headers.append(("content-range", f"bytes {start}-{end}/{len(data)}"))
+        conn.send_headers(stream_id, response_headers)
+        view = memoryview(data)[start:end + 1]
+        position = 0
+        while position < len(view):
+            while conn.local_flow_control_window(stream_id) <= 0:
+                window_opened.clear()
+                await window_opened.wait()
+            size = min(64 * 1024, conn.local_flow_control_window(stream_id), conn.max_outbound_frame_size, len(view) - position)
+            conn.send_data(stream_id, view[position:position + size].tobytes(), end_stream=position + size == len(view))
+            writer.write(conn.data_to_send())
+            await writer.drain()
+            position += size
+            if rate:
+                await asyncio.sleep(size / rate)  # 模拟单连接限速的源站 / emulate a per-connection rate limit
+
+    try:
+        while True:
+            received = await reader.read(65536)
+            if not received:
+                break
+            for event in conn.receive_data(received):
+                if isinstance(event, h2.events.RequestReceived):
+                    tasks[event.stream_id] = asyncio.ensure_future(send_range(event.stream_id, dict(event.headers)))
+                elif isinstance(event, h2.events.WindowUpdated):
+                    window_opened.set()
+                elif isinstance(event, h2.events.StreamReset) and event.stream_id in tasks:
+                    tasks.pop(event.stream_id).cancel()
+            writer.write(conn.data_to_send())
+    except (ConnectionError, h2.exceptions.ProtocolError):
+        pass  # 下载器提前关闭了连接 / the downloader dropped the connection
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        writer.close()
+
+def _start_h2_origin(data: bytes, rate: float, stats: dict):
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(lambda reader, writer: _serve_h2(reader, writer, data, rate, stats), "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+def _consume(url: str, size: int, data: bytes, results: list):
+    """像http_handler一样读完整个文件, 只校验不发送"""
+    download, consumer_id = attach_download(url, {}, 0, size - 1, size)
+    received = bytearray()
+    try:
+        done = False
+        while not done:
+            pieces, offset, count = download.read(consumer_id)
+            for piece in pieces:
+                received += piece
+            done = download.advance(consumer_id, count)
+    finally:
+        download.detach(consumer_id)
+    results.append(received == data)
+
+def _worker_threads(engine: str):
+    name = "Downloader" if engine == "thread" else "AsyncDownloader"
+    return sum(1 for thread in threading.enumerate() if thread.name == name)
+
+def run(engine: str, origin: str, data: bytes, downloads: int, stats: dict):
+    downloader.DOWNLOADER_ENGINE = engine
+    async_downloader.DOWNLOADER_ENGINE = engine
+    stats["connections"] = 0
+    results = []
+    peak_threads = _worker_threads(engine)
+    consumers = [threading.Thread(target=_consume, args=(f"{origin}/{engine}/{i}.bin", len(data), data, results)) for i in range(downloads)]
+    started = time.time()
+    cpu_started = time.process_time()
+    for consumer in consumers:
+        consumer.start()
+    while any(consumer.is_alive() for consumer in consumers):
+        peak_threads = max(peak_threads, _worker_threads(engine))
+        time.sleep(0.05)
+    elapsed = time.time() - started
+    cpu_time = time.process_time() - cpu_started
+    throughput = len(data) * downloads / elapsed / 1024 / 1024
+    print(f"{engine:>8}: {elapsed:.2f}s, {throughput:.1f}MB/s, CPU {cpu_time:.2f}s, worker threads {peak_threads}, origin connections {stats['connections']}, {results.count(True)}/{downloads} verified")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the download engines")
+    parser.add_argument("--size", type=int, default=64, help="File size in MB")
+    parser.add_argument("--downloads", type=int, default=8, help="Concurrent downloads")
+    parser.add_argument("--rate", type=float, default=0, help="Per-connection rate limit of the origin in MB/s, 0 for unlimited")
+    parser.add_argument("--engines", default="thread,asyncio", help="Comma-separated engines to run (thread, asyncio, http2)")
+    args = parser.parse_args()
+
+    # 不污染真实的主机能力记录 / keep the real host profiles untouched
+    host_profile.HOST_PROFILE_FILE = os.path.join(tempfile.mkdtemp(), "hosts.json")
+
+    data = os.urandom(args.size * 1024 * 1024)
+    stats = {"connections": 0}
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(data, args.rate * 1024 * 1024, stats))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    origin = f"http://127.0.0.1:{server.server_address[1]}"
+
+    for engine in args.engines.split(","):
+        if engine == "http2":
+            h2_origin = _start_h2_origin(data, args.rate * 1024 * 1024, stats)
+            DOWNLOADER_HTTP2_PRIOR_KNOWLEDGE.append(h2_origin)
+            run(engine, h2_origin, data, args.downloads, stats)
+        else:
+            run(engine, origin, data, args.downloads, stats)
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+from configs import *
+from utils import log
+from session_pool import get_origin
+
+# 每个源的能力记录, 持久化在 HOST_PROFILE_FILE
+# Per-origin capability profile, persisted to HOST_PROFILE_FILE
+#
+# {
+#     "https://example.com": {
+#         "range_support": true,  # 是否支持Range, null为未知 / honors Range requests, null if unknown
+#         "single_throughput": 1048576.0,  # 单个连接的吞吐 (字节/秒) / throughput of one connection (bytes/s)
+#         "multi_throughput": 8388608.0,  # 多线程下载的总吞吐 / aggregate throughput of parallel downloads
+#         "best_concurrency": 16,  # 总吞吐最高时的并发数 / concurrency of the best aggregate throughput
+#         "best_throughput": 9437184.0,
+#         "multi_updated": 1700000000.0,  # 最近一次多线程样本的时间 / time of the latest parallel sample
+#         "updated": 1700000000.0
+#     }
+# }
+
+_EWMA_WEIGHT = 0.3  # 新样本的权重 / weight of a new sample
+
+_profiles = {}
+_profiles_lock = threading.Lock()
+_passed_through = {}  # 上次多线程下载之后不加速的下载次数 / downloads not accelerated since the last parallel one
+_explored_at = {}  # 上次为了重新测量而加速的时间, 那次下载可能没有留下样本 / last accelerated only to measure, that download may have left no sample
+
+def _load_profiles():
+    if not Path(HOST_PROFILE_FILE).exists():
+        return
+    try:
+        with open(HOST_PROFILE_FILE) as f:
+            _profiles.update(json.load(f))
+    except (OSError, ValueError) as e:
+        log(f"Failed to load host profiles: {e}")
+
+def _save_profiles():
+    """调用者需持有锁"""
+    try:
+        Path(HOST_PROFILE_FILE).parent.mkdir(parents=True, exist_ok=True)
+        with open(HOST_PROFILE_FILE + ".tmp", 'w') as f:
+            json.dump(_profiles, f, indent=2)
+        os.replace(HOST_PROFILE_FILE + ".tmp", HOST_PROFILE_FILE)
+    except OSError as e:
+        log(f"Failed to save host profiles: {e}")
+
+def _new_profile():
+    return {
+        "range_support": None,
+        "single_throughput": None,
+        "multi_throughput": None,
+        "best_concurrency": None,
+        "best_throughput": None,
+        "multi_updated": None,
+        "updated": time.time(),
+    }
+
+def _get_profile(origin: str):
+    """过期的记录重新学习; 调用者需持有锁"""
+    profile = _profiles.get(origin)
+    if profile is None or profile["updated"] + HOST_PROFILE_EXPIRE_SECONDS < time.time():
+        profile = _new_profile()
+        _profiles[origin] = profile
+    return profile
+
+def _update(url: str, **fields):
+    """只有值变化时才写盘"""
+    origin = get_origin(url)
+    with _profiles_lock:
+        profile = _get_profile(origin)
+        changed = {k: v for k, v in fields.items() if profile.get(k) != v}
+        if not changed:
+            return
+        profile.update(changed)
+        profile["updated"] = time.time()
+        _save_profiles()
+    if "range_support" in changed:
+        log(f"Host profile of {origin}: range support {changed['range_support']}")
+
+def _ewma(old: float | None, sample: float):
+    return sample if old is None else old * (1 - _EWMA_WEIGHT) + sample * _EWMA_WEIGHT
+
+def get_profile(url: str):
+    """获取该源的能力记录 (副本)"""
+    with _profiles_lock:
+        return dict(_get_profile(get_origin(url)))
+
+def record_head(url: str, status_code: int, headers: dict):
+    """根据HEAD响应记录Range支持; 重定向由redirect_handler缓存, 它的Accept-Ranges不代表文件"""
+    if 300 <= status_code < 400:
+        return
+    accept_ranges = headers.get("Accept-Ranges")
+    if accept_ranges is not None:
+        _update(url, range_support=accept_ranges.strip().lower() == "bytes")
+
+def record_range_support(url: str, supported: bool):
+    """分片请求返回206或者200时调用"""
+    _update(url, range_support=supported)
+
+def record_download(url: str, size: int, throughput: float, connection_throughput: float, concurrency: int):
+    """
+    记录一次没有被客户端拖慢的下载.
+    size是下载的字节数, throughput是总吞吐, connection_throughput是其中最快的单个连接, concurrency是同时使用的最大连接数.
+    """
+    if size < HOST_PROFILE_MIN_SAMPLE_SIZE:
+        return
+    origin = get_origin(url)
+    with _profiles_lock:
+        profile = _get_profile(origin)
+        profile["single_throughput"] = _ewma(profile["single_throughput"], connection_throughput)
+        if concurrency > 1:
+            profile["multi_throughput"] = _ewma(profile["multi_throughput"], throughput)
+            profile["multi_updated"] = time.time()
+            if profile["best_throughput"] is None or throughput >= profile["best_throughput"]:
+                profile["best_throughput"] = throughput
+                profile["best_concurrency"] = concurrency
+        profile["updated"] = time.time()
+        _save_profiles()
+
+def should_accelerate(url: str):
+    """
+    该源是否值得多线程下载: 支持Range, 并且多线程的吞吐明显高于单个连接.
+    不加速的源每隔 HOST_PROFILE_EXPLORE_INTERVAL 次下载或者样本过期时仍然加速一次, 源站或者网络变快后能重新发现.
+    """
+    origin = get_origin(url)
+    with _profiles_lock:
+        profile = _get_profile(origin)
+        if profile["range_support"] is False:
+            return False
+        if profile["single_throughput"] is None or profile["multi_throughput"] is None:
+            return True
+        if profile["multi_throughput"] >= profile["single_throughput"] * HOST_PROFILE_MIN_SPEEDUP:
+            return True
+        sampled_at = max(profile.get("multi_updated") or 0, _explored_at.get(origin, 0))
+        if sampled_at + HOST_PROFILE_SAMPLE_MAX_AGE < time.time() or _passed_through.get(origin, 0) + 1 >= HOST_PROFILE_EXPLORE_INTERVAL:
+            _passed_through[origin] = 0
+            _explored_at[origin] = time.time()
+            log(f"Host profile of {origin}: measuring parallel download again")
+            return True
+        _passed_through[origin] = _passed_through.get(origin, 0) + 1
+        return False
+
+def get_concurrency(url: str):
+    """单个下载使用的并发数: 在观察到的最佳并发数上多试一半, 没有记录时用 DOWNLOADER_MAX_THREADS"""
+    best_concurrency = get_profile(url)["best_concurrency"]
+    if best_concurrency is None:
+        return DOWNLOADER_MAX_THREADS
+    return min(DOWNLOADER_MAX_THREADS, max(2, best_concurrency + best_concurrency // 2))
+
+_load_profiles()
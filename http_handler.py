@@ -1,4 +1,6 @@
 from enum import Enum
+import mimetypes
+import os
 import select
 import socket
 import ssl
@@ -12,17 +14,19 @@ from configs import *
 import configs
 from mfc_handler import get_mfc_dir, handle_mfc_download, is_cache_disabled
 from utils import decode_header, filter_transfer_headers, log, logger
-from downloader import download_file_with_schedule, generate_schedule
+from downloader import attach_download
 from log_handler import LoggingSocketDecorator, request_tracker
-
-def _handle_multithread_download(client_socket: socket.socket, target_url: str, headers: dict, content_length: int, response_headers: dict, response: requests.Response, range: str | None, full_length: int | None):
-    l_range = 0
-    r_range = None
-    if range is not None:
-        _range = range.split("=")[1]
-        l_range = int(_range.split("-")[0])
-        if len(_range.split("-")) == 2 and _range.split("-")[1] != "":
-            r_range = int(_range.split("-")[1])
+from host_profile import should_accelerate
+from mirror_handler import find_sources, source_headers
+from redirect_handler import probe_following_redirects
+from cache_handler import CacheType, discard_segments, get_cached_response, open_cached_segments, refresh_cached_response, remove_from_cache
+from cache_key_handler import record_vary, response_cache_name
+from checksum_handler import find_cached_artifact
+from circuit_breaker import is_open, record_failure
+from revalidation_handler import is_fresh, revalidate
+
+def _handle_multithread_download(client_socket: socket.socket, target_url: str, headers: dict, content_length: int, response_headers: dict, response: requests.Response, range: str | None, full_length: int, sources: list | None = None, first_bytes: bytes | None = None):
+    l_range, r_range = _parse_range(range, full_length)
 
     try:
         def safe_send(data):
@@ -32,10 +36,15 @@ def _handle_multithread_download(client_socket: socket.socket, target_url: str,
             except (ConnectionResetError, BrokenPipeError, socket.timeout) as e:
                 logger.error(f"Send failed: {type(e).__name__}")
                 return False
+
+        def safe_sendfile(file, offset, count):
+            try:
+                client_socket.sendfile(file, offset, count)
+                return True
+            except (ConnectionResetError, BrokenPipeError, socket.timeout) as e:
+                logger.error(f"Send failed: {type(e).__name__}")
+                return False
             
-        if not range or not r_range:
-            r_range = l_range + content_length - 1
-        
         if range is not None:
             response_headers["Content-Range"] = f"bytes {l_range}-{r_range}/{full_length}"
             response_headers["Accept-Ranges"] = "bytes"
@@ -47,35 +56,34 @@ def _handle_multithread_download(client_socket: socket.socket, target_url: str,
         
         safe_send(response_headers_raw.encode())
 
-        schedule = generate_schedule(l_range, r_range)
-        chunk_num = len(schedule)
+        # concurrent requests for the same file share one download, each with its own send cursor
+        download, consumer_id = attach_download(target_url, headers, l_range, r_range, full_length, sources, first_bytes, response_headers)
 
-        lock = threading.Lock()
+        spool_reader = None
+        try:
+            # with cache enabled the chunks are written straight into a spool file and sent from there
+            if download.spool_path is not None:
+                spool_reader = open(download.spool_path, "rb")
 
-        download_process = threading.Thread(
-            target=download_file_with_schedule,
-            args=(target_url, headers, r_range - l_range + 1, schedule, lock),
-        )
-        download_process.start()
+            # Main thread sending loop, read() sleeps until the workers hand over the data at the cursor
+            cpu_started = time.thread_time()
+            while True:
+                pieces, offset, count = download.read(consumer_id)
 
-        # Main thread sending loop
-        current_chunk_id = 0
-        while True:
-            with lock:
-                if schedule[current_chunk_id]["downloaded"]:
-                    if not safe_send(schedule[current_chunk_id]["chunk_data"]):
+                for piece in pieces:
+                    if not safe_send(piece):
                         raise Exception("Send failed")
-                    schedule[current_chunk_id]["consumed"] = True
-                    if not configs.with_cache:
-                        schedule[current_chunk_id]["chunk_data"] = None
-
-                    current_chunk_id += 1
-                    if current_chunk_id == chunk_num:
-                        break
-
-        if result := download_process.join():
-            if not safe_send(result):
-                raise Exception("Send failed")
+                if count and spool_reader is not None:
+                    if not safe_sendfile(spool_reader, offset, count):
+                        raise Exception("Send failed")
+                if count and download.advance(consumer_id, count):
+                    break
+            log(f"Sent {(r_range - l_range + 1)/1024/1024:.2f}MB to client (sender CPU time: {time.thread_time() - cpu_started:.2f}s)")
+        finally:
+            if spool_reader is not None:
+                spool_reader.close()
+            # the last client to leave wakes up the workers blocked on the window, they give up if the download is unfinished
+            download.detach(consumer_id)
 
         safe_send(b"\r\n")
 
@@ -83,11 +91,138 @@ def _handle_multithread_download(client_socket: socket.socket, target_url: str,
         logger.error(f"Download failed: {e}")
         log(traceback.format_exc())
 
+# stored response headers that describe the original transfer, they are recomputed for each hit
+_REPLACED_HEADERS = {"content-length", "content-range", "accept-ranges", "connection", "keep-alive", "transfer-encoding"}
+
+def _revalidate(url: str, headers: dict, path: str, stored_headers: dict, validated_at: float):
+    """
+    The headers to serve a cached file with: the stored ones while fresh, refreshed ones once the origin confirms a stale copy.
+    None when the origin has a different version, the copy is then dropped. A stale copy is still served if the origin can not be asked.
+    """
+    if is_fresh(url, validated_at):
+        return stored_headers
+    if is_open(url):
+        log("Circuit breaker is open for this host, serving the stale cached copy")
+        return stored_headers
+    try:
+        refreshed = revalidate(url, headers, stored_headers)
+    except Exception as e:
+        record_failure(url)
+        logger.error(f"Revalidation failed, serving the stale cached copy: {e}")
+        return stored_headers
+    if refreshed is not None:
+        refresh_cached_response(path, refreshed)
+    return refreshed
+
+def _parse_range(range: str | None, full_length: int):
+    """The first and last byte a simple Range header asks for, first > last when it can not be satisfied"""
+    l_range = 0
+    r_range = full_length - 1
+    if range is not None:
+        first, last = (part.strip() for part in range.split("=")[1].split("-"))
+        if first == "":
+            l_range = max(full_length - int(last), 0)  # suffix range: the last N bytes
+        else:
+            l_range = int(first)
+            if last != "":
+                r_range = min(int(last), full_length - 1)
+    return l_range, r_range
+
+def _probe_range(range: str | None):
+    """The probe asks for the first DOWNLOADER_PROBE_SIZE bytes of what the client wants, a suffix range is sent as is since its start depends on the file size"""
+    if range is None:
+        return f"bytes=0-{DOWNLOADER_PROBE_SIZE - 1}"
+    first, last = (part.strip() for part in range.split("=")[1].split("-"))
+    if first == "":
+        return f"bytes=-{last}"
+    probe_end = int(first) + DOWNLOADER_PROBE_SIZE - 1
+    if last != "":
+        probe_end = min(probe_end, int(last))
+    return f"bytes={first}-{probe_end}"
+
+def _send_cached_file(client_socket: socket.socket, url: str, f, full_length: int, l_range: int, r_range: int, range: str | None, stored_headers: dict | None):
+    """Send [l_range, r_range] of an open cached file with sendfile"""
+    if stored_headers:
+        response_headers = {k: v for k, v in stored_headers.items() if k.lower() not in _REPLACED_HEADERS}
+    else:
+        response_headers = {"Content-Type": mimetypes.guess_type(urlparse(url).path)[0] or "application/octet-stream"}
+    response_headers["Content-Length"] = str(r_range - l_range + 1)
+    response_headers["Accept-Ranges"] = "bytes"
+    response_headers["Connection"] = "keep-alive"
+    status = "200 OK"
+    if range is not None:
+        status = "206 Partial Content"
+        response_headers["Content-Range"] = f"bytes {l_range}-{r_range}/{full_length}"
+    response_headers_raw = f"HTTP/1.1 {status}\r\n"
+    for key, value in response_headers.items():
+        response_headers_raw += f"{key}: {value}\r\n"
+    response_headers_raw += "\r\n"
+
+    try:
+        client_socket.sendall(response_headers_raw.encode())
+        client_socket.sendfile(f, l_range, r_range - l_range + 1)
+        log(f"Sent {(r_range - l_range + 1)/1024/1024:.2f}MB to client from the cache")
+    except (ConnectionResetError, BrokenPipeError, socket.timeout) as e:
+        logger.error(f"Send failed: {type(e).__name__}")
+
+def _handle_blob_hit(client_socket: socket.socket, url: str, path: str, range: str | None, stored_headers: dict | None = None):
+    """
+    Serve a cached file straight from disk with sendfile, the origin is never contacted.
+    stored_headers are the origin's response headers saved with the file, without them the Content-Type is guessed from the url.
+    """
+    full_length = os.path.getsize(path)
+    l_range, r_range = _parse_range(range, full_length)
+    if l_range > r_range:
+        client_socket.sendall(f"HTTP/1.1 416 Range Not Satisfiable\r\nContent-Range: bytes */{full_length}\r\nContent-Length: 0\r\n\r\n".encode())
+        return
+
+    with open(path, "rb") as f:
+        _send_cached_file(client_socket, url, f, full_length, l_range, r_range, range, stored_headers)
+
+def _handle_segment_hit(client_socket: socket.socket, url: str, segments: tuple, range: str | None):
+    """
+    Serve a range of a partially downloaded file from its segment store if every byte of it is present.
+    Returns False when something is missing, the request then goes the usual way and only the gaps are downloaded.
+    """
+    f, stored_headers, intervals = segments
+    with f:
+        full_length = os.fstat(f.fileno()).st_size
+        l_range, r_range = _parse_range(range, full_length)
+        if l_range > r_range or not any(start <= l_range and r_range <= end for start, end in intervals):
+            return False
+        _send_cached_file(client_socket, url, f, full_length, l_range, r_range, range, stored_headers)
+        return True
+
 class InterceptStatus(Enum):
     PASS = 0
     CLOSE_DIRECTLY = 1
     NO_PASS = 2
 
+def _serve_cached(client_socket: socket.socket, url: str, headers: dict, range: str | None, cache_name: str):
+    """
+    Answer from the cache entry or the segment store of cache_name, True when the client was answered.
+    A file an earlier download cached is answered with its stored headers, once it is stale a conditional request confirms it first
+    """
+    cached = get_cached_response(CacheType.WEB_FILE, cache_name)
+    if cached is not None:
+        path, stored_headers, validated_at = cached
+        stored_headers = _revalidate(url, headers, path, stored_headers, validated_at)
+        if stored_headers is not None:
+            _handle_blob_hit(client_socket, url, path, range, stored_headers)
+            return True
+        remove_from_cache(CacheType.WEB_FILE, cache_name)
+    # ranges earlier requests already fetched are served from the file's segment store
+    segments = open_cached_segments(cache_name)
+    if segments is not None:
+        f, stored_headers, validated_at, intervals = segments
+        stored_headers = _revalidate(url, headers, f.name, stored_headers, validated_at)
+        if stored_headers is None:
+            f.close()
+            discard_segments(cache_name)
+        elif _handle_segment_hit(client_socket, url, (f, stored_headers, intervals), range):
+            return True
+    return False
+
 def _on_header(client_socket: socket.socket, header: bytes, is_ssl: bool):
     method, url, headers = decode_header(header, is_ssl)
 
@@ -101,20 +236,41 @@ def _on_header(client_socket: socket.socket, header: bytes, is_ssl: bool):
     
     if is_cache_disabled(url):
         return InterceptStatus.PASS
+
+    # the cache name keys on the Vary stored with the resource's response, so it is known before anything goes to the network
+    cache_name = response_cache_name(url, headers)
+    if _serve_cached(client_socket, url, headers, range_h, cache_name):
+        return InterceptStatus.CLOSE_DIRECTLY
+
+    # the same artifact fetched from another repository or by another build is found by its checksum in the verification metadata
+    blob_path = find_cached_artifact(url, headers)
+    if blob_path is not None:
+        _handle_blob_hit(client_socket, url, blob_path, range_h)
+        return InterceptStatus.CLOSE_DIRECTLY
     
+    # a host that keeps failing is not probed or split into ranges until its breaker cools down
+    if is_open(url):
+        log("Circuit breaker is open for this host, passing through")
+        return InterceptStatus.PASS
+
     content_length = -1
     full_length = -1
     response_headers = {}
     response = None
+    target_url = url  # the final location after redirects
+    first_bytes = None  # bytes the ranged probe already fetched, they become the first chunk
+
+    # a ranged GET probe saves the HEAD round trip and also works where HEAD is rejected or has no length
+    probe_range = _probe_range(range_h) if DOWNLOADER_PROBE == "range" else None
 
     attempts = 1
 
     # Fetch HEAD
     for attempt in range(attempts):
         try:
-            session = requests.Session()
-            session.trust_env = DOWNLOADER_TRUST_ENV
-            with session.request('HEAD', url, allow_redirects=False, timeout=10, headers=headers, proxies=DOWNLOADER_PROXIES) as head_response:
+            # artifacts are often a redirect to a CDN, the download runs against the final location
+            target_url, head_response = probe_following_redirects(url, headers, probe_range)
+            with head_response:
                 content_length = int(head_response.headers.get('Content-Length', -1))
                 if head_response.headers.get('Content-Range') is not None:
                     full_length = int(head_response.headers.get('Content-Range', None).split("/")[-1])
@@ -122,6 +278,32 @@ def _on_header(client_socket: socket.socket, header: bytes, is_ssl: bool):
                     full_length = content_length # full file, no range
                 response_headers = filter_transfer_headers(head_response.headers)
                 response = head_response
+                if head_response.status_code < 300:
+                    # later requests key on the request headers this response varies on
+                    record_vary(url, head_response.headers)
+                if probe_range is not None:
+                    if head_response.status_code != 206:
+                        log(f"Probe answered {head_response.status_code}, passing through")
+                        return InterceptStatus.PASS
+                    # answer what the client asked for, not the probe
+                    l_range, r_range = _parse_range(range_h, full_length)
+                    if l_range > r_range:
+                        return InterceptStatus.PASS
+                    if int(head_response.headers["Content-Range"].split(" ")[-1].split("-")[0]) == l_range:
+                        first_bytes = head_response.raw.read(min(DOWNLOADER_PROBE_SIZE, r_range - l_range + 1))
+                    content_length = r_range - l_range + 1
+                    response_headers["Content-Length"] = str(content_length)
+                    if range_h is None:
+                        response_headers.pop("Content-Range", None)
+                        response.status_code, response.reason = 200, "OK"
+                elif range_h is not None and content_length != -1:
+                    # a HEAD may ignore Range, the client's range is resolved against the file size the same way
+                    l_range, r_range = _parse_range(range_h, full_length)
+                    if l_range > r_range:
+                        return InterceptStatus.PASS
+                    content_length = r_range - l_range + 1
+                    response_headers["Content-Length"] = str(content_length)
+                    response.status_code, response.reason = 206, "Partial Content"
                 if content_length != -1:
                     log(f"Content size: {content_length/1024/1024:.2f}MB")
                 else:
@@ -130,20 +312,44 @@ def _on_header(client_socket: socket.socket, header: bytes, is_ssl: bool):
                 break
         except Exception as e:
             if attempt == attempts - 1:  # 最后一次尝试失败
+                record_failure(url)
                 logger.error(f"Head request failed after {attempts} attempts: {e}")
                 return InterceptStatus.PASS
             
+    # the response may vary on other request headers than the ones the stored Vary named, e.g. no Vary was stored yet
+    variant_name = response_cache_name(url, headers, response_headers)
+    if variant_name != cache_name and _serve_cached(client_socket, url, headers, range_h, variant_name):
+        return InterceptStatus.CLOSE_DIRECTLY
+
+    # without verification metadata the checksum files are only fetched once the origin answered and the file is worth caching
+    if full_length >= DISK_CACHE_MIN_FILE_SIZE:
+        blob_path = find_cached_artifact(url, headers, fetch_sidecars=True)
+        if blob_path is not None:
+            _handle_blob_hit(client_socket, url, blob_path, range_h)
+            return InterceptStatus.CLOSE_DIRECTLY
+
     if get_mfc_dir(url) is not None:
         log("Using manual cache for large file")
         handle_mfc_download(client_socket, url, headers, content_length, response_headers, response, range_h, full_length)
         return InterceptStatus.CLOSE_DIRECTLY
 
-    if content_length >= DOWNLOADER_MULTIPART_THRESHOLD:
-        log("Using multi-thread download for large file with chunked transfer")
-        _handle_multithread_download(client_socket, url, headers, content_length, response_headers, response, range_h, full_length)
-        return InterceptStatus.CLOSE_DIRECTLY
-    
-    return InterceptStatus.PASS
+    if content_length < DOWNLOADER_MULTIPART_THRESHOLD:
+        return InterceptStatus.PASS
+
+    # mirrors serving the same bytes share the chunks, a rewrite rule replaces the origin altogether
+    sources = find_sources(target_url, source_headers(url, target_url, headers), full_length, response.headers.get("ETag"))
+
+    if sources == [target_url] and not should_accelerate(target_url):
+        log("Host profile says multi-thread download does not pay off here, passing through")
+        return InterceptStatus.PASS
+
+    if all(is_open(source) for source in sources):
+        log("Circuit breaker is open for every source, passing through")
+        return InterceptStatus.PASS
+
+    log("Using multi-thread download for large file with chunked transfer")
+    _handle_multithread_download(client_socket, url, headers, content_length, response_headers, response, range_h, full_length, sources, first_bytes)
+    return InterceptStatus.CLOSE_DIRECTLY
 
 def _extract_http_header(data: bytes):
     endpos = -1
@@ -13,12 +13,12 @@ class ConversationType(Enum):
     DATA = 1
 
 class Conversation:
-    def __init__(self, conversation_type: ConversationType, data: bytes, data_type: DataType):
+    def __init__(self, conversation_type: ConversationType, data: bytes, data_type: DataType, length: int | None = None):
         self.conversation_type = conversation_type
         if conversation_type == ConversationType.HEADER:
             self.data = data
         self.data_type = data_type
-        self.length = len(data)
+        self.length = len(data) if length is None else length
         self.time = time.time()
 
 class _Tracker:
@@ -125,6 +125,13 @@ class _Tracker:
                 )
                 self.conversation_history.append(data_conv)
 
+    def on_file_data(self, count: int, data_type: DataType):
+        """
+        Record a body sent with sendfile: only its length is known, the bytes never pass through Python.
+        """
+        if count > 0:
+            self.conversation_history.append(Conversation(ConversationType.DATA, b"", data_type, count))
+
 class LoggingSocketDecorator():
     def __init__(self, socket: socket.socket, tracker: _Tracker):
         self._socket = socket
@@ -140,6 +147,9 @@ class LoggingSocketDecorator():
 
             if method.__name__ == "recv":
                 self._tracker.on_data(result, DataType.FROM_SERVER)
+            elif method.__name__ == "sendfile":
+                # cached bodies go out with sendfile, which returns the number of bytes sent
+                self._tracker.on_file_data(result, DataType.FROM_CLIENT)
 
             return result
         return inner
@@ -0,0 +1,138 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from configs import *
+from utils import log, logger, match_prefix
+from session_pool import get_origin, get_session
+from host_profile import get_profile
+
+# 镜像: 同一个文件可以从镜像组里的多个源下载, 也可以整体改写到更快的镜像
+# Mirrors: one file may be fetched from several sources of its mirror group, or rewritten to a faster mirror
+
+_MIRROR_PROBE_TIMEOUT = 3
+_MIRROR_MAX_FAILURES = 3  # 连续失败这么多次后不再使用该镜像 / stop using a mirror after this many consecutive failures
+_MIRROR_RETRY_SECONDS = 60  # 连不上的镜像在这段时间内不再探测 / unreachable mirrors are not probed again for this long
+
+_unreachable = {}  # 源 -> 探测失败的时间 / origin -> time its probe failed
+
+# 发给其他主机时不能带上的请求头 / headers that must not follow the request to another host
+_ORIGIN_BOUND_HEADERS = {"host", "authorization", "cookie", "proxy-authorization", "referer"}
+
+def rewrite_url(url: str):
+    """按 DOWNLOADER_MIRROR_REWRITES 改写url, 不匹配时原样返回"""
+    prefix = match_prefix(url, DOWNLOADER_MIRROR_REWRITES)
+    if prefix is None:
+        return url
+    return DOWNLOADER_MIRROR_REWRITES[prefix] + url[len(prefix):]
+
+def _mirror_candidates(url: str):
+    """url在所属镜像组里其他镜像上的地址"""
+    candidates = []
+    for group in DOWNLOADER_MIRROR_GROUPS:
+        prefix = match_prefix(url, group)
+        if prefix is None:
+            continue
+        for mirror in group:
+            if mirror != prefix:
+                candidates.append(mirror + url[len(prefix):])
+    return candidates
+
+def source_headers(url: str, source: str, headers: dict):
+    """从source下载url时使用的请求头; 其他主机上的镜像不转发Host和凭据"""
+    if get_origin(source) == get_origin(url):
+        return dict(headers)
+    return {k: v for k, v in headers.items() if k.lower() not in _ORIGIN_BOUND_HEADERS}
+
+def _probe_mirror(url: str, mirror_url: str, headers: dict, full_length: int, etag: str | None):
+    """镜像上的文件长度和ETag与源站一致, 并且支持Range时返回True"""
+    failed_at = _unreachable.get(get_origin(mirror_url))
+    if failed_at is not None and time.time() - failed_at < _MIRROR_RETRY_SECONDS:
+        return False
+    try:
+        session = get_session(mirror_url)
+        probe_headers = {k: v for k, v in source_headers(url, mirror_url, headers).items() if k.lower() != "range"}
+        with session.head(mirror_url, allow_redirects=False, timeout=_MIRROR_PROBE_TIMEOUT, headers=probe_headers, proxies=DOWNLOADER_PROXIES) as r:
+            if r.status_code != 200:
+                return False
+            if int(r.headers.get("Content-Length", -1)) != full_length:
+                return False
+            # 不同的镜像不一定给出ETag, 都给出时才比较
+            mirror_etag = r.headers.get("ETag")
+            if etag is not None and mirror_etag is not None and mirror_etag.removeprefix("W/") != etag.removeprefix("W/"):
+                return False
+            return r.headers.get("Accept-Ranges", "").strip().lower() == "bytes" or get_profile(mirror_url)["range_support"] is True
+    except Exception as e:
+        logger.error(f"Mirror probe of {mirror_url} failed: {e}")
+        _unreachable[get_origin(mirror_url)] = time.time()
+        return False
+
+def find_sources(url: str, headers: dict, full_length: int, etag: str | None):
+    """
+    获取下载url时可以使用的源, 第一个是主源.
+    配置了改写时主源是改写后的镜像 (它与源站不一致时退回源站); 所属镜像组里内容一致的其他镜像也会加入.
+    """
+    primary = rewrite_url(url)
+    candidates = [candidate for candidate in _mirror_candidates(primary) if candidate != url]
+    if primary != url:
+        candidates.insert(0, primary)
+    if not candidates:
+        return [url]
+
+    with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        verified = list(executor.map(lambda candidate: _probe_mirror(url, candidate, headers, full_length, etag), candidates))
+    mirrors = [candidate for candidate, ok in zip(candidates, verified) if ok]
+
+    if primary != url:
+        if mirrors and mirrors[0] == primary:
+            log(f"Rewriting {url} to mirror {primary}")
+        else:
+            log(f"Mirror {primary} does not match {url}, using the origin")
+            mirrors.insert(0, url)
+    else:
+        mirrors.insert(0, url)
+    if len(mirrors) > 1:
+        log(f"Fetching {url} from {len(mirrors)} sources: {', '.join(get_origin(mirror) for mirror in mirrors)}")
+    return mirrors
+
+class MirrorSelector:
+    """
+    在一次下载的多个源之间分配请求.
+    每个源的权重是它单个连接的下载速度 (先用主机能力记录, 下载过程中按本次观察到的速度更新),
+    新请求交给 (进行中的请求数 + 1) / 权重 最小的源, 连续失败的源被跳过.
+    """
+    def __init__(self, urls: list):
+        self.urls = urls
+        self._lock = threading.Lock()
+        self._active = {url: 0 for url in urls}
+        self._failures = {url: 0 for url in urls}
+        self._speed = {url: get_profile(url)["single_throughput"] for url in urls}
+
+    def _weight(self, url: str):
+        known = [speed for speed in self._speed.values() if speed]
+        if self._speed[url]:
+            return self._speed[url]
+        # 没有记录的源按已知的平均速度对待, 让它有机会被测量
+        return sum(known) / len(known) if known else 1.0
+
+    def acquire(self):
+        """选择下一个请求使用的源, 用完后调用release"""
+        with self._lock:
+            usable = [url for url in self.urls if self._failures[url] < _MIRROR_MAX_FAILURES] or self.urls
+            url = min(usable, key=lambda url: (self._active[url] + 1) / self._weight(url))
+            self._active[url] += 1
+            return url
+
+    def release(self, url: str, received: int, elapsed: float):
+        with self._lock:
+            self._active[url] -= 1
+            if received >= DOWNLOADER_MIN_SPLIT_SIZE and elapsed > 0:
+                speed = received / elapsed
+                self._speed[url] = speed if not self._speed[url] else 0.7 * self._speed[url] + 0.3 * speed
+                self._failures[url] = 0
+
+    def report_failure(self, url: str):
+        with self._lock:
+            self._failures[url] += 1
+            if self._failures[url] == _MIRROR_MAX_FAILURES and len(self.urls) > 1:
+                log(f"Mirror {get_origin(url)} keeps failing, skipping it")
@@ -0,0 +1,234 @@
+import select
+import socket
+import threading
+from urllib.parse import urljoin, urlparse
+
+from configs import *
+from utils import log
+from session_pool import _create_ssl_context, create_private_session, get_origin, get_session
+from mirror_handler import source_headers
+from redirect_handler import MAX_REDIRECTS, REDIRECT_STATUS
+
+# 线程引擎的分片传输: 不经过requests, 在keep-alive连接上直接发送range请求,
+# 响应体用readinto收进调用者提供的缓冲区 (写盘模式下是临时文件的内存映射), Python层不再复制数据.
+# Chunk transport of the thread engine: range requests go out on keep-alive sockets without requests,
+# and the body is received with readinto straight into the caller's buffer (a mapping of the spool file when spooling)
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+
+# 不转发给源站的请求头, Range和Accept-Encoding由传输层自己设置
+_SKIPPED_HEADERS = {"host", "connection", "keep-alive", "proxy-connection", "proxy-authorization", "te", "trailer",
+                    "transfer-encoding", "upgrade", "content-length", "range", "accept-encoding"}
+
+_pools = {}  # 源 -> _OriginPool / origin -> _OriginPool
+_pools_lock = threading.Lock()
+
+def _request_fields(headers: dict, start: int, end: int):
+    """转发给源站的请求头, 不含Host"""
+    fields = [(k, v) for k, v in headers.items() if k.lower() not in _SKIPPED_HEADERS]
+    # 按字节偏移切分, 不能让源站压缩 / ranges are byte offsets, so the body must not be encoded
+    fields.append(("Accept-Encoding", "identity"))
+    fields.append(("Range", f"bytes={start}-{end}"))
+    return fields
+
+def _build_request(url: str, headers: dict, start: int, end: int):
+    parsed_url = urlparse(url)
+    target = (parsed_url.path or "/") + ("?" + parsed_url.query if parsed_url.query else "")
+    lines = [f"GET {target} HTTP/1.1", f"Host: {headers.get('Host') or parsed_url.netloc}"]
+    lines += [f"{k}: {v}" for k, v in _request_fields(headers, start, end)]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1")
+
+class RangeResponse:
+    """
+    HTTP/1.1响应, 响应体通过readinto读取; 读完并且源站允许时关闭后连接回到连接池.
+    socket.makefile返回的BufferedReader在缓冲区比请求的长度小时直接recv_into到目标缓冲区.
+    """
+    def __init__(self, pool, sock: socket.socket, fp, status_code: int, reason: str, headers: dict, keep_alive: bool):
+        self._pool = pool
+        self._sock = sock
+        self._fp = fp
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.keep_alive = keep_alive
+        self.complete = False
+        self._chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self._remaining = int(headers["content-length"]) if "content-length" in headers and not self._chunked else None
+        if self._remaining is None and not self._chunked:
+            self.keep_alive = False  # 没有长度的响应以连接关闭结束
+        if self._remaining == 0:
+            self.complete = True
+
+    def readinto(self, view: memoryview):
+        """把响应体的下一段读进view, 返回读到的字节数, 响应体结束时返回0"""
+        if self.complete:
+            return 0
+        size = len(view)
+        if self._chunked:
+            if not self._remaining:
+                self._remaining = int(self._fp.readline().split(b";")[0], 16)
+                if self._remaining == 0:
+                    while self._fp.readline() not in (b"\r\n", b"\n", b""):
+                        pass  # 跳过trailer
+                    self.complete = True
+                    return 0
+            size = min(size, self._remaining)
+        elif self._remaining is not None:
+            size = min(size, self._remaining)
+        count = self._fp.readinto(view[:size])
+        if count == 0:
+            if self._remaining is not None:
+                raise ConnectionError("Connection closed while reading the response body")
+            self.complete = True
+            return 0
+        if self._remaining is not None:
+            self._remaining -= count
+            if self._remaining == 0:
+                if self._chunked:
+                    self._fp.readline()
+                else:
+                    self.complete = True
+        return count
+
+    def close(self):
+        self._pool.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _RequestsResponse:
+    """配置了代理时经过requests发送, 响应体复制进调用者的缓冲区, 用法与RangeResponse相同"""
+    def __init__(self, session, response):
+        self._session = session
+        self._response = response
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = {k.lower(): v for k, v in response.headers.items()}
+
+    def readinto(self, view: memoryview):
+        data = self._response.raw.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._response.close()
+        if self._session is not None:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class _OriginPool:
+    """一个源的keep-alive连接; 连接数由download_scheduler限制, 这里只保留空闲连接"""
+    def __init__(self, url: str):
+        parsed_url = urlparse(url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or (443 if parsed_url.scheme == "https" else 80)
+        # 与requests的连接池一样, 新连接尝试恢复上一个TLS会话 / new connections resume the last TLS session, as in session_pool
+        self.ssl_context = _create_ssl_context() if parsed_url.scheme == "https" else None
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self, fresh: bool = False):
+        """返回(socket, 读取用的文件对象, 是否复用); fresh为True时总是新建连接"""
+        with self._lock:
+            while self._idle and not fresh:
+                sock, fp = self._idle.pop()
+                # 空闲的连接变为可读说明源站已经关闭了它 (或者发来了多余的数据)
+                if not select.select([sock], [], [], 0)[0]:
+                    return sock, fp, True
+                fp.close()
+                sock.close()
+        sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.ssl_context is not None:
+                sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+            sock.settimeout(READ_TIMEOUT)
+        except BaseException:
+            sock.close()
+            raise
+        return sock, sock.makefile("rb"), False
+
+    def get(self, url: str, headers: dict, start: int, end: int, fresh: bool = False):
+        """发送range请求并读取响应头"""
+        request = _build_request(url, headers, start, end)
+        while True:
+            sock, fp, reused = self._connect(fresh)
+            try:
+                sock.sendall(request)
+                return _read_response_head(self, sock, fp)
+            except OSError:
+                fp.close()
+                sock.close()
+                if not reused:
+                    raise
+                # 空闲的keep-alive连接可能已经被源站关闭, 换一个连接重新发送
+            except BaseException:
+                fp.close()
+                sock.close()
+                raise
+
+    def release(self, response: RangeResponse):
+        with self._lock:
+            if response.complete and response.keep_alive and len(self._idle) < DOWNLOADER_POOL_SIZE:
+                self._idle.append((response._sock, response._fp))
+                return
+        response._fp.close()
+        response._sock.close()
+
+def _read_response_head(pool: _OriginPool, sock: socket.socket, fp):
+    status_line = fp.readline()
+    if not status_line:
+        raise ConnectionError("Connection closed before the response")
+    version, status_code, *reason = status_line.decode("iso-8859-1").rstrip("\r\n").split(" ", 2)
+    headers = {}
+    while True:
+        line = fp.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("iso-8859-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+    return RangeResponse(pool, sock, fp, int(status_code), reason[0] if reason else "", headers, keep_alive)
+
+def _get_pool(url: str):
+    origin = get_origin(url)
+    with _pools_lock:
+        pool = _pools.get(origin)
+        if pool is None:
+            pool = _OriginPool(url)
+            _pools[origin] = pool
+            log(f"Created range connection pool for {origin}")
+        return pool
+
+def request_range(url: str, source: str, headers: dict, start: int, end: int, fresh: bool = False):
+    """
+    向source发送range请求并跟随重定向, 返回响应, 用完后需要关闭.
+    fresh为True时使用新连接 (对冲请求). 配置了代理时退回requests.
+    """
+    if any(DOWNLOADER_PROXIES.values()) or DOWNLOADER_TRUST_ENV:
+        session = create_private_session() if fresh else None
+        request_headers = source_headers(url, source, headers)
+        request_headers["Range"] = f"bytes={start}-{end}"
+        request_headers["Accept-Encoding"] = "identity"
+        response = (session or get_session(source)).get(source, headers=request_headers, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), proxies=DOWNLOADER_PROXIES)
+        return _RequestsResponse(session, response)
+
+    target = source
+    for _ in range(MAX_REDIRECTS + 1):
+        pool = _get_pool(target)
+        response = pool.get(target, source_headers(url, target, headers), start, end, fresh)
+        location = response.headers.get("location")
+        if response.status_code not in REDIRECT_STATUS or location is None:
+            return response
+        response.close()
+        target = urljoin(target, location)
+    raise ConnectionError(f"Exceeded {MAX_REDIRECTS} redirects for {source}")
@@ -0,0 +1,87 @@
+import threading
+import time
+from urllib.parse import urljoin
+
+import requests
+
+from configs import *
+from utils import log
+from session_pool import get_session
+from host_profile import record_head, record_range_support
+from mirror_handler import source_headers
+
+# 重定向: 很多制品以302指向CDN, 解析一次重定向链后多线程下载直接请求最终地址, 客户端仍然按原来的url收到文件
+# Redirects: many artifacts are a 302 to a CDN. The chain is resolved once and the parallel download runs against the final location,
+# while the client still receives the file under its original url
+
+MAX_REDIRECTS = 10
+REDIRECT_STATUS = {301, 302, 303, 307, 308}
+
+_redirects = {}  # url -> (最终地址, 过期时间) / url -> (final location, expiry time)
+_redirects_lock = threading.Lock()
+
+def get_cached_redirect(url: str):
+    """url最近解析出的最终地址, 没有或者已过期时返回None"""
+    with _redirects_lock:
+        cached = _redirects.get(url)
+        if cached is None:
+            return None
+        if cached[1] < time.time():
+            del _redirects[url]
+            return None
+        return cached[0]
+
+def forget_redirect(url: str):
+    with _redirects_lock:
+        _redirects.pop(url, None)
+
+def _remember_redirect(url: str, target: str):
+    with _redirects_lock:
+        _redirects[url] = (target, time.time() + DOWNLOADER_REDIRECT_CACHE_SECONDS)
+
+def _probe(url: str, target: str, headers: dict, probe_range: str | None):
+    session = get_session(target)
+    request_headers = source_headers(url, target, headers)
+    if probe_range is None:
+        response = session.request('HEAD', target, allow_redirects=False, timeout=10, headers=request_headers, proxies=DOWNLOADER_PROXIES)
+    else:
+        request_headers["Range"] = probe_range
+        # 收到的字节会作为第一个分片, 不能让源站压缩 / the bytes become the first chunk, so they must not be encoded
+        request_headers["Accept-Encoding"] = "identity"
+        response = session.get(target, allow_redirects=False, timeout=10, headers=request_headers, proxies=DOWNLOADER_PROXIES, stream=True)
+    record_head(target, response.status_code, response.headers)
+    # 源站实际的行为比Accept-Ranges可靠 / what the origin actually did beats Accept-Ranges
+    if probe_range is not None and response.status_code == 206:
+        record_range_support(target, True)
+    elif probe_range is not None and response.status_code == 200:
+        record_range_support(target, False)
+    return response
+
+def probe_following_redirects(url: str, headers: dict, probe_range: str | None = None):
+    """
+    对url发送HEAD并跟随重定向, 返回 (最终地址, 最终地址的响应).
+    给定probe_range时用带这个Range的GET代替HEAD, 响应体没有读取, 调用者用完后需要关闭响应.
+    其他主机上的地址不会收到Host和凭据 (见mirror_handler.source_headers).
+    缓存的最终地址失效时 (签名过期等) 从url重新解析.
+    """
+    cached = get_cached_redirect(url)
+    if cached is not None:
+        response = _probe(url, cached, headers, probe_range)
+        if response.status_code < 300:
+            return cached, response
+        response.close()
+        forget_redirect(url)
+        log(f"Cached redirect of {url} to {cached} answered {response.status_code}, resolving again")
+
+    target = url
+    for _ in range(MAX_REDIRECTS + 1):
+        response = _probe(url, target, headers, probe_range)
+        location = response.headers.get("Location")
+        if response.status_code not in REDIRECT_STATUS or location is None:
+            if target != url and response.status_code < 300:
+                _remember_redirect(url, target)
+                log(f"Resolved redirect of {url} to {target}")
+            return target, response
+        response.close()
+        target = urljoin(target, location)
+    raise requests.exceptions.TooManyRedirects(f"Exceeded {MAX_REDIRECTS} redirects for {url}")
@@ -0,0 +1,74 @@
+import fnmatch
+import time
+
+from configs import *
+from utils import log
+from redirect_handler import probe_following_redirects
+
+# 新鲜度和重新验证: 缓存的文件在 CACHE_FRESHNESS_RULES 给出的时间内直接返回, 过期后带上保存的ETag / Last-Modified
+# 向源站发送条件请求, 304时只刷新验证时间, 不重新下载. 验证时间是缓存文件旁边保存的响应头的修改时间.
+# Freshness and revalidation: a cached file is served as is for the time CACHE_FRESHNESS_RULES gives it, after that the origin is asked
+# with the stored ETag / Last-Modified and a 304 only refreshes the validation time. That time is the mtime of the stored headers
+
+# 304响应中会更新的响应头 / headers a 304 response updates
+_REFRESHED_HEADERS = {"etag", "last-modified", "cache-control", "expires", "date"}
+
+def freshness_lifetime(url: str):
+    """url的缓存保持新鲜的秒数, None为永不过期"""
+    for pattern, lifetime in CACHE_FRESHNESS_RULES.items():
+        if fnmatch.fnmatchcase(url, pattern):
+            return lifetime
+    return CACHE_FRESHNESS_DEFAULT
+
+def is_fresh(url: str, validated_at: float):
+    lifetime = freshness_lifetime(url)
+    return lifetime is None or time.time() - validated_at < lifetime
+
+def _validator(headers):
+    """响应头中用来区分版本的值: 优先ETag, 其次Last-Modified, 都没有时返回None"""
+    lowered = {k.lower(): v for k, v in headers.items()}
+    if "etag" in lowered:
+        return "etag", lowered["etag"].removeprefix("W/")
+    if "last-modified" in lowered:
+        return "last-modified", lowered["last-modified"]
+    return None
+
+def same_validators(old, new):
+    """两组响应头是否描述同一个版本, 无法判断时返回None"""
+    old_validator = _validator(old)
+    new_validator = _validator(new)
+    if old_validator is None or new_validator is None or old_validator[0] != new_validator[0]:
+        return None
+    return old_validator[1] == new_validator[1]
+
+def revalidate(url: str, headers: dict, stored_headers: dict):
+    """
+    用If-None-Match / If-Modified-Since向源站确认缓存的版本是否仍然有效.
+    有效时返回用304响应更新过的响应头; 文件已经改变, 被删除或者没有可以用来确认的验证器时返回None.
+    网络错误和源站的5xx抛出异常, 调用者可以继续使用缓存.
+    """
+    lowered = {k.lower(): v for k, v in stored_headers.items()}
+    if "etag" not in lowered and "last-modified" not in lowered:
+        log(f"No validator stored for {url}, it can not be revalidated")
+        return None
+
+    conditional_headers = {k: v for k, v in headers.items() if k.lower() not in ("range", "if-range", "if-none-match", "if-modified-since")}
+    if "etag" in lowered:
+        conditional_headers["If-None-Match"] = lowered["etag"]
+    if "last-modified" in lowered:
+        conditional_headers["If-Modified-Since"] = lowered["last-modified"]
+
+    _, response = probe_following_redirects(url, conditional_headers)
+    with response:
+        if response.status_code >= 500:
+            raise ConnectionError(f"Revalidation of {url} answered {response.status_code}")
+        # 不支持条件请求的源站返回200, 版本相同时也算有效 / origins without conditional requests answer 200, the same version still counts
+        if response.status_code != 304 and not (response.status_code == 200 and same_validators(stored_headers, response.headers)):
+            log(f"Cached copy of {url} is outdated (HTTP {response.status_code})")
+            return None
+
+        updated = {k: v for k, v in response.headers.items() if k.lower() in _REFRESHED_HEADERS}
+        refreshed = {k: v for k, v in stored_headers.items() if k.lower() not in {key.lower() for key in updated}}
+        refreshed.update(updated)
+    log(f"Revalidated cached copy of {url}")
+    return refreshed
@@ -0,0 +1,106 @@
+import ssl
+import threading
+import weakref
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+
+from configs import *
+from utils import log
+
+# 每个源 (scheme://host:port) 共享一个Session, 分片之间复用keep-alive连接
+# One shared session per origin so chunk workers reuse keep-alive connections
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+class _SessionReusingContext(ssl.SSLContext):
+    """记住最近一次的TLS会话, 新连接握手时尝试恢复 / Resume the last TLS session on new connections"""
+    def _remember(self, ssl_sock):
+        self._last_socket = weakref.ref(ssl_sock)
+        if ssl_sock.session is not None:
+            self._tls_session = ssl_sock.session
+
+    def _last_session(self):
+        # TLS 1.3 的 session ticket 在握手之后才到达, 所以从上一个socket上重新取
+        last_socket = getattr(self, "_last_socket", None)
+        ssl_sock = last_socket() if last_socket is not None else None
+        if ssl_sock is not None:
+            try:
+                if ssl_sock.session is not None:
+                    self._tls_session = ssl_sock.session
+            except (ValueError, OSError):
+                pass
+        return getattr(self, "_tls_session", None)
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if kwargs.get("session") is None:
+            kwargs["session"] = self._last_session()
+        try:
+            ssl_sock = super().wrap_socket(sock, *args, **kwargs)
+        except ssl.SSLError:
+            # 证书校验失败也是ValueError, 此时socket已经关闭, 不能重试
+            raise
+        except ValueError:
+            if kwargs["session"] is None:
+                raise
+            # 会话不可用 (例如主机名变化), 退回完整握手
+            kwargs["session"] = None
+            ssl_sock = super().wrap_socket(sock, *args, **kwargs)
+        self._remember(ssl_sock)
+        return ssl_sock
+
+def _create_ssl_context():
+    context = _SessionReusingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(DEFAULT_CA_BUNDLE_PATH)
+    return context
+
+class _PooledAdapter(HTTPAdapter):
+    """带共享SSLContext的连接池适配器 / Adapter whose connections share one SSLContext"""
+    def __init__(self, pool_size: int):
+        self._ssl_context = _create_ssl_context()
+        super().__init__(pool_connections=1, pool_maxsize=pool_size, pool_block=False)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+        if verify is True:
+            # CA已经加载进共享的context, 避免每次建连都重新加载
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+def get_origin(url: str):
+    """获取url的源 / Get the origin (scheme://netloc) of url"""
+    parsed_url = urlparse(url)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}".lower()
+
+def _create_session():
+    session = requests.Session()
+    session.trust_env = DOWNLOADER_TRUST_ENV
+    # 共享的Session不能在不同客户端之间串cookie
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = _PooledAdapter(DOWNLOADER_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def get_session(url: str) -> requests.Session:
+    """获取该源共享的Session / Get the shared keep-alive session for the origin of url"""
+    origin = get_origin(url)
+    with _sessions_lock:
+        session = _sessions.get(origin)
+        if session is None:
+            session = _create_session()
+            _sessions[origin] = session
+            log(f"Created connection pool for {origin} (size: {DOWNLOADER_POOL_SIZE})")
+        return session
+
+def create_private_session() -> requests.Session:
+    """新建一个不共享的Session, 请求走全新的连接 / A private session, its requests go out on fresh connections"""
+    return _create_session()
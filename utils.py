@@ -90,6 +90,14 @@ def get_base_domain(domain: str):
         return '.'.join(parts[-2:])
     return domain
 
+def match_prefix(url: str, prefixes):
+    """The longest of prefixes that url starts with, None if there is none"""
+    matched = None
+    for prefix in prefixes:
+        if url.startswith(prefix) and (matched is None or len(prefix) > len(matched)):
+            matched = prefix
+    return matched
+
 def filter_transfer_headers(headers: dict):
     """
     Filter out headers that are related to transfer encoding, which is python will handle automatically.